@@ -4,8 +4,10 @@ import logging
 from multiprocessing import Pool
 import numpy as np
 from collections import defaultdict
+from functools import partial
 import time
 from pandas.core.indexes.base import InvalidIndexError
+from clubcpg.Sharding import select_shard, shard_tag
 
 
 class CalculateCompleteBins:
@@ -13,13 +15,23 @@ class CalculateCompleteBins:
     Class to calculate the number of reads covering all CpGs
     """
     def __init__(self,
-                 bam_file, bin_size, output_directory, number_of_processors=1, mbias_read1_5=None, mbias_read1_3=None, mbias_read2_5= None, mbias_read2_3=None, no_overlap=True):
+                 bam_file, bin_size, output_directory, number_of_processors=1, mbias_read1_5=None, mbias_read1_3=None, mbias_read2_5= None, mbias_read2_3=None, no_overlap=True,
+                 models_folder=None, imputation_densities=range(2, 6), low_threshold=0.2, high_threshold=0.8,
+                 target_regions=None):
         """
         This class is initialized with a path to a bam file and a bin size
     
         :param bam_file: One of the BAM files for analysis to be performed
         :param bin_size: Size of the bins for the analysis, integer
         :number_of_processors: How many CPUs to use for parallel computation, default=1
+        :param models_folder: Optional folder of trained PReLIM models. If given, bins of the imputation densities are
+            imputed from the matrices parsed for coverage and the report gets a fourth column with the number of
+            complete reads after imputation, the same count clubcpg-impute-coverage reports
+        :param imputation_densities: CpG densities to impute, a model for each must be in models_folder
+        :param low_threshold: Imputed values at or below this are called unmethylated
+        :param high_threshold: Imputed values at or above this are called methylated
+        :param target_regions: Optional :class:`clubcpg.IntervalIndex.IntervalIndex`. If given only bins overlapping
+            its regions are analyzed, and the reads of each window of bins are fetched from the bam file once
         """
         self.input_bam_file = bam_file
         self.bin_size = int(bin_size)
@@ -34,16 +46,29 @@ class CalculateCompleteBins:
         self.mbias_read2_3 = mbias_read2_3
         self.no_overlap = no_overlap
 
-    def calculate_bin_coverage(self, bin):
+        self.models_folder = models_folder
+        self.imputation_densities = set(imputation_densities)
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.target_regions = target_regions
+
+    def _create_parser(self):
+        return BamFileReadParser(self.input_bam_file, 20, self.mbias_read1_5, self.mbias_read1_3,
+                                 self.mbias_read2_5, self.mbias_read2_3, self.no_overlap)
+
+    def calculate_bin_coverage(self, bin, keep_unknowns=False, parser=None):
         """
         Take a single bin, return a matrix. This is passed to a multiprocessing Pool.
 
         :param bin: Bin should be passed as "Chr19_4343343"
-        :return: pd.DataFrame with rows containing NaNs dropped
+        :param keep_unknowns: Also return the matrix before incomplete reads are dropped, as int8 array with unknowns as -1
+        :param parser: Optional BamFileReadParser to reuse, for example one which prefetched the reads around this bin
+        :return: tuple of (bin, pd.DataFrame with rows containing NaNs dropped), with the int8 matrix as third element if
+            keep_unknowns is set
         """
         # Get reads from bam file
-        parser = BamFileReadParser(self.input_bam_file, 20, self.mbias_read1_5, self.mbias_read1_3,
-                                   self.mbias_read2_5, self.mbias_read2_3, self.no_overlap)
+        if parser is None:
+            parser = self._create_parser()
         # Split bin into parts
         chromosome, bin_location = bin.split("_")
         bin_location = int(bin_location)
@@ -60,6 +85,8 @@ class CalculateCompleteBins:
 
         # drop rows of ALL NaN
         matrix = matrix.dropna(how="all")
+        # the same matrix clubcpg-impute-coverage extracts for imputation, kept before incomplete reads are dropped
+        unknowns = np.array(matrix.fillna(-1)).astype('int8') if keep_unknowns else None
         # convert to data_frame of 1s and 0s, drop rows with NaN
         matrix = matrix.dropna()
         # if matrix is empty, attempt to create it with correction before giving up
@@ -71,7 +98,7 @@ class CalculateCompleteBins:
             except InvalidIndexError as e:
                 logging.error("Invalid Index error when creating matrices at bin {}".format(bin))
                 logging.debug(str(e))
-                return bin, original_matrix
+                return (bin, original_matrix, unknowns) if keep_unknowns else (bin, original_matrix)
             except ValueError as e:
                 logging.error("Matrix concat error ar bin {}".format(bin))
                 logging.debug(str(e))
@@ -82,8 +109,64 @@ class CalculateCompleteBins:
             else:
                 logging.info("Correction attempt at bin {}: FAILED".format(bin))
 
+        if keep_unknowns:
+            return bin, matrix, unknowns
         return bin, matrix
 
+    def calculate_window_coverage(self, window, keep_unknowns=False):
+        """
+        Calculate the coverage of all bins of one window with a single fetch from the bam file. This is passed to a
+        multiprocessing Pool.
+
+        :param window: tuple of (chromosome, start, stop, bins) as generated by
+            :meth:`clubcpg.IntervalIndex.IntervalIndex.bin_intervals`
+        :param keep_unknowns: see :meth:`calculate_bin_coverage`
+        :return: list with the result of :meth:`calculate_bin_coverage` for every bin of the window
+        """
+        chromosome, start, stop, bins = window
+        parser = self._create_parser()
+        try:
+            parser.prefetch(chromosome, start, stop)
+        except ValueError as e:
+            # Chromosome is not in the bam file
+            logging.error("Could not fetch reads of {}:{}-{}".format(chromosome, start, stop))
+            logging.debug(str(e))
+            return [None] * len(bins)
+
+        return [self.calculate_bin_coverage(bin, keep_unknowns, parser) for bin in bins]
+
+    def impute_read_counts(self, results):
+        """
+        Number of complete reads of every bin after imputation, from results of calculate_bin_coverage with keep_unknowns
+
+        :param results: list of (bin, matrix, int8 matrix with unknowns) tuples or None, as returned by the pool
+        :return: list of imputed read counts in the order of results. Bins of other densities, and bins whose unknown
+            matrix does not have as many CpGs as the complete matrix, keep their number of complete reads
+        """
+        # Imported here, imputation pulls in the model training dependencies which coverage alone does not need
+        from clubcpg.Imputation import Imputation
+        from clubcpg_prelim import RaggedMatrices
+
+        counts = [result[1].shape[0] if result else None for result in results]
+
+        by_density = defaultdict(list)
+        for k, result in enumerate(results):
+            if result is None:
+                continue
+            density = result[1].shape[1]
+            if density in self.imputation_densities and result[2].ndim == 2 and result[2].shape[1] == density:
+                by_density[density].append(k)
+
+        imputer = Imputation(None, self.input_bam_file, low_threshold=self.low_threshold,
+                             high_threshold=self.high_threshold, bin_size=self.bin_size)
+        for density, indices in by_density.items():
+            matrices = RaggedMatrices.from_matrices([results[k][2] for k in indices], cpg_density=density)
+            imputed = imputer.imputed_read_counts(self.models_folder, matrices)
+            for k, count in zip(indices, imputed):
+                counts[k] = int(count)
+
+        return counts
+
     def get_chromosome_lengths(self):
         """
         Get dictionary containing lengths of the chromosomes. Uses bam file for reference
@@ -123,11 +206,13 @@ class CalculateCompleteBins:
 
         return all_bins
 
-    def analyze_bins(self, individual_chrom=None):
+    def analyze_bins(self, individual_chrom=None, shard=None):
         """
         Main function in class. Run the Complete analysis on the data
 
         :param individual_chrom: Chromosome to analyze: ie "chr7"
+        :param shard: Optional tuple of (i, N), analyze only the i-th of N contiguous shards of the bins, balanced by
+            genome length. The report name gets a ".shard{i}of{N}" tag for clubcpg-merge
         :return: filename of the generated report
         """
 
@@ -140,7 +225,9 @@ class CalculateCompleteBins:
 
         # Get and clean dict of chromosome lenghts, convert to list of bins
         chromosome_lengths = self.get_chromosome_lengths()
-        chromosome_lengths = self.remove_scaffolds(chromosome_lengths)
+        # Target regions select the chromosomes themselves
+        if self.target_regions is None:
+            chromosome_lengths = self.remove_scaffolds(chromosome_lengths)
 
         # If one chromosome was specified use only that chromosome
         if individual_chrom:
@@ -148,26 +235,52 @@ class CalculateCompleteBins:
             new[individual_chrom] = chromosome_lengths[individual_chrom]
             chromosome_lengths = new
 
-        bins_to_analyze = self.generate_bins_list(chromosome_lengths)
+        # With target regions every task is a window of bins sharing one fetch, otherwise a single bin
+        if self.target_regions is not None:
+            bins_to_analyze = defaultdict(list)
+            for window in self.target_regions.bin_intervals(self.bin_size, chromosome_lengths):
+                bins_to_analyze[window[0]].append(window)
+            calculate = partial(self.calculate_window_coverage, keep_unknowns=bool(self.models_folder))
+        else:
+            bins_to_analyze = self.generate_bins_list(chromosome_lengths)
+            calculate = partial(self.calculate_bin_coverage, keep_unknowns=bool(self.models_folder))
+
+        if shard is not None:
+            # Every bin costs the same, so shards cover about the same length of the genome
+            tasks = [(chromosome, task) for chromosome, chromosome_tasks in bins_to_analyze.items()
+                     for task in chromosome_tasks]
+            costs = [len(task[3]) if self.target_regions is not None else 1 for chromosome, task in tasks]
+            bins_to_analyze = defaultdict(list)
+            for chromosome, task in select_shard(tasks, costs, shard):
+                bins_to_analyze[chromosome].append(task)
 
         # Set up for multiprocessing
         # Loop over bin dict and pool.map them individually
         final_results = []
         for key in bins_to_analyze.keys():
             pool = Pool(processes=self.number_of_processors)
-            results = pool.map_async(self.calculate_bin_coverage, bins_to_analyze[key])
+            results = pool.map_async(calculate, bins_to_analyze[key])
 
             track_progress(results)
 
             # once done, get results
             results = results.get()
+            if self.target_regions is not None:
+                results = [result for window_results in results for result in window_results]
+
+            # Impute while the matrices of this chromosome are at hand, only their counts are kept
+            if self.models_folder:
+                logging.info("Imputing bins of {}".format(key))
+                imputed = self.impute_read_counts(results)
+                results = [result[:2] + (count,) if result else None for result, count in zip(results, imputed)]
 
             final_results.extend(results)
 
         logging.info("Analysis complete")
 
         # Write to output file
-        output_file = os.path.join(self.output_directory, "CompleteBins.{}.{}.csv".format(os.path.basename(self.input_bam_file), individual_chrom))
+        output_file = os.path.join(self.output_directory, "CompleteBins.{}.{}{}.csv".format(
+            os.path.basename(self.input_bam_file), individual_chrom, shard_tag(shard)))
 
         with open(output_file, "w") as out:
             for result in final_results:
@@ -177,7 +290,11 @@ class CalculateCompleteBins:
                     # num of reads
                     out.write(str(result[1].shape[0]) + ",")
                     # num of CpGs
-                    out.write(str(result[1].shape[1]) + "\n")
+                    out.write(str(result[1].shape[1]))
+                    # num of reads after imputation
+                    if self.models_folder:
+                        out.write("," + str(result[2]))
+                    out.write("\n")
 
         logging.info("Full read coverage analysis complete!")
         return output_file
@@ -6,12 +6,17 @@ import logging
 import os
 from clubcpg.ParseBam import BamFileReadParser
 from clubcpg.OutputComparisonResults import OutputIndividualMatrixData
+from clubcpg.ClusterTable import ClusterTableWriter
 from clubcpg.Imputation import Imputation
 import datetime
 from multiprocessing import Pool
-import time
-import tempfile
+from functools import partial
 from sklearn.utils import shuffle
+from clubcpg.Pipeline import BoundedPipeline
+from clubcpg.DensityScheduler import DensityScheduler
+from clubcpg.ModelRegistry import default_registry
+from clubcpg.CoverageFilter import iter_coverage, read_coverage
+from clubcpg.Sharding import assign_shards, bin_cost, iter_shard, select_shard, shard_tag
 
 
 class ClusterReads:
@@ -23,11 +28,20 @@ class ClusterReads:
     >>> cluster = ClusterReads(bam_a="/path/to/file.bam", bam_b="/path/to/file.bam", bins_file="/path/to/file.csv", suffix="chr19")
     >>> cluster.execute()
 
+    The bins file can also be the unfiltered clubcpg-coverage output, bins below min_reads or min_cpgs are then skipped
+    while it is read. With target_regions only bins overlapping the targets are clustered, and without a bins file all
+    of them are. With shard=(i, N) only the i-th of N contiguous shards of the bins is clustered, balanced by the read
+    counts of the bins file, and the output name gets a ".shard{i}of{N}" tag for clubcpg-merge.
+
     """
 
+    # Number of bins sent to a worker at once
+    bins_per_task = 64
+
     def __init__(self, bam_a: str, bam_b=None, bin_size=100, bins_file=None, output_directory=None, num_processors=1,
         cluster_member_min=4, read_depth_req=10, remove_noise=True, mbias_read1_5=None, 
-        mbias_read1_3=None, mbias_read2_5=None, mbias_read2_3=None, suffix="", no_overlap=True, permute_labels=False):
+        mbias_read1_3=None, mbias_read2_5=None, mbias_read2_3=None, suffix="", no_overlap=True, permute_labels=False,
+        min_reads=None, min_cpgs=None, target_regions=None, shard=None, output_format="csv", use_imputed=False):
 
         self.bam_a = bam_a
         self.bam_b = bam_b
@@ -45,12 +59,32 @@ class ClusterReads:
         self.suffix = suffix
         self.no_overlap = no_overlap
         self.permute_labels = permute_labels
+        # Thresholds on the reads and cpgs columns of the bins file, None to use every bin in it
+        self.min_reads = min_reads
+        self.min_cpgs = min_cpgs
+        # If True min_reads applies to the imputed_reads column written by clubcpg-coverage with models
+        self.use_imputed = use_imputed
+        # Optional IntervalIndex, bins are then processed per window of bins sharing one fetch from each bam file
+        self.target_regions = target_regions
+        # Optional tuple of (i, N), only the bins of shard i of N are processed
+        self.shard = shard
+        # csv, or parquet, feather or npz for a file with typed columns
+        self.output_format = output_format
         
         if bam_b:
             self.single_file_mode = False
         else:
             self.single_file_mode = True
 
+    @property
+    def input_labels(self):
+        """
+        Labels of the input files in the cluster output, the bam file name in single-file mode
+        """
+        if self.single_file_mode:
+            return (os.path.basename(self.bam_a),)
+        return ("A", "B")
+
     # Remove clusters with less than n members
     def filter_data_frame(self, matrix: pd.DataFrame):
         """
@@ -195,14 +229,23 @@ class ClusterReads:
         corrected_reads = parser.correct_cpg_positions(reads)
         return corrected_reads
 
+    def _create_parsers(self):
+        """
+        :return: list with one BamFileReadParser per input file
+        """
+        return [BamFileReadParser(bam_file, 20, read1_5=self.mbias_read1_5, read1_3=self.mbias_read1_3,
+                                  read2_5=self.mbias_read2_5, read2_3=self.mbias_read2_3, no_overlap=self.no_overlap)
+                for bam_file in (self.bam_a, self.bam_b) if bam_file]
+
     # MAIN METHOD
-    def process_bins(self, bin):
+    def process_bins(self, bin, parsers=None):
         """
         This is the main method and should be called using Pool.map It takes one bin location and uses the other helper
         functions to get the reads, form the matrix, cluster it with DBSCAN, and output the cluster data as text lines
         ready to writing to a file.
 
         :param bin: string in this format: "chr19_55555"
+        :param parsers: Optional list of BamFileReadParser to reuse, one per input file
         :return: a list of lines representing the cluster data from that bin
 
         """
@@ -213,13 +256,13 @@ class ClusterReads:
         bin_loc = int(bin_loc)
 
         # Create bam parser and parse reads
-        bam_parser_A = BamFileReadParser(self.bam_a, 20, read1_5=self.mbias_read1_5, read1_3=self.mbias_read1_3,
-                                        read2_5=self.mbias_read2_5, read2_3=self.mbias_read2_3, no_overlap=self.no_overlap)
+        if parsers is None:
+            parsers = self._create_parsers()
+        bam_parser_A = parsers[0]
         reads_A = bam_parser_A.parse_reads(chromosome, bin_loc - self.bin_size, bin_loc)
 
         if not self.single_file_mode:
-            bam_parser_B = BamFileReadParser(self.bam_b, 20, read1_5=self.mbias_read1_5, read1_3=self.mbias_read1_3,
-                                            read2_5=self.mbias_read2_5, read2_3=self.mbias_read2_3, no_overlap=self.no_overlap)
+            bam_parser_B = parsers[1]
             reads_B = bam_parser_B.parse_reads(chromosome, bin_loc - self.bin_size, bin_loc)
 
         # This try/catch block returns None for a bin if any discrepancies in the data format of the bins are detected.
@@ -257,10 +300,75 @@ class ClusterReads:
             if matrix_B.shape[0] < self.read_depth_req:
                 return None
 
+        return self.cluster_bin_matrices(chromosome, bin_loc, matrix_A, matrix_B if not self.single_file_mode else None)
+
+    def process_window(self, window):
+        """
+        Cluster all bins of one window, fetching its reads from every input file once. This is passed to a
+        multiprocessing Pool.
+
+        :param window: tuple of (chromosome, start, stop, bins) as generated by
+            :meth:`clubcpg.IntervalIndex.IntervalIndex.bin_intervals`
+        :return: list with the result of :meth:`process_bins` for every bin of the window
+        """
+        chromosome, start, stop, bins = window
+        parsers = self._create_parsers()
+        try:
+            for parser in parsers:
+                parser.prefetch(chromosome, start, stop)
+        except ValueError as e:
+            # Chromosome is not in one of the bam files
+            logging.error("Could not fetch reads of {}:{}-{}".format(chromosome, start, stop))
+            logging.debug(str(e))
+            return [None] * len(bins)
+
+        return [self.process_bins(bin, parsers) for bin in bins]
+
+    def _target_windows(self, bins=None):
+        """
+        :param bins: optional iterable of bin ids to group, all bins overlapping the targets if None
+        :return: iterable of windows of bins overlapping :attr:`target_regions`
+        """
+        if bins is not None:
+            return self.target_regions.group_bins(bins, self.bin_size)
+
+        parser = BamFileReadParser(self.bam_a, 20)
+        chromosome_lengths = dict(zip(parser.OpenBamFile.references, parser.OpenBamFile.lengths))
+        windows = self.target_regions.bin_intervals(self.bin_size, chromosome_lengths)
+        # Without read counts every bin costs the same
+        return select_shard(windows, [len(window[3]) for window in windows], self.shard)
+
+    def _shard_bins(self):
+        """
+        :return: generator of the bins of the bins file passing the thresholds, only those of :attr:`shard` if set
+        """
+        def read_bins():
+            return iter_coverage(self.bins_file, self.min_reads, self.min_cpgs, use_imputed=self.use_imputed)
+
+        def cost(item):
+            fields = item[1].split(",")
+            # A bins file may list only bin ids, their cost is then unknown
+            return bin_cost(int(fields[1]) if len(fields) > 1 else None)
+
+        return (bin_ for bin_, line in iter_shard(read_bins, cost, self.shard))
+
+    def cluster_bin_matrices(self, chromosome, bin_loc, matrix_A: pd.DataFrame, matrix_B=None):
+        """
+        Label, combine and cluster the complete read matrices of one bin and return the output lines for it
+
+        :param chromosome: chromosome as "chr19"
+        :param bin_loc: location representing the bin given as the end coordinate, ie 590000
+        :param matrix_A: dataframe of complete reads from bam_a
+        :param matrix_B: dataframe of complete reads from bam_b, None in single file mode
+        :return: a list of lines representing the cluster data from that bin, or None if it could not be clustered
+
+        """
+        bin = self.make_bin_label(chromosome, bin_loc)
+
         # create labels and add to dataframe
 
         # If two files label each A and B, otherwise use file_name as label
-        if not self.single_file_mode:
+        if matrix_B is not None:
             try:
                 labels_A = ['A'] * len(matrix_A)
                 matrix_A['input'] = labels_A
@@ -273,7 +381,7 @@ class ClusterReads:
             labels_A = [os.path.basename(self.bam_a)] * len(matrix_A)
             matrix_A['input'] = labels_A
 
-        if not self.single_file_mode:
+        if matrix_B is not None:
             try:
                 # ensure they have the same CpG positions
                 matrix_B.columns = matrix_A.columns
@@ -319,36 +427,38 @@ class ClusterReads:
 
         :param return_only: Whether to return the results as a variabel (True) or write to file (False)
         :type return_only: bool
-        :return: list of lists if :attribute: `return_only` False otherwise None
-        :rtype: list or None
+        :return: list of lists if :attribute: `return_only` True otherwise the path of the output file
+        :rtype: list or str
 
         """
         start_time = datetime.datetime.now().strftime("%y-%m-%d")
 
-        def track_progress(job, update_interval=60):
-            while job._number_left > 0:
-                logging.info("Tasks remaining = {0}".format(
-                    job._number_left * job._chunksize
-                ))
-                time.sleep(update_interval)
+        def track_progress(results, update_interval=100000):
+            for k, result in enumerate(results):
+                if (k + 1) % update_interval == 0:
+                    logging.info("Tasks completed = {0}".format(k + 1))
+                yield result
 
-        bins = []
-        with open(self.bins_file, "r") as f:
-            for line in f:
-                data = line.strip().split(",")
-                bins.append(data[0])
+        # The bins file is read lazily, bins failing the thresholds never reach the pool
+        bins = None
+        if self.bins_file:
+            bins = self._shard_bins()
 
-        pool = Pool(processes=self.num_processors)
-        results = pool.map_async(self.process_bins, bins)
-        track_progress(results)
-        results = results.get()
+        with Pool(processes=self.num_processors) as pool:
+            if self.target_regions is not None:
+                windows = pool.imap(self.process_window, self._target_windows(bins))
+                results = track_progress(result for window_results in windows for result in window_results)
+            else:
+                results = track_progress(pool.imap(self.process_bins, bins, chunksize=self.bins_per_task))
 
-        if return_only:
-            return results
+            if return_only:
+                return list(results)
 
-        else:
-            output = OutputIndividualMatrixData(results)
-            output.write_to_output(self.output_directory, "Clustering.{}{}.{}".format(os.path.basename(self.bam_a), self.suffix, start_time))
+            else:
+                output = OutputIndividualMatrixData(results)
+                return output.write_to_output(self.output_directory, "Clustering.{}{}{}.{}".format(
+                    os.path.basename(self.bam_a), self.suffix, shard_tag(self.shard), start_time),
+                    self.output_format, self.input_labels)
 
 
 class ClusterReadsWithImputation(ClusterReads):
@@ -365,19 +475,32 @@ class ClusterReadsWithImputation(ClusterReads):
     
     def __init__(self, bam_a: str, bam_b=None, bin_size=100, bins_file=None, output_directory=None, num_processors=1,
         cluster_member_min=4, read_depth_req=10, remove_noise=True, mbias_read1_5=None,
-        mbias_read1_3=None, mbias_read2_5=None, mbias_read2_3=None, suffix="", no_overlap=True, models_A=None, models_B=None, chunksize=10000):
+        mbias_read1_3=None, mbias_read2_5=None, mbias_read2_3=None, suffix="", no_overlap=True, models_A=None, models_B=None, chunksize=10000,
+        pipeline_depth=2, low_threshold=0.2, high_threshold=0.8, shard=None, output_format="csv"):
 
         self.models_A = models_A
         self.models_B = models_B
-        self.chunksize = chunksize
+        self.chunksize = int(chunksize)
+        # CpG densities which have imputation models, all other bins are clustered without imputation
+        self.imputed_densities = range(2, 6)
+        # Seconds before extraction or clustering of one bin is abandoned
+        self.bin_timeout = 60
+        # Counters of the inference avoided by prune_unreachable_bins()
+        self.pruning_stats = dict.fromkeys(['bins_considered', 'bins_pruned_depth', 'bins_pruned_missing_pair',
+                                            'matrices_skipped', 'cells_skipped'], 0)
+        # Number of chunks allowed to wait between the extraction, imputation and clustering stages
+        self.pipeline_depth = int(pipeline_depth)
+        # Imputed values at or below low_threshold are called 0, at or above high_threshold 1, anything between is NaN
+        self.low_threshold = float(low_threshold)
+        self.high_threshold = float(high_threshold)
 
         super().__init__(bam_a, bam_b, bin_size, bins_file, output_directory, 
         num_processors, cluster_member_min, read_depth_req, remove_noise, 
-        mbias_read1_5, mbias_read1_3, mbias_read2_5, mbias_read2_3, suffix, no_overlap)
+        mbias_read1_5, mbias_read1_3, mbias_read2_5, mbias_read2_3, suffix, no_overlap, shard=shard,
+        output_format=output_format)
 
     def get_coverage_data(self, cpg_density=None):
-        coverage_data = pd.read_csv(self.bins_file, header=None)
-        coverage_data.columns = ['bin', 'reads', 'cpgs']
+        coverage_data = read_coverage(self.bins_file)
 
         return coverage_data
 
@@ -393,180 +516,200 @@ class ClusterReadsWithImputation(ClusterReads):
     def filter_coverage_data(coverage_data, cpg_density):
         return coverage_data[coverage_data['cpgs'] == cpg_density]
 
-    def execute(self, return_only=False):
-
-        coverage_data = self.get_coverage_data()
-
-        # start the main loop for imputation of these CpGs
-        final_results_tf = tempfile.TemporaryFile(mode="w+t")
-        final_results_tf.write("bin,input_label,methylation,class_label,read_number,cpg_number,cpg_pattern,class_split" + "\n")
-        for i in range(2,6):
-            print("Starting Imputation of CpG density {}...".format(i))
-
-            imputer_A = Imputation(cpg_density=i, 
-                bam_file=self.bam_a,
+    def _create_imputers(self):
+        """
+        Create one :class:`clubcpg.Imputation.Imputation` per imputed CpG density and input file
+        """
+        imputers = dict()
+        for i in self.imputed_densities:
+            imputers[i] = [Imputation(cpg_density=i,
+                bam_file=bam_file,
                 mbias_read1_5=self.mbias_read1_5,
                 mbias_read1_3=self.mbias_read1_3,
                 mbias_read2_5=self.mbias_read2_5,
                 mbias_read2_3=self.mbias_read2_3,
                 processes=self.num_processors,
-            )
-
-            if self.bam_b:
-                imputer_B = Imputation(cpg_density=i, 
-                    bam_file=self.bam_b,
-                    mbias_read1_5=self.mbias_read1_5,
-                    mbias_read1_3=self.mbias_read1_3,
-                    mbias_read2_5=self.mbias_read2_5,
-                    mbias_read2_3=self.mbias_read2_3,
-                    processes=self.num_processors
-                )
-
-            # Subset for CpG density
-            sub_coverage_data = self.filter_coverage_data(coverage_data, i)
-
-            # Split into chunks for memory management
-            n = self.chunksize
-            chunks = [sub_coverage_data[i * n:(i + 1) * n] for i in range((len(sub_coverage_data) + n - 1) // n )]
-            n_chunks = len(chunks)
-            print("Divided into {} chunks for processing...".format(n_chunks), flush=True)
-
-            for j, chunk in enumerate(chunks):
-                print("Extracting matrices from chunk {}/{}...".format(j+1,n_chunks))
-                bins_A, matrices_A = imputer_A.extract_matrices(chunk, return_bins=True)
-
-                if self.bam_b:
-                    print("Extracting from second imput bam...", flush=True)
-                    bins_B, matrices_B = imputer_B.extract_matrices(chunk, return_bins=True)
-                else:
-                    bins_B = None
-                    matrices_B = None
-
-                # Create dictionary with key as bin and values as a list like [matrix_A, matrix_B]
-                data_A_dict = self.create_dictionary(bins_A, matrices_A)
-                if self.bam_b:
-                    data_B_dict = self.create_dictionary(bins_B, matrices_B)
-
-                # Attempt to impute
-                print("Imputing chunk {}/{}...".format(j+1, n_chunks), flush=True)
-                imputed_matrices_A = imputer_A.impute_from_model(self.models_A, list(data_A_dict.values()))
-                if self.bam_b:
-                    imputed_matrices_B = imputer_B.impute_from_model(self.models_B, data_B_dict.values())
-                else:
-                    imputed_matrices_B = None
-
-                data_imputed_A_dict = self.create_dictionary(data_A_dict.keys(), imputed_matrices_A)
-
-                if self.bam_b:
-                    data_imputed_B_dict = self.create_dictionary(data_B_dict.keys(), imputed_matrices_B)
-
-                # Combine and cluster as normal
-                # Maybe do this in the future
-                # def _multiprocess_cluster_work(bin_):
-                #     pass
-
-                for bin_ in data_imputed_A_dict.keys():
-                    matrix_A = data_imputed_A_dict[bin_]
-                    matrix_A = pd.DataFrame(matrix_A)
-                    matrix_A = matrix_A.dropna()
-                    if matrix_A.shape[0] < self.read_depth_req:
-                        continue
-                    if self.bam_b:
-                        try:
-                            matrix_B = data_imputed_B_dict[bin_]
-                        # matrix doesnt exist in other file
-                        except KeyError:
-                            logging.info("Covered bin {} doesnt exist in second file".format(bin_))
-                            continue
-                        matrix_B = pd.DataFrame(matrix_B)
-                        matrix_B = matrix_B.dropna()
-                        if matrix_B.shape[0] < self.read_depth_req:
-                            # TODO SAME AS ABOVE
-                            continue
-                    
-                    if self.bam_b:
-                        labels_A = ['A'] * len(matrix_A)
-                        matrix_A['input'] = labels_A
-                        labels_B = ['B'] * len(matrix_B)
-                        matrix_B['input'] = labels_B
-                    else:
-                        labels_A = [os.path.basename(self.bam_a)] * len(matrix_A)
-                        matrix_A['input'] = labels_A
-
-                    if self.bam_b:
-                        try:
-                            full_matrix = pd.concat([matrix_A, matrix_B])
-                        except ValueError as e:
-                            logging.error("Matrix concat eror in bin {}".format(bin_))
-                            continue
-                    else:
-                        full_matrix = matrix_A
-
-                    # get data to cluster
-                    data_to_cluster = np.array(full_matrix)[:,:-1]
-                    clf = DBSCAN(min_samples=2)
-                    try:
-                        labels = clf.fit_predict(data_to_cluster)
-                    except ValueError as e:
-                        logging.error("ValueError when trying to cluster bin {}".format(bin_))
-                        continue
+                bin_size=self.bin_size,
+                low_threshold=self.low_threshold,
+                high_threshold=self.high_threshold,
+            ) for bam_file in (self.bam_a, self.bam_b) if bam_file]
+
+        return imputers
+
+    def _extract_chunk(self, scheduler, chunk):
+        """
+        Pipeline stage: extract all bins of one chunk. Bins without an imputed CpG density are clustered in the pool
+        """
+        j, n_chunks, chunk = chunk
+        print("Extracting matrices from chunk {}/{}...".format(j+1, n_chunks), flush=True)
+        routed, unimputable_results = scheduler.extract(chunk)
+
+        return j, n_chunks, routed, unimputable_results
+
+    def prune_unreachable_bins(self, matrices):
+        """
+        Remove bins which cannot reach :attr:`read_depth_req` complete reads in every input, even after imputation.
+
+        Imputation can at best complete every read of a matrix, so the number of reads extracted is an upper bound on
+        the number of complete reads after imputation. Bins below the requirement in any input, and in two file mode bins
+        missing from the second input, are removed before any inference is spent on them. Counts of the skipped work
+        are accumulated in :attr:`pruning_stats`.
 
-                    full_matrix['class'] = labels
-
-                    filtered_matrix = super().filter_data_frame(full_matrix)
-                    if self.remove_noise:
-                        filtered_matrix = filtered_matrix[filtered_matrix['class'] != -1]
-                    
-                    # generate output lines
-                    chromosome, bin_loc = bin_.split("_")
-                    output_lines = super().generate_individual_matrix_data(filtered_matrix, chromosome, bin_loc)
-                    for line in output_lines:
-                        final_results_tf.write(line+"\n")
-
-        # CLUSTER ALL OTHER BINS LIKE NORMAL WITHOUT IMPUTATION
-        print("Performing clustering on the rest of the bins with no imputaiton...", flush=True)
-        unimputable_coverage = coverage_data[coverage_data['cpgs'] >= 6]
-
-        unimputable_temp = tempfile.NamedTemporaryFile(mode="w+t")
-        unimputable_file_name = unimputable_temp.name
-        logging.info("Temp file for unimputable bins is {}".format(unimputable_file_name))
-        logging.info("unimputable bins looks like this...")
-        logging.info(unimputable_coverage.head())
-
-        unimputable_coverage.to_csv(unimputable_file_name, header=False, index=False)
-
-
-        cluster_reads = ClusterReads(
-            bam_a=self.bam_a,
-            bam_b=self.bam_b,
-            bin_size=self.bin_size,
-            bins_file=unimputable_file_name,
-            output_directory=self.output_directory,
-            num_processors=self.num_processors,
-            cluster_member_min=self.cluster_member_min,
-            read_depth_req=self.read_depth_req,
-            remove_noise=self.remove_noise,
+        :param matrices: list with one :class:`clubcpg_prelim.RaggedMatrices` of extracted matrices per input file
+        :return: list of RaggedMatrices in the same order, holding only the bins that can pass the read depth
+            requirement, in the order of the first input
+        """
+        stats = self.pruning_stats
+        positions = [dict(zip(ragged.bins, range(len(ragged)))) for ragged in matrices]
+        read_counts = [ragged.read_counts() for ragged in matrices]
+
+        keep = []
+        for bin_ in matrices[0].bins:
+            stats['bins_considered'] += 1
+            if self.bam_b and bin_ not in positions[1]:
+                stats['bins_pruned_missing_pair'] += 1
+                continue
+            if any(counts[position[bin_]] < self.read_depth_req for counts, position in zip(read_counts, positions)):
+                stats['bins_pruned_depth'] += 1
+                continue
+            keep.append(bin_)
+
+        pruned = []
+        for ragged, position in zip(matrices, positions):
+            kept = np.array([position[bin_] for bin_ in keep], dtype=np.int64)
+            skipped = np.ones(len(ragged), dtype=bool)
+            skipped[kept] = False
+            unknowns = np.bincount(ragged.matrix_index(), weights=(ragged.data == -1).sum(axis=1),
+                                   minlength=len(ragged))
+            stats['matrices_skipped'] += int(skipped.sum())
+            stats['cells_skipped'] += int(unknowns[skipped].sum())
+            pruned.append(ragged.subset(kept))
+
+        return pruned
+
+    def _impute_chunk(self, imputers, extracted):
+        """
+        Pipeline stage: impute the extracted matrices of one chunk, per CpG density
+        """
+        j, n_chunks, routed, unimputable_results = extracted
+        print("Imputing chunk {}/{}...".format(j+1, n_chunks), flush=True)
+        imputed = []
+        for i in sorted(routed.keys()):
+            pruned = self.prune_unreachable_bins(routed[i])
+            if len(pruned[0]) == 0:
+                continue
+            # Consume the generators here so inference runs within this stage
+            imputed_dicts = [self.create_dictionary(ragged.bins, list(imputer.impute_from_model(models, ragged)))
+                             for imputer, models, ragged in zip(imputers[i], (self.models_A, self.models_B), pruned)]
+            imputed.append(imputed_dicts)
+
+        return imputed, unimputable_results
+
+    def _cluster_imputed_bin(self, bin_, data_imputed_A_dict, data_imputed_B_dict):
+        """
+        Cluster one bin from the imputed matrices, returns the output lines or None if the bin is skipped
+        """
+        matrix_A = data_imputed_A_dict[bin_]
+        matrix_A = pd.DataFrame(matrix_A)
+        matrix_A = matrix_A.dropna()
+        if matrix_A.shape[0] < self.read_depth_req:
+            return None
+        if self.bam_b:
+            try:
+                matrix_B = data_imputed_B_dict[bin_]
+            # matrix doesnt exist in other file
+            except KeyError:
+                logging.info("Covered bin {} doesnt exist in second file".format(bin_))
+                return None
+            matrix_B = pd.DataFrame(matrix_B)
+            matrix_B = matrix_B.dropna()
+            if matrix_B.shape[0] < self.read_depth_req:
+                return None
+        else:
+            matrix_B = None
+
+        chromosome, bin_loc = bin_.split("_")
+        return self.cluster_bin_matrices(chromosome, bin_loc, matrix_A, matrix_B)
+
+    def execute(self, return_only=False):
+        """
+        Impute and cluster all bins with 2-5 CpGs and cluster all remaining bins without imputation.
+
+        The coverage table is read once and split into chunks of :attr:`chunksize` bins of any CpG density. A single
+        :class:`clubcpg.DensityScheduler.DensityScheduler` process pool extracts every bin once, bins with 2-5 CpGs are
+        routed to the model for their density and all other bins are clustered directly inside the pool.
+        Chunks flow through a :class:`clubcpg.Pipeline.BoundedPipeline`, so extraction of chunk j+1 overlaps the
+        imputation and clustering of chunk j, and at most :attr:`pipeline_depth` chunks wait between two stages.
+
+        :param return_only: unused, results are always written to the output directory
+        :return: path of the output file
+        """
+
+        coverage_data = self.get_coverage_data()
+        # Bins with fewer CpGs than any model are neither imputed nor clustered
+        coverage_data = coverage_data[coverage_data['cpgs'] >= min(self.imputed_densities)]
+        if self.shard is not None:
+            costs = bin_cost(coverage_data['reads'].values)
+            coverage_data = coverage_data[assign_shards(costs, costs.sum(), self.shard[1]) == self.shard[0] - 1]
+
+        # Split into chunks for memory management
+        n = self.chunksize
+        chunks = [coverage_data[k * n:(k + 1) * n] for k in range((len(coverage_data) + n - 1) // n)]
+        n_chunks = len(chunks)
+        print("Divided into {} chunks for processing...".format(n_chunks), flush=True)
+
+        imputers = self._create_imputers()
+        # bins which are not imputed are clustered like normal by process_bins, within the same pool
+        scheduler = DensityScheduler([self.bam_a, self.bam_b],
+            densities=self.imputed_densities,
             mbias_read1_5=self.mbias_read1_5,
             mbias_read1_3=self.mbias_read1_3,
             mbias_read2_5=self.mbias_read2_5,
             mbias_read2_3=self.mbias_read2_3,
-            suffix=self.suffix,
-            no_overlap=self.no_overlap
+            processes=self.num_processors,
+            fallback=self.process_bins,
+            timeout=self.bin_timeout,
+            bin_size=self.bin_size
         )
 
-        # Write this output to the output temp file
-        results = cluster_reads.execute(return_only=True)
-        for result in results:
-            if result:
-                for line in result:
-                    final_results_tf.write(line + "\n")
-
-        # rewrite the tempfile to a final output file
-        final_results_tf.seek(0)
-        # output = 'output_dir/basename_suffix_cluster_results.csv'
-        output_file = os.path.join(self.output_directory, os.path.basename(self.bam_a) + self.suffix + "_cluster_results.csv")
-        with open(output_file, "w") as final:
-            for line in final_results_tf:
-                final.write(line)
-
-        unimputable_temp.close()
+        pipeline = BoundedPipeline([
+            ("extract", partial(self._extract_chunk, scheduler)),
+            ("impute", partial(self._impute_chunk, imputers)),
+        ], max_in_flight=self.pipeline_depth)
+
+        # output = 'output_dir/basename_suffix_cluster_results.csv', or the extension of output_format
+        output_prefix = os.path.join(self.output_directory,
+                                     os.path.basename(self.bam_a) + self.suffix + shard_tag(self.shard) + "_cluster_results")
+        with scheduler, ClusterTableWriter(output_prefix, self.output_format, self.input_labels) as final:
+
+            # Cluster imputed bins in this thread while the next chunks are extracted and imputed
+            for imputed, unimputable_results in pipeline.run((j, n_chunks, chunk) for j, chunk in enumerate(chunks)):
+                for data_imputed_dicts in imputed:
+                    data_imputed_A_dict = data_imputed_dicts[0]
+                    data_imputed_B_dict = data_imputed_dicts[1] if self.bam_b else None
+                    for bin_ in data_imputed_A_dict.keys():
+                        output_lines = self._cluster_imputed_bin(bin_, data_imputed_A_dict, data_imputed_B_dict)
+                        if not output_lines:
+                            continue
+                        final.write_lines(output_lines)
+
+                for bin_, output_lines in unimputable_results:
+                    if not output_lines:
+                        continue
+                    final.write_lines(output_lines)
+
+        stats = self.pruning_stats
+        summary = "Pruned {} of {} imputable bins before imputation ({} below read depth, {} missing from second input). " \
+                  "Skipped imputing {} matrices with {} unknown CpGs".format(
+                      stats['bins_pruned_depth'] + stats['bins_pruned_missing_pair'], stats['bins_considered'],
+                      stats['bins_pruned_depth'], stats['bins_pruned_missing_pair'], stats['matrices_skipped'],
+                      stats['cells_skipped'])
+        print(summary, flush=True)
+        logging.info(summary)
+
+        # Each model file was loaded once for all chunks and both input files
+        for summary in (default_registry().summary(), default_registry().cache_summary()):
+            print(summary, flush=True)
+            logging.info(summary)
+
+        return final.path
@@ -0,0 +1,299 @@
+import os
+import logging
+import zipfile
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+
+# pyarrow is optional, without it columnar output is written as chunked numpy arrays
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.ipc as ipc
+except ImportError:
+    pa = None
+
+HEADER = "bin,input_label,methylation,class_label,read_number,cpg_number,cpg_pattern,class_split"
+
+# Patterns of up to this many CpGs are packed into the integer cpg_pattern column
+MAX_PACKED_CPGS = 64
+
+# Typed columns of the columnar layout. reads_A and reads_B are the reads of the cluster from the first and second
+# input, the class_split column of the csv layout. Patterns of bins with more than MAX_PACKED_CPGS CpGs are kept as
+# strings in wide_pattern, with cpg_pattern 0, wide_pattern is empty for all other clusters
+COLUMNS = [
+    ("chromosome", object),
+    ("bin_end", np.int64),
+    ("input_label", object),
+    ("methylation", np.float32),
+    ("class_label", np.int16),
+    ("read_number", np.int32),
+    ("cpg_number", np.int16),
+    ("cpg_pattern", np.uint64),
+    ("wide_pattern", object),
+    ("reads_A", np.int32),
+    ("reads_B", np.int32),
+]
+
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather", "npz": ".npz"}
+
+
+def encode_pattern(pattern: str):
+    """
+    :param pattern: semicolon separated CpG pattern of the csv layout, ie "1;0;1"
+    :return: the pattern as an integer, bit k is set if CpG k is methylated
+    """
+    values = pattern.split(";")
+    if len(values) > MAX_PACKED_CPGS:
+        raise ValueError("Cannot pack a pattern of {} CpGs into {} bits".format(len(values), MAX_PACKED_CPGS))
+    value = 0
+    for k, x in enumerate(values):
+        if x == "1":
+            value |= 1 << k
+    return value
+
+
+def decode_pattern(pattern: int, cpg_number: int):
+    """
+    :param pattern: CpG pattern as returned by :func:`encode_pattern`
+    :param cpg_number: number of CpGs of the pattern
+    :return: semicolon separated CpG pattern of the csv layout, ie "1;0;1"
+    """
+    pattern = int(pattern)
+    return ";".join(str((pattern >> k) & 1) for k in range(int(cpg_number)))
+
+
+def _pattern_string(pattern, wide_pattern, cpg_number):
+    if int(cpg_number) > MAX_PACKED_CPGS:
+        return wide_pattern
+    return decode_pattern(pattern, cpg_number)
+
+
+def parse_line(line: str, input_labels=("A", "B")):
+    """
+    :param line: one line of clubcpg-cluster output
+    :param input_labels: labels of the first and second input, counts of other labels are rejected
+    :return: tuple of the values of :data:`COLUMNS`
+    """
+    bin_, input_label, methylation, class_label, read_number, cpg_number, cpg_pattern, class_split = \
+        line.rstrip("\n").split(",")
+    chromosome, bin_end = bin_.rsplit("_", 1)
+
+    reads = [0, 0]
+    for split in class_split.split(";"):
+        label, count = split.rsplit("=", 1)
+        try:
+            reads[input_labels.index(label)] = int(count)
+        except ValueError:
+            raise ValueError("Unknown input label {} in class_split {}".format(label, class_split))
+
+    cpg_number = int(cpg_number)
+    if cpg_number > MAX_PACKED_CPGS:
+        packed, wide_pattern = 0, cpg_pattern
+    else:
+        packed, wide_pattern = encode_pattern(cpg_pattern), ""
+
+    return (chromosome, int(bin_end), input_label, float(methylation), int(class_label), int(read_number),
+            cpg_number, packed, wide_pattern, reads[0], reads[1])
+
+
+class ClusterTableWriter:
+    """
+    Write clubcpg-cluster output lines as csv or as a columnar file with typed columns. Columnar files are written
+    incrementally, one row group of :attr:`row_group_size` clusters at a time, as Parquet or Feather if pyarrow is
+    installed. Otherwise, or with output_format "npz", every row group is stored as one numpy array per column in a
+    zip archive which :func:`numpy.load` can open.
+
+    :Example:
+    >>> from clubcpg.ClusterTable import ClusterTableWriter, read_cluster_table
+    >>> with ClusterTableWriter("/path/to/Clustering.file.bam_matrix_data", "parquet") as writer:
+    ...     writer.write_lines(lines)
+    >>> clusters = read_cluster_table(writer.path)
+
+    """
+
+    def __init__(self, path_prefix: str, output_format="csv", input_labels=("A", "B"), row_group_size=100000):
+        """
+        :param path_prefix: path of the output file without extension, the extension of the format is added
+        :param output_format: one of "csv", "parquet", "feather" or "npz"
+        :param input_labels: labels of the first and second input as used in class_split. In single-file mode this is
+            the name of the bam file
+        :param row_group_size: number of clusters held in memory before they are written
+        """
+        if output_format not in EXTENSIONS:
+            raise ValueError("Unknown output format {}, expected one of {}".format(
+                output_format, ", ".join(EXTENSIONS.keys())))
+        if output_format in ("parquet", "feather") and pa is None:
+            logging.warning("pyarrow is not installed, writing {} output as npz instead".format(output_format))
+            output_format = "npz"
+
+        self.output_format = output_format
+        self.input_labels = tuple(input_labels)
+        self.row_group_size = int(row_group_size)
+        self.path = path_prefix + EXTENSIONS[output_format]
+        self.rows = []
+        self.row_groups = 0
+        self.written = 0
+        self._writer = None
+
+        if output_format == "csv":
+            self._file = open(self.path, "w")
+            self._file.write(HEADER + "\n")
+        elif output_format == "npz":
+            self._file = zipfile.ZipFile(self.path, "w", allowZip64=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_line(self, line: str):
+        """
+        :param line: one line of clubcpg-cluster output, without the line break
+        """
+        if self.output_format == "csv":
+            self._file.write(line + "\n")
+            self.written += 1
+            return
+        self.rows.append(parse_line(line, self.input_labels))
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def write_lines(self, lines):
+        """
+        :param lines: iterable of clubcpg-cluster output lines, as returned by
+            :meth:`clubcpg.ClusterReads.ClusterReads.process_bins`
+        """
+        for line in lines:
+            self.write_line(line)
+
+    def write_frame(self, frame: pd.DataFrame):
+        """
+        :param frame: clusters with the columns of :data:`COLUMNS`, as returned by :func:`read_cluster_table`
+        """
+        if self.output_format == "csv":
+            for row in frame[[name for name, dtype in COLUMNS]].itertuples(index=False):
+                self.write_line(",".join([
+                    "{}_{}".format(row.chromosome, row.bin_end), row.input_label, str(np.float32(row.methylation)),
+                    str(row.class_label), str(row.read_number), str(row.cpg_number),
+                    _pattern_string(row.cpg_pattern, row.wide_pattern, row.cpg_number),
+                    self._class_split(row.reads_A, row.reads_B)]))
+            return
+        self.flush()
+        self._write_columns(frame)
+
+    def _class_split(self, reads_A, reads_B):
+        splits = ["{}={}".format(label, count) for label, count in zip(self.input_labels, (reads_A, reads_B)) if count]
+        return ";".join(splits)
+
+    def flush(self):
+        """
+        Write the buffered clusters as one row group
+        """
+        if not self.rows:
+            return
+        frame = pd.DataFrame.from_records(self.rows, columns=[name for name, dtype in COLUMNS])
+        self.rows = []
+        self._write_columns(frame)
+
+    def _write_columns(self, frame: pd.DataFrame):
+        if frame.empty:
+            return
+        frame = frame[[name for name, dtype in COLUMNS]].astype(dict(COLUMNS))
+
+        if self.output_format == "npz":
+            for name, dtype in COLUMNS:
+                values = frame[name].values
+                if dtype is object:
+                    values = values.astype(str)
+                with self._file.open("group{:06d}/{}.npy".format(self.row_groups, name), "w",
+                                     force_zip64=True) as f:
+                    np.lib.format.write_array(f, values, allow_pickle=False)
+        else:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._writer is None:
+                if self.output_format == "parquet":
+                    self._writer = pq.ParquetWriter(self.path, table.schema)
+                else:
+                    self._writer = ipc.new_file(self.path, table.schema)
+            self._writer.write_table(table)
+
+        self.row_groups += 1
+        self.written += len(frame)
+
+    def close(self):
+        """
+        Write the remaining clusters and close the file
+        """
+        if self.output_format != "csv":
+            self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        elif self.output_format in ("parquet", "feather") and self.row_groups == 0:
+            # No clusters, still write a file with the schema
+            self._write_empty()
+        if self.output_format in ("csv", "npz") and self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_empty(self):
+        frame = pd.DataFrame({name: pd.Series([], dtype=dtype) for name, dtype in COLUMNS})
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self.output_format == "parquet":
+            pq.write_table(table, self.path)
+        else:
+            with ipc.new_file(self.path, table.schema) as writer:
+                writer.write_table(table)
+
+
+def read_cluster_table(path: str, columns=None, decode_patterns=False):
+    """
+    Load a clubcpg-cluster output written by :class:`ClusterTableWriter` in any of the columnar formats
+
+    :param path: path to a .parquet, .feather or .npz file
+    :param columns: optional list of columns to load
+    :param decode_patterns: if True the cpg_pattern column holds the semicolon separated patterns of the csv layout,
+        including those of bins with more than :data:`MAX_PACKED_CPGS` CpGs
+    :return: pd.DataFrame with the columns of :data:`COLUMNS`
+    """
+    extension = os.path.splitext(path)[1]
+    if columns is not None and decode_patterns:
+        columns = list(columns) + [name for name in ("cpg_pattern", "wide_pattern", "cpg_number")
+                                   if name not in columns]
+
+    if extension == ".npz":
+        groups = defaultdict(dict)
+        with np.load(path, allow_pickle=False) as data:
+            for key in data.files:
+                group, name = key.split("/")
+                if columns is None or name in columns:
+                    groups[group][name] = data[key]
+        names = [name for name, dtype in COLUMNS if columns is None or name in columns]
+        frames = [pd.DataFrame(groups[group], columns=names) for group in sorted(groups)]
+        if frames:
+            frame = pd.concat(frames, ignore_index=True)
+        else:
+            frame = pd.DataFrame({name: pd.Series([], dtype=dtype) for name, dtype in COLUMNS if name in names})
+        for name, dtype in COLUMNS:
+            if dtype is object and name in frame:
+                frame[name] = frame[name].astype(object)
+    elif extension in (".parquet", ".feather"):
+        if pa is None:
+            raise ImportError("pyarrow is required to read {}".format(path))
+        if extension == ".parquet":
+            frame = pq.read_table(path, columns=columns).to_pandas()
+        else:
+            with pa.memory_map(path) as source:
+                table = ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select([name for name, dtype in COLUMNS if name in columns])
+            frame = table.to_pandas()
+    else:
+        raise ValueError("{} is not a parquet, feather or npz cluster table".format(path))
+
+    if decode_patterns:
+        frame["cpg_pattern"] = [_pattern_string(pattern, wide_pattern, n) for pattern, wide_pattern, n in
+                                zip(frame["cpg_pattern"], frame["wide_pattern"], frame["cpg_number"])]
+    return frame
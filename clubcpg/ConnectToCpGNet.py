@@ -1,6 +1,7 @@
-from clubcpg_prelim import PReLIM
+from clubcpg_prelim import PReLIM, CompactForest
 import os
-from joblib import dump
+from concurrent.futures import ThreadPoolExecutor
+from joblib import dump, parallel_backend
 
 
 class TrainWithPReLIM:
@@ -8,13 +9,14 @@ class TrainWithPReLIM:
     Used to train models using CpGnet
     """
 
-    def __init__(self, cpg_density=None, save_path=None):
+    def __init__(self, cpg_density=None, save_path=None, search="grid"):
         """
         Class to train a CpGNet model from input data
 
         :param cpg_density: Number of CpGs
         :type cpg_density: int
         :param save_path: Location of folder to save the resulting model files. One per cpg density
+        :param search: Hyperparameter search strategy of :meth:`clubcpg_prelim.PReLIM.fit`, "grid" or "halving"
         """
         if not cpg_density:
             raise AttributeError("CpG density must be specified")
@@ -22,6 +24,7 @@ class TrainWithPReLIM:
             raise AttributeError("Folder to save trained model must be specified")
         self.save_path = save_path
         self.cpg_density = cpg_density
+        self.search = search
         self.model = PReLIM(cpgDensity=cpg_density)
 
     def save_net(self, model):
@@ -39,16 +42,130 @@ class TrainWithPReLIM:
 
         return output
 
+    def save_compact(self, model):
+        """
+        Save the best forest of the model in the compact inference format, next to the saved model
 
-    def train_model(self, bins: iter):
+        :param model: The trained PReLIM model. Located at PReLIM.model
+        :return: Path to the saved compact model
+        """
+        file_name = "saved_model_{}_cpgs.compact".format(self.cpg_density)
+        output = os.path.join(self.save_path, file_name)
+        dump(CompactForest.from_estimator(model), output)
+        print("Saved {} cpg compact model to {}".format(self.cpg_density, output))
+
+        return output
+
+
+    def train_model(self, bins: iter, cores=-1, fit_params=None):
         """
         Train the CpGNet model on a list of provided bins
 
         :param bins: iterable containing CpG matrices of 1 (methylated), 0 (unmethylated), and -1 (unknown)
+        :param cores: number of CPUs used by the hyperparameter search
+        :param fit_params: optional dict of extra keyword arguments for :meth:`clubcpg_prelim.PReLIM.fit`
+        :return: Path to the saved model file
+        """
+        X, y = self.model.get_X_y(bins, model_file="no")
+
+        return self.train_from_features(X, y, cores, fit_params)
+
+    def train_from_features(self, X, y, cores=-1, fit_params=None):
+        """
+        Fit the model on already collected training features and save it
+
+        :param X: feature vectors, as returned by :meth:`clubcpg_prelim.PReLIM.get_X_y`
+        :param y: labels of the feature vectors
+        :param cores: number of CPUs used by the hyperparameter search
+        :param fit_params: optional dict of extra keyword arguments for :meth:`clubcpg_prelim.PReLIM.fit`
         :return: Path to the saved model file
         """
-        self.model.train(bins, model_file="no")
+        self.model.fit(X, y, cores=cores, model_file="no", search=self.search, **(fit_params or {}))
+        summary = self.model.search_summary
+        print("{} cpg model: {} search took {:.1f} s, chosen parameters: {}".format(
+            self.cpg_density, summary["search"], summary["wall_time"], summary["best_params"]), flush=True)
         output = self.save_net(self.model.model)
+        self.save_compact(self.model.model)
 
         return output
 
+
+class TrainAllDensities:
+    """
+    Train the models of several CpG densities concurrently under one CPU budget.
+
+    Training features of each density are collected in the calling thread. As soon as the features of a density are
+    ready its hyperparameter search starts in a separate thread, so feature collection of the next density overlaps the
+    searches already running. The budget is split between the searches. Each search uses joblib's threading
+    backend, the forests release the GIL while growing trees so the threads run in parallel, and the searches do not
+    compete for one shared process pool. Features found in the optional
+    :class:`clubcpg.TrainingSetCache.TrainingSetCache` are reused instead of collected again, new ones are added to it.
+
+    :Example:
+    >>> from clubcpg.ConnectToCpGNet import TrainAllDensities
+    >>> trainer = TrainAllDensities("/path/to/models", cores=16)
+    >>> model_files = trainer.train({2: matrices_2, 3: matrices_3, 4: matrices_4, 5: matrices_5})
+
+    """
+
+    def __init__(self, save_path=None, cores=-1, fit_params=None, search="grid", cache=None):
+        """
+        :param save_path: Location of folder to save the resulting model files. One per cpg density
+        :param cores: total number of CPUs shared by all searches, all available if -1
+        :param fit_params: optional dict of extra keyword arguments for :meth:`clubcpg_prelim.PReLIM.fit`
+        :param search: Hyperparameter search strategy of :meth:`clubcpg_prelim.PReLIM.fit`, "grid" or "halving"
+        :param cache: optional :class:`clubcpg.TrainingSetCache.TrainingSetCache` holding training features
+        """
+        if not save_path:
+            raise AttributeError("Folder to save trained model must be specified")
+        self.save_path = save_path
+        self.cores = cores if cores > 0 else os.cpu_count()
+        self.fit_params = fit_params
+        self.search = search
+        self.cache = cache
+
+    @staticmethod
+    def _search(trainer, X, y, cores, fit_params):
+        with parallel_backend("threading", n_jobs=cores):
+            return trainer.train_from_features(X, y, cores, fit_params)
+
+    def train(self, matrices: dict):
+        """
+        Train and save one model per CpG density
+
+        :param matrices: dict of cpg density -> iterable of CpG matrices or RaggedMatrices for that density
+        :return: dict of cpg density -> path to the saved model file
+        """
+        densities = [density for density in sorted(matrices.keys()) if len(matrices[density])]
+        if not densities:
+            return dict()
+
+        workers = min(len(densities), self.cores)
+        # Even split of the budget, cores left over go to the highest densities which have the most features
+        base, left_over = divmod(self.cores, workers)
+        cores_per_search = {density: max(1, base + (k >= len(densities) - left_over))
+                            for k, density in enumerate(densities)}
+
+        futures = dict()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for density in densities:
+                trainer = TrainWithPReLIM(cpg_density=density, save_path=self.save_path, search=self.search)
+                features = self.cache.load_features(density) if self.cache else None
+                if features:
+                    print("Using cached training features for cpg density: {}".format(density), flush=True)
+                    X, y = features
+                else:
+                    print("Collecting training features for cpg density: {}".format(density), flush=True)
+                    X, y = trainer.model.get_X_y(matrices[density], model_file="no")
+                    if self.cache:
+                        self.cache.save_features(density, X, y)
+                if len(X) == 0:
+                    print("No training features for cpg density: {}, no model is trained".format(density), flush=True)
+                    continue
+                print("Starting training cpg density: {} on {} cores".format(density, cores_per_search[density]),
+                      flush=True)
+                futures[density] = executor.submit(self._search, trainer, X, y, cores_per_search[density],
+                                                   self.fit_params)
+
+        return {density: future.result() for density, future in futures.items()}
+
@@ -0,0 +1,112 @@
+import sys
+import pandas as pd
+from clubcpg.IntervalIndex import IntervalIndex
+
+# Columns of clubcpg-coverage output. imputed_reads is only written when models are given to clubcpg-coverage
+COVERAGE_COLUMNS = ["bin", "reads", "cpgs", "imputed_reads"]
+
+
+def coverage_columns(coverage_file: str):
+    """
+    :param coverage_file: path to a clubcpg-coverage output file without a header
+    :return: names of its columns, the first three or all of :data:`COVERAGE_COLUMNS`
+    """
+    with open(coverage_file, "r") as f:
+        first_line = f.readline().strip()
+    if not first_line:
+        return COVERAGE_COLUMNS[:3]
+    n_columns = len(first_line.split(","))
+    if n_columns not in (3, 4):
+        raise ValueError("{} has {} columns, expected bin, reads, cpgs and optionally imputed_reads".format(
+            coverage_file, n_columns))
+    return COVERAGE_COLUMNS[:n_columns]
+
+
+def read_coverage(coverage_file: str, chunksize=None):
+    """
+    Load a clubcpg-coverage output file, with or without the imputed_reads column
+
+    :param coverage_file: path to a clubcpg-coverage output file without a header
+    :param chunksize: if given, an iterator over DataFrames of at most chunksize rows is returned
+    :return: DataFrame, or iterator of DataFrames, with the columns returned by :func:`coverage_columns`
+    """
+    return pd.read_csv(coverage_file, header=None, names=coverage_columns(coverage_file), chunksize=chunksize)
+
+
+def iter_coverage(coverage_files, min_reads=None, min_cpgs=None, chromosomes=None, regions=None, bin_size=100,
+                  use_imputed=False):
+    """
+    Stream the lines of one or more clubcpg-coverage files, keeping only bins which pass all filters. Files are read
+    one line at a time in the given order, so per chromosome files are merged by passing all of them.
+
+    :param coverage_files: path or list of paths to clubcpg-coverage output files
+    :param min_reads: minimum number of complete reads, second column. Not checked if None
+    :param min_cpgs: minimum number of CpGs, third column. Not checked if None
+    :param chromosomes: optional collection of chromosomes to keep, ie {"chr1", "chr2"}
+    :param regions: optional :class:`clubcpg.IntervalIndex.IntervalIndex` of BED regions, bins must overlap one
+    :param bin_size: size of the bins in bp, used to overlap bins with regions
+    :param use_imputed: if True min_reads is checked against the imputed_reads column, fourth column, written by
+        clubcpg-coverage when models are given
+    :return: generator of tuples of (bin, stripped line) for every bin passing the filters
+    """
+    if isinstance(coverage_files, str):
+        coverage_files = [coverage_files]
+    if chromosomes is not None:
+        chromosomes = set(chromosomes)
+    reads_column = 3 if use_imputed else 1
+
+    for coverage_file in coverage_files:
+        with open(coverage_file, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                fields = line.split(",")
+                bin_ = fields[0]
+                if use_imputed and len(fields) < 4:
+                    raise ValueError("{} has no imputed_reads column, run clubcpg-coverage with models".format(
+                        coverage_file))
+                if min_reads is not None and int(fields[reads_column]) < min_reads:
+                    continue
+                if min_cpgs is not None and int(fields[2]) < min_cpgs:
+                    continue
+                if chromosomes is not None or regions is not None:
+                    chromosome, bin_loc = bin_.rsplit("_", 1)
+                    if chromosomes is not None and chromosome not in chromosomes:
+                        continue
+                    if regions is not None and not regions.bin_overlaps(chromosome, int(bin_loc), bin_size):
+                        continue
+                yield bin_, line
+
+
+def filter_coverage(coverage_files, output_file=None, min_reads=None, min_cpgs=None, chromosomes=None,
+                    bed_file=None, bin_size=100, padding=0, use_imputed=False):
+    """
+    Write the bins of one or more clubcpg-coverage files which pass all filters into one file, in the layout of the
+    input. This replaces filtering the coverage output with awk before clustering.
+
+    :Example:
+    >>> from clubcpg.CoverageFilter import filter_coverage
+    >>> filter_coverage(["CompleteBins.file.bam.chr1.csv", "CompleteBins.file.bam.chr2.csv"],
+    ...                 "CompleteBins.file.bam.filtered.csv", min_reads=10, min_cpgs=2)
+
+    :param coverage_files: path or list of paths to clubcpg-coverage output files
+    :param output_file: path of the filtered file, standard output if None
+    :param bed_file: optional BED file, only bins overlapping its regions are kept
+    :param padding: number of bp added on both sides of every BED region
+    :param use_imputed: if True min_reads is checked against the imputed_reads column instead of the reads column
+    :return: number of bins written
+    """
+    regions = IntervalIndex.from_bed(bed_file, padding) if bed_file else None
+    out = open(output_file, "w") if output_file else sys.stdout
+    written = 0
+    try:
+        for bin_, line in iter_coverage(coverage_files, min_reads, min_cpgs, chromosomes, regions, bin_size,
+                                          use_imputed):
+            out.write(line + "\n")
+            written += 1
+    finally:
+        if output_file:
+            out.close()
+
+    return written
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+from sklearn.utils import check_random_state
+from clubcpg.CoverageFilter import read_coverage
+
+
+class CoverageSampler:
+    """
+    Draws training bins from a clubcpg-coverage output file in one streaming pass. The file is read in chunks and only
+    a bounded reservoir of bins is kept, so memory does not depend on the size of the file. Every bin is sampled at
+    most once.
+
+    Sampling is done per CpG density, optionally stratified by chromosome and read depth. Each row gets a uniform random
+    key and every stratum keeps the rows with the smallest keys, which is a uniform sample without replacement of that
+    stratum. With stratification the sample limit of a density is split between its strata in proportion to their
+    size.
+
+    :Example:
+    >>> from clubcpg.CoverageSampler import CoverageSampler
+    >>> sampler = CoverageSampler(densities=range(2, 6), sample_limit=10000, stratify_chromosome=True)
+    >>> bins = sampler.sample("/path/to/CompleteBins.csv")
+
+    """
+
+    def __init__(self, densities=range(2, 6), sample_limit=10000, stratify_chromosome=False, depth_strata=None,
+                 chunksize=1000000, random_state=None):
+        """
+        :param densities: CpG densities to sample bins of
+        :param sample_limit: maximum number of bins per density
+        :param stratify_chromosome: sample every chromosome in proportion to its number of bins
+        :param depth_strata: optional increasing list of read depths, bins are stratified by the interval their read
+            depth falls into
+        :param chunksize: number of coverage rows read at once
+        :param random_state: None, int or np.random.RandomState. None uses the global numpy random state
+        """
+        self.densities = sorted(densities)
+        self.sample_limit = int(sample_limit)
+        self.stratify_chromosome = stratify_chromosome
+        self.depth_strata = sorted(depth_strata) if depth_strata else None
+        self.chunksize = int(chunksize)
+        self.random_state = random_state
+
+    def describe(self):
+        """
+        :return: dict of the settings which decide which bins of a density are sampled
+        """
+        return {"sample_limit": self.sample_limit, "stratify_chromosome": self.stratify_chromosome,
+                "depth_strata": self.depth_strata}
+
+    def _strata(self, chunk):
+        strata = ['cpgs']
+        if self.stratify_chromosome:
+            chunk['chromosome'] = chunk['bin'].str.rsplit("_", n=1).str[0]
+            strata.append('chromosome')
+        if self.depth_strata:
+            chunk['depth_stratum'] = np.digitize(chunk['reads'].values, self.depth_strata)
+            strata.append('depth_stratum')
+        return strata
+
+    def sample(self, coverage_file: str):
+        """
+        :param coverage_file: path to a clubcpg-coverage output file, columns bin, reads, cpgs and optionally
+            imputed_reads without a header
+        :return: DataFrame with the columns bin, reads and cpgs holding at most sample_limit distinct bins per density
+        """
+        random_state = check_random_state(self.random_state)
+        reservoir = None
+        stratum_sizes = None
+
+        for chunk in read_coverage(coverage_file, chunksize=self.chunksize):
+            chunk = chunk[chunk['cpgs'].isin(self.densities)].copy()
+            if chunk.empty:
+                continue
+            strata = self._strata(chunk)
+            chunk['key'] = random_state.random_sample(len(chunk))
+
+            sizes = chunk.groupby(strata).size()
+            stratum_sizes = sizes if stratum_sizes is None else stratum_sizes.add(sizes, fill_value=0)
+
+            # Keep the sample_limit smallest keys of every stratum
+            candidates = chunk if reservoir is None else pd.concat([reservoir, chunk], ignore_index=True)
+            reservoir = candidates.sort_values('key').groupby(strata, sort=False).head(self.sample_limit)
+
+        if reservoir is None:
+            return pd.DataFrame({'bin': [], 'reads': [], 'cpgs': []})
+
+        if len(strata) > 1:
+            reservoir = self._allocate(reservoir, stratum_sizes, strata)
+
+        return reservoir.sort_values(['cpgs', 'key'])[['bin', 'reads', 'cpgs']].reset_index(drop=True)
+
+    def _allocate(self, reservoir, stratum_sizes, strata):
+        """
+        Split the sample limit of every density between its strata in proportion to their sizes, by largest remainder
+        """
+        quotas = []
+        for density, sizes in stratum_sizes.groupby(level=0):
+            share = sizes / sizes.sum() * min(self.sample_limit, sizes.sum())
+            quota = np.floor(share)
+            left_over = int(round(share.sum() - quota.sum()))
+            quota[(share - quota).sort_values(ascending=False).index[:left_over]] += 1
+            quotas.append(quota)
+
+        quotas = pd.concat(quotas).rename('quota').reset_index()
+        reservoir = reservoir.sort_values('key')
+        reservoir['rank'] = reservoir.groupby(strata, sort=False).cumcount()
+        reservoir = reservoir.merge(quotas, on=strata)
+        return reservoir[reservoir['rank'] < reservoir['quota']]
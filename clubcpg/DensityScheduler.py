@@ -0,0 +1,171 @@
+import logging
+import numpy as np
+import pandas as pd
+from pebble import ProcessPool
+from clubcpg.Imputation import Imputation
+from clubcpg.Pipeline import map_in_batches
+from clubcpg_prelim.RaggedMatrices import RaggedMatrices
+
+
+class DensityScheduler:
+    """
+    Reads a coverage table once, extracts every bin once from each input BAM file in a single process pool and routes
+    the resulting matrices by CpG density into one :class:`clubcpg_prelim.RaggedMatrices` per density and BAM file.
+    Bins whose density is not routed can be handed to a fallback function which
+    runs inside the same pool, for example :meth:`clubcpg.ClusterReads.ClusterReads.process_bins`.
+
+    :Example:
+    >>> from clubcpg.DensityScheduler import DensityScheduler
+    >>> scheduler = DensityScheduler(["/path/to/file.bam"], densities=range(2, 6), processes=8)
+    >>> with scheduler:
+    ...     routed, other = scheduler.extract(coverage_data)
+    >>> matrices = routed[4][0]
+    >>> bins = matrices.bins
+
+    """
+
+    def __init__(self, bam_files: list, densities=range(2, 6), mbias_read1_5=None, mbias_read1_3=None,
+                 mbias_read2_5=None, mbias_read2_3=None, processes=-1, fallback=None, timeout=5, batch_size=64,
+                 bin_size=100):
+        """
+        :param bam_files: list of paths to bam files, every bin is extracted from each of them
+        :param densities: CpG densities whose matrices are extracted and routed
+        :param processes: number of CPUs to use for the process pool
+        :param fallback: optional picklable callable taking a bin id. Used in the pool for bins with any other density
+        :param timeout: seconds before one bin is abandoned
+        :param batch_size: number of bins submitted to the pool as one task
+        :param bin_size: size of the bins in bp
+        """
+        self.bam_files = [x for x in bam_files if x]
+        self.densities = set(densities)
+        self.processes = processes
+        self.fallback = fallback
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.extractors = [Imputation(None, bam_file, mbias_read1_5, mbias_read1_3, mbias_read2_5, mbias_read2_3,
+                                      processes, bin_size=bin_size) for bam_file in self.bam_files]
+        self.pool = None
+
+    def __getstate__(self):
+        # The pool stays in the parent process, workers only need the extraction settings
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Start the process pool shared by every call to :meth:`extract`
+        """
+        if self.pool is None:
+            self.pool = ProcessPool(max_workers=self.processes if self.processes > 0 else None)
+
+    def close(self):
+        """
+        Stop the process pool
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def sample(self, coverage_data_frame: pd.DataFrame, sample_limit: int = None):
+        """
+        Downsample the bins of every routed density to at most sample_limit bins, other densities are dropped
+
+        :param coverage_data_frame: Output of clubcpg-coverage read in as a csv file
+        :param sample_limit: maximum number of bins to keep per density
+        :return: subset of the coverage data frame
+        """
+        subsets = []
+        for density in sorted(self.densities):
+            subset = coverage_data_frame[coverage_data_frame['cpgs'] == density]
+            bins_of_interest = subset['bin'].unique()
+            if sample_limit and len(bins_of_interest) > sample_limit:
+                bins_of_interest = np.random.choice(bins_of_interest, size=sample_limit, replace=False)
+            subsets.append(pd.DataFrame({'bin': bins_of_interest, 'cpgs': density}))
+
+        return pd.concat(subsets, ignore_index=True)
+
+    def _extract_bin(self, item):
+        """Function to be used for multiprocessing
+
+        :param item: tuple of (bin, cpg density)
+        :return: tuple of (bin, density, list with one matrix per bam file) or (bin, density, fallback result)
+        """
+        one_bin, density = item
+        if density in self.densities:
+            return one_bin, density, [extractor._multiprocess_extract(one_bin)[1] for extractor in self.extractors]
+
+        return one_bin, density, self.fallback(one_bin)
+
+    def extract(self, coverage_data_frame: pd.DataFrame):
+        """
+        Extract all bins of the coverage data frame in one pass over the process pool
+
+        :param coverage_data_frame: coverage data with at least the columns 'bin' and 'cpgs'
+        :return: tuple of (routed, other). routed maps each density to a list with one RaggedMatrices per bam file,
+            its bins attribute holds the bin of every matrix. other is a list of (bin, fallback result) for all
+            remaining bins
+        """
+        # Bins and matrices of every density and bam file, packed into one buffer each once all bins are extracted
+        extracted = {density: [([], []) for _ in self.extractors] for density in self.densities}
+        other = []
+
+        if self.fallback:
+            items = list(zip(coverage_data_frame['bin'], coverage_data_frame['cpgs']))
+        else:
+            subset = coverage_data_frame[coverage_data_frame['cpgs'].isin(self.densities)]
+            items = list(zip(subset['bin'], subset['cpgs']))
+
+        if not items:
+            return self._pack(extracted), other
+
+        # Use a temporary pool if this scheduler was not opened as a context manager
+        temporary_pool = self.pool is None
+        if temporary_pool:
+            self.open()
+
+        try:
+            results = map_in_batches(self.pool, self._extract_bin, items, batch_size=self.batch_size,
+                                     timeout=self.timeout)
+
+            for result in results:
+                if result is None:
+                    continue
+                one_bin, density, result = result
+
+                if density not in self.densities:
+                    other.append((one_bin, result))
+                    continue
+
+                # Remove any potential bad data
+                for k, matrix in enumerate(result):
+                    try:
+                        if matrix.shape[1] == density:
+                            extracted[density][k][0].append(one_bin)
+                            extracted[density][k][1].append(matrix)
+                    except IndexError as e:
+                        logging.info("Index error at bin {}".format(one_bin))
+                        logging.error(str(e))
+        finally:
+            if temporary_pool:
+                self.close()
+
+        return self._pack(extracted), other
+
+    @staticmethod
+    def _pack(extracted):
+        """
+        :param extracted: dict of density -> list with one tuple of (bins, matrices) per bam file
+        :return: dict of density -> list with one RaggedMatrices per bam file
+        """
+        return {density: [RaggedMatrices.from_matrices(matrices, bins, cpg_density=density)
+                          for bins, matrices in per_file]
+                for density, per_file in extracted.items()}
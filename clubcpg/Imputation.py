@@ -5,8 +5,12 @@ import os
 from clubcpg.ConnectToCpGNet import TrainWithPReLIM
 from clubcpg.ParseBam import BamFileReadParser
 from clubcpg_prelim import PReLIM
+from clubcpg_prelim.RaggedMatrices import RaggedMatrices
 from pebble import ProcessPool
-from joblib import load
+from clubcpg.Pipeline import map_in_batches
+from clubcpg.ModelRegistry import default_registry
+from clubcpg.Sharding import assign_shards, bin_cost
+from clubcpg.CoverageFilter import read_coverage
 
 
 class Imputation:
@@ -14,7 +18,8 @@ class Imputation:
     """
 
     def __init__(self, cpg_density: int, bam_file: str, mbias_read1_5=None, 
-        mbias_read1_3=None, mbias_read2_5= None, mbias_read2_3=None, processes=-1):
+        mbias_read1_3=None, mbias_read2_5= None, mbias_read2_3=None, processes=-1,
+        persistent_pool=False, batch_size=64, timeout=5, bin_size=100, low_threshold=0.2, high_threshold=0.8):
         """[summary]
         
         Arguments:
@@ -27,6 +32,12 @@ class Imputation:
             mbias_read2_5 {[type]} -- [description] (default: {None})
             mbias_read2_3 {[type]} -- [description] (default: {None})
             processes {int} -- number or CPUs to use when parallelization can be utilized, default= All available (default: {-1})
+            persistent_pool {bool} -- Keep one process pool alive across calls to extract_matrices until close() is called (default: {False})
+            batch_size {int} -- Number of bins submitted to the process pool as one task (default: {64})
+            timeout {int} -- Seconds allowed per bin before its extraction is abandoned (default: {5})
+            bin_size {int} -- Size of the bins in bp, bin ids give the end coordinate of each bin (default: {100})
+            low_threshold {float} -- Imputed values at or below this are called unmethylated when postprocessing (default: {0.2})
+            high_threshold {float} -- Imputed values at or above this are called methylated when postprocessing (default: {0.8})
         """
 
         self.cpg_density = cpg_density
@@ -36,6 +47,41 @@ class Imputation:
         self.mbias_read2_5 = mbias_read2_5
         self.mbias_read2_3 = mbias_read2_3
         self.processes = processes
+        self.persistent_pool = persistent_pool
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.bin_size = int(bin_size)
+        if not low_threshold < high_threshold:
+            raise ValueError("low_threshold ({}) must be smaller than high_threshold ({})".format(low_threshold, high_threshold))
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.pool = None
+
+    def __getstate__(self):
+        # The pool stays in the parent process, workers only need the extraction settings
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def __enter__(self):
+        self.persistent_pool = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPool(max_workers=self.processes if self.processes > 0 else None)
+        return self.pool
+
+    def close(self):
+        """Stop the process pool kept alive in persistent_pool mode
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def extract_matrices(self, coverage_data_frame: pd.DataFrame, sample_limit: int = None, return_bins=False):
         """Extract CpG matrices from bam file.
@@ -47,7 +93,8 @@ class Imputation:
             return_bins {bool} -- Return the bin location along with the matrix (default: {False})
         
         Returns:
-            [tuple] -- Returns tuple of (bin, np.array) if returns_bins = True else returns only np.array
+            [tuple] -- Returns tuple of (bins, RaggedMatrices) if returns_bins = True else returns only the
+            :class:`clubcpg_prelim.RaggedMatrices.RaggedMatrices` holding all int8 matrices in one buffer
         """
 
         subset = coverage_data_frame[coverage_data_frame['cpgs'] == self.cpg_density]
@@ -55,35 +102,26 @@ class Imputation:
 
         # Downsample the training bins if requested and necessary
         if sample_limit and len(bins_of_interest) > sample_limit:
-            bins_of_interest = np.random.choice(bins_of_interest, size=sample_limit)
-
-        # Use the pebbel ProcessPool because it can handle hanging processes with a timeout
-        complete_results = []
-        with ProcessPool(max_workers=self.processes) as pool:
-            future = pool.map(self._multiprocess_extract, bins_of_interest, timeout=5)
-
-            iterator = future.result()
-
-            while True:
-                try:
-                    result = next(iterator)
-                    complete_results.append(result)
-                except StopIteration:
-                    break
-                except TimeoutError as error:
-                    print("Timeout caught - {}".format(error.args[1]))
-                except Exception as error:
-                    print("Unknown exception = {}".format(error))
-
-        bins, matrices = zip(*complete_results)
+            bins_of_interest = np.random.choice(bins_of_interest, size=sample_limit, replace=False)
 
-        # destroy the pool
-        pool.close()
+        # Use the pebbel ProcessPool because it can handle hanging processes with a timeout.
+        # Bins are submitted in batches and each result lands at the index of its bin
+        pool = self._get_pool()
+        try:
+            complete_results = map_in_batches(pool, self._multiprocess_extract, bins_of_interest,
+                                              batch_size=self.batch_size, timeout=self.timeout)
+        finally:
+            # destroy the pool unless it should be reused by the next call
+            if not self.persistent_pool:
+                self.close()
 
         # Remove any potential bad data
         clean_matrices = []
         clean_bins = []
-        for matrix, bin_ in zip(matrices, bins):
+        for result in complete_results:
+            if result is None:
+                continue
+            bin_, matrix = result
             try:
                 if matrix.shape[1] == self.cpg_density:
                     clean_matrices.append(matrix)
@@ -93,10 +131,7 @@ class Imputation:
                 logging.error(str(e))
                 continue
 
-        # if len(clean_matrices) > 0:
-        #     clean_matrices = np.array(clean_matrices)
-
-        clean_matrices = np.array(clean_matrices)
+        clean_matrices = RaggedMatrices.from_matrices(clean_matrices, clean_bins, cpg_density=self.cpg_density)
 
         if return_bins:
             return clean_bins, clean_matrices
@@ -117,7 +152,7 @@ class Imputation:
             read_parser = BamFileReadParser(self.bam_file, 20, read1_5=self.mbias_read1_5, read1_3=self.mbias_read1_3, read2_5=self.mbias_read2_5, read2_3=self.mbias_read2_3)
             chrom, loc = one_bin.split("_")
             loc = int(loc)
-            reads = read_parser.parse_reads(chrom, loc-100, loc) # TODO unhardcode bin size
+            reads = read_parser.parse_reads(chrom, loc-self.bin_size, loc)
             matrix = read_parser.create_matrix(reads)
             matrix = matrix.dropna(how="all")
             # if matrix.shape[0] == 0:
@@ -136,7 +171,7 @@ class Imputation:
         
         Arguments:
             output_folder {str} -- Folder to save trained models
-            matrices {iter} -- An iterable of CpGMatrices - ideally obtained through Imputation.extract_matrices()
+            matrices {iter} -- An iterable of CpGMatrices or a RaggedMatrices - ideally obtained through Imputation.extract_matrices()
         
         Returns:
             [keras model] -- Returns the trained CpGNet model
@@ -148,64 +183,201 @@ class Imputation:
         return model
 
     @staticmethod
-    def postprocess_predictions(predicted_matrix):
+    def postprocess_predictions(predicted_matrix, low_threshold=0.2, high_threshold=0.8):
         """Takes array with predicted values and rounds them to 0 or 1 if threshold is exceeded
         
         Arguments:
-            predicted_matrix {[type]} -- matrix generated by imputation
+            predicted_matrix {[type]} -- matrix generated by imputation, or several of them concatenated
+        
+        Keyword Arguments:
+            low_threshold {float} -- values at or below are set to 0 (default: {0.2})
+            high_threshold {float} -- values at or above are set to 1 (default: {0.8})
         
         Returns:
             [type] -- predicted matrix predictions as 1, 0, or NaN
         """
+        predicted_matrix = np.asarray(predicted_matrix, dtype=float)
+
+        # Observed 1s and 0s are kept, imputed values are called in one pass over the whole array
+        return np.select(
+            [(predicted_matrix == 1) | (predicted_matrix == 0),
+             predicted_matrix <= low_threshold,
+             predicted_matrix >= high_threshold],
+            [predicted_matrix, 0.0, 1.0],
+            default=np.nan)
+
+    def _impute_batch(self, trained_model, batch, postprocess):
+        """Impute one batch of matrices with a single model prediction, results are in the order of the batch
+        """
+        # only impute matrices with an unknown, passback a copy of the others to keep list in order
+        results = [m.copy() for m in batch]
+        to_impute = [k for k, m in enumerate(batch) if -1 in m]
+        if not to_impute:
+            return results
 
-        processed_array = []
-        for array in predicted_matrix:
-            new_array = []
-            for item in array:
-                if item != 1 and item != 0:
-                    if item <= 0.2: #TODO un-hardcode this
-                        new_array.append(0.0)
-                    elif item >= 0.8: #TODO un-hardcode this
-                        new_array.append(1.0)
-                    else:
-                        new_array.append(np.nan)
-                else:
-                    new_array.append(item)
-
-            processed_array.append(new_array)
-
-        return np.array(processed_array)
-
+        ragged = RaggedMatrices.from_matrices([batch[k] for k in to_impute], dtype=float)
+        predicted = trained_model.impute_ragged(ragged.data, ragged.offsets, inplace=True)
+        if postprocess:
+            predicted = self.postprocess_predictions(predicted, self.low_threshold, self.high_threshold)
 
+        for k, pm in zip(to_impute, ragged.with_data(predicted)):
+            results[k] = pm
 
+        return results
 
-    def impute_from_model(self, models_folder: str, matrices: iter, postprocess=True):
+    def impute_from_model(self, models_folder: str, matrices: iter, postprocess=True, batch_size=1000, registry=None):
         """Generator to provide imputed matrices on-the-fly
         
         Arguments:
             models_folder {str} -- Path to directory containing trained CpGNet models
-            matrices {iter} -- An iterable containging n x m matrices with n=cpgs and m=reads
+            matrices {iter} -- An iterable containging n x m matrices with n=cpgs and m=reads, or a RaggedMatrices
         
         Keyword Arguments:
             postprocess {bool} -- Round imputed values to 1s and 0s  (default: {True})
+            batch_size {int} -- Number of matrices whose features are predicted together in one model call (default: {1000})
+            registry {ModelRegistry} -- Registry caching loaded models, the one shared by this process if None (default: {None})
         """
+        if registry is None:
+            registry = default_registry()
+        trained_model = registry.get(models_folder, self.cpg_density)
 
-        model_path = os.path.join(models_folder, "saved_model_{}_cpgs.prelim".format(self.cpg_density))
+        batch = []
+        for m in matrices:
+            batch.append(m)
+            if len(batch) >= batch_size:
+                yield from self._impute_batch(trained_model, batch, postprocess)
+                batch = []
 
-        trained_model = PReLIM(cpgDensity=self.cpg_density)
-        print("Successfully loaded model: {}".format(model_path), flush=True)
-        trained_model.model = load(model_path)
+        if batch:
+            yield from self._impute_batch(trained_model, batch, postprocess)
 
-        for m in matrices:
-            # only impute if there is an unknown
-            if -1 in m:
-                m = m.astype(float)
-                pm = trained_model.impute(m)
-                if postprocess:
-                    pm = self.postprocess_predictions(pm)
-            # Nothing to impute, passback original matrix to keep list in order
-            else:
-                pm = m.copy()
-                
-            # K.clear_session()
-            yield pm   
+    def imputed_read_counts(self, models_folder: str, matrices: RaggedMatrices, postprocess=True, batch_size=1000,
+                            registry=None):
+        """Number of complete reads of every matrix after imputation, without building the imputed matrices one by one
+        
+        Arguments:
+            models_folder {str} -- Path to directory containing trained models
+            matrices {RaggedMatrices} -- matrices of one CpG density with unknowns as -1, as returned by extract_matrices()
+        
+        Keyword Arguments:
+            postprocess {bool} -- Round imputed values to 1s and 0s, reads with a value left in between are incomplete (default: {True})
+            batch_size {int} -- Number of matrices imputed together in one model call (default: {1000})
+            registry {ModelRegistry} -- Registry caching loaded models, the one shared by this process if None (default: {None})
+        
+        Returns:
+            [np.array] -- integer array with the number of reads without any unknown value left, one per matrix
+        """
+        counts = np.zeros(len(matrices), dtype=np.int64)
+        if len(matrices) == 0:
+            return counts
+        if registry is None:
+            registry = default_registry()
+        trained_model = registry.get(models_folder, matrices.cpg_density)
+
+        for start in range(0, len(matrices), batch_size):
+            stop = min(start + batch_size, len(matrices))
+            # The matrices of a batch are one contiguous slice of the buffer
+            offsets = matrices.offsets[start:stop + 1] - matrices.offsets[start]
+            data = np.array(matrices.data[matrices.offsets[start]:matrices.offsets[stop]], dtype=float)
+
+            predicted = trained_model.impute_ragged(data, offsets, inplace=True)
+            if postprocess:
+                predicted = self.postprocess_predictions(predicted, self.low_threshold, self.high_threshold)
+
+            # Complete reads per matrix from a running total over the rows of the batch
+            complete = np.zeros(len(predicted) + 1, dtype=np.int64)
+            np.cumsum(~np.isnan(predicted).any(axis=1), out=complete[1:])
+            counts[start:stop] = complete[offsets[1:]] - complete[offsets[:-1]]
+
+        return counts
+
+    def _impute_coverage_block(self, block: pd.DataFrame, models_folder: str, densities, registry):
+        """Replace the read counts of one block of coverage rows by their imputed read counts, in place
+        """
+        routed = block['cpgs'].isin(densities).values
+        if not routed.any():
+            return
+
+        results = map_in_batches(self._get_pool(), self._multiprocess_extract, block['bin'].values[routed],
+                                 batch_size=self.batch_size, timeout=self.timeout)
+
+        # Integer row of every bin in the block, extraction results are merged back by position
+        rows = np.flatnonzero(routed)
+        by_density = {density: ([], []) for density in densities}
+        for row, result in zip(rows, results):
+            if result is None:
+                continue
+            bin_, matrix = result
+            density = block['cpgs'].values[row]
+            try:
+                if matrix.shape[1] == density:
+                    by_density[density][0].append(row)
+                    by_density[density][1].append(matrix)
+            except IndexError as e:
+                logging.info("Index error at bin {}".format(bin_))
+                logging.error(str(e))
+
+        reads = block['reads'].values.copy()
+        for density, (density_rows, matrices) in by_density.items():
+            if not density_rows:
+                continue
+            matrices = RaggedMatrices.from_matrices(matrices, cpg_density=density)
+            reads[density_rows] = self.imputed_read_counts(models_folder, matrices, registry=registry)
+        block['reads'] = reads
+
+    def impute_coverage(self, coverage_file: str, models_folder: str, output_file: str, densities=range(2, 6),
+                        chromosome: str = None, chunksize=100000, registry=None, shard=None):
+        """Write a copy of a clubcpg-coverage file whose read counts are the number of complete reads after imputation.
+        The coverage file is streamed in chunks and each chromosome within a chunk is extracted, imputed and written
+        before the next one is read, so memory does not grow with the size of the genome. Bins of other densities and
+        bins whose extraction failed keep their original counts
+        
+        Arguments:
+            coverage_file {str} -- output of clubcpg-coverage, columns bin, reads, cpgs and optionally imputed_reads without a header
+            models_folder {str} -- Path to directory containing trained models
+            output_file {str} -- csv file to write with the columns bin, reads, cpgs, an imputed_reads column of the input is not copied
+        
+        Keyword Arguments:
+            densities {iter} -- CpG densities to impute, a model for each must be in models_folder (default: {range(2, 6)})
+            chromosome {str} -- Only keep bins of this chromosome, example 'chr7' (default: {None})
+            chunksize {int} -- Number of coverage rows read at once (default: {100000})
+            registry {ModelRegistry} -- Registry caching loaded models, the one shared by this process if None (default: {None})
+            shard {tuple} -- (i, N) to impute only the i-th of N shards of the bins, balanced by read count (default: {None})
+        """
+        densities = list(densities)
+
+        def read_chunks():
+            for chunk in read_coverage(coverage_file, chunksize=chunksize):
+                chromosomes = chunk['bin'].str.rsplit("_", n=1).str[0].values
+                if chromosome:
+                    chunk = chunk[chromosomes == chromosome]
+                    chromosomes = chromosomes[chromosomes == chromosome]
+                yield chunk, chromosomes
+
+        # A first pass sums the cost of all bins, so every shard can place its bins without seeing the others
+        if shard is not None:
+            total_cost = sum(float(bin_cost(chunk['reads'].values).sum()) for chunk, chromosomes in read_chunks())
+        cost_before = 0.0
+
+        try:
+            with open(output_file, "w") as out:
+                for chunk, chromosomes in read_chunks():
+                    if shard is not None and not chunk.empty:
+                        costs = bin_cost(chunk['reads'].values)
+                        in_shard = assign_shards(costs, total_cost, shard[1], cost_before) == shard[0] - 1
+                        cost_before += float(costs.sum())
+                        chunk = chunk[in_shard]
+                        chromosomes = chromosomes[in_shard]
+                    if chunk.empty:
+                        continue
+
+                    # Consecutive rows of the same chromosome form one block
+                    breaks = np.flatnonzero(chromosomes[1:] != chromosomes[:-1]) + 1
+                    for start, stop in zip(np.r_[0, breaks], np.r_[breaks, len(chunk)]):
+                        block = chunk.iloc[start:stop].copy()
+                        print("Imputing {} bins of {}...".format(len(block), chromosomes[start]), flush=True)
+                        self._impute_coverage_block(block, models_folder, densities, registry)
+                        block[['bin', 'reads', 'cpgs']].to_csv(out, header=False, index=False)
+        finally:
+            if not self.persistent_pool:
+                self.close()
@@ -0,0 +1,147 @@
+import io
+import os
+import re
+import pandas as pd
+import pysam
+from clubcpg.CoverageFilter import COVERAGE_COLUMNS
+
+
+def index_output(csv_file: str, output_file=None, bin_size=100, keep_original=True):
+    """
+    Write a coverage or cluster csv output as a coordinate sorted, BGZF compressed and tabix indexed file, so the
+    records of a region can be read with :class:`IndexedOutput` without reading the whole file.
+
+    Every line gets the chromosome, start and end of its bin in front of the csv columns, all tab separated, and a
+    header starting with "#" names the columns. Outputs whose bins are not in order, like clubcpg-impute-cluster
+    output, are sorted in memory. Chromosomes stay in the order they first appear.
+
+    :Example:
+    >>> from clubcpg.IndexedOutput import index_output, IndexedOutput
+    >>> indexed_file = index_output("CompleteBins.file.bam.chr19.csv")
+    >>> IndexedOutput(indexed_file).query("chr19:3000000-3100000")
+
+    :param csv_file: output of clubcpg-coverage, clubcpg-impute-coverage, clubcpg-cluster, clubcpg-impute-cluster or
+        clubcpg-run
+    :param output_file: path of the compressed file, the csv path ending in .tsv.gz if None. The index is written next
+        to it with an added .tbi
+    :param bin_size: size of the bins in bp, the start of a bin is its end coordinate minus bin_size
+    :param keep_original: if False the csv file is removed once the compressed file is written
+    :return: path of the compressed file
+    """
+    if output_file is None:
+        output_file = os.path.splitext(csv_file)[0] + ".tsv.gz"
+    if not output_file.endswith(".gz"):
+        raise ValueError("Output file must end with .gz, got {}".format(output_file))
+    # tabix_index compresses the text file into output_file and removes it
+    text_file = output_file[:-3]
+
+    with open(csv_file, "r") as f:
+        first_line = f.readline().rstrip("\n")
+    if first_line.startswith("bin,"):
+        columns = first_line.split(",")
+    else:
+        columns = COVERAGE_COLUMNS[:len(first_line.split(","))]
+    header = "#" + "\t".join(["chromosome", "start", "end"] + columns) + "\n"
+
+    # Stream the rows while they are in order, each chromosome must be one run of increasing bins
+    in_order = True
+    with open(text_file, "w") as out:
+        out.write(header)
+        last = None
+        for key, row in _read_rows(csv_file, bin_size):
+            if last is not None and key < last:
+                in_order = False
+                break
+            last = key
+            out.write(row + "\n")
+
+    if not in_order:
+        # sorted() is stable, lines of one bin keep their order
+        with open(text_file, "w") as out:
+            out.write(header)
+            for key, row in sorted(_read_rows(csv_file, bin_size), key=lambda x: x[0]):
+                out.write(row + "\n")
+
+    pysam.tabix_index(text_file, force=True, seq_col=0, start_col=1, end_col=2, zerobased=True)
+    if not keep_original:
+        os.remove(csv_file)
+
+    return output_file
+
+
+def _read_rows(csv_file, bin_size):
+    """
+    :return: generator of tuples of (sort key, tab separated row) for every record of a csv output
+    """
+    chromosomes = dict()
+    with open(csv_file, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("bin,"):
+                continue
+            chromosome, bin_end = line.split(",", 1)[0].rsplit("_", 1)
+            bin_end = int(bin_end)
+            # Chromosomes are ordered as they first appear
+            key = (chromosomes.setdefault(chromosome, len(chromosomes)), bin_end)
+            yield key, "\t".join([chromosome, str(max(0, bin_end - bin_size)), str(bin_end), line.replace(",", "\t")])
+
+
+class IndexedOutput:
+    """
+    Read the records of a region from an output written by :func:`index_output`, only the compressed blocks
+    overlapping the region are read from disk.
+
+    :Example:
+    >>> from clubcpg.IndexedOutput import IndexedOutput
+    >>> clusters = IndexedOutput("Clustering.file.bam.19-01-01_matrix_data.tsv.gz")
+    >>> clusters.query("chr19", 3000000, 3100000)
+
+    """
+
+    def __init__(self, indexed_file: str):
+        """
+        :param indexed_file: path of a file written by :func:`index_output`, its .tbi index must be next to it
+        """
+        self.indexed_file = indexed_file
+        self.tabix = pysam.TabixFile(indexed_file)
+        header = list(self.tabix.header)
+        if not header:
+            raise ValueError("{} has no column header, it was not written by index_output".format(indexed_file))
+        # The first three columns are the coordinates added by index_output
+        self.columns = header[-1].lstrip("#").split("\t")[3:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.tabix.close()
+
+    def chromosomes(self):
+        """
+        :return: list of the chromosomes with records
+        """
+        return list(self.tabix.contigs)
+
+    def query(self, chromosome: str, start=None, stop=None):
+        """
+        :param chromosome: chromosome to read, or a region like "chr19:3000000-3100000"
+        :param start: optional start of the region, 0 based
+        :param stop: optional end of the region, exclusive
+        :return: pd.DataFrame of the records of all bins overlapping the region, with the columns of the csv output
+        """
+        match = re.match(r"^(.+):([\d,]+)-([\d,]+)$", chromosome)
+        if start is None and stop is None and match:
+            chromosome = match.group(1)
+            start, stop = int(match.group(2).replace(",", "")), int(match.group(3).replace(",", ""))
+
+        # Chromosomes without any records are not in the index
+        if chromosome not in self.tabix.contigs:
+            return pd.DataFrame(columns=self.columns)
+        lines = [line.split("\t", 3)[3] for line in self.tabix.fetch(chromosome, start, stop)]
+        if not lines:
+            return pd.DataFrame(columns=self.columns)
+
+        return pd.read_csv(io.StringIO("\n".join(lines)), sep="\t", header=None, names=self.columns)
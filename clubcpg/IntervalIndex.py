@@ -0,0 +1,164 @@
+import bisect
+from collections import OrderedDict
+
+
+class IntervalIndex:
+    """
+    Sorted, merged target regions per chromosome, used to restrict an analysis to the bins overlapping a BED file.
+
+    Regions are padded, overlapping or touching regions are merged and each chromosome is kept as two sorted lists of
+    starts and ends, so overlap queries are a binary search. :meth:`bin_intervals` groups the bins overlapping the
+    targets into windows which can each be fetched from a bam file once.
+
+    :Example:
+    >>> from clubcpg.IntervalIndex import IntervalIndex
+    >>> targets = IntervalIndex.from_bed("/path/to/promoters.bed", padding=500)
+    >>> for chromosome, start, stop, bins in targets.bin_intervals(bin_size=100):
+    ...     pass
+
+    """
+
+    def __init__(self, intervals: dict, padding=0):
+        """
+        :param intervals: dict of chromosome -> iterable of (start, end) tuples, 0 based and end exclusive like BED
+        :param padding: number of bp added on both sides of every region
+        """
+        self.padding = int(padding)
+        # Chromosomes stay in the order they are given
+        self.regions = OrderedDict()
+        for chromosome, chromosome_intervals in intervals.items():
+            starts, ends = [], []
+            for start, end in sorted((max(0, int(s) - self.padding), int(e) + self.padding)
+                                     for s, e in chromosome_intervals):
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.regions[chromosome] = (starts, ends)
+
+    @classmethod
+    def from_bed(cls, bed_file: str, padding=0):
+        """
+        :param bed_file: path to a BED file, only the chromosome, start and end columns are used
+        :param padding: number of bp added on both sides of every region
+        """
+        intervals = OrderedDict()
+        with open(bed_file, "r") as f:
+            for line in f:
+                if not line.strip() or line.startswith(("#", "track", "browser")):
+                    continue
+                fields = line.split("\t") if "\t" in line else line.split()
+                intervals.setdefault(fields[0], []).append((int(fields[1]), int(fields[2])))
+
+        return cls(intervals, padding)
+
+    def __getitem__(self, chromosome):
+        return self.regions[chromosome]
+
+    def __contains__(self, chromosome):
+        return chromosome in self.regions
+
+    def chromosomes(self):
+        return list(self.regions.keys())
+
+    def total_length(self):
+        """
+        :return: number of bp covered by the merged regions
+        """
+        return sum(sum(ends) - sum(starts) for starts, ends in self.regions.values())
+
+    def overlaps(self, chromosome: str, start: int, stop: int):
+        """
+        :return: True if [start, stop) overlaps any region of the chromosome
+        """
+        if chromosome not in self.regions:
+            return False
+        starts, ends = self.regions[chromosome]
+        # First region ending after start, the window overlaps it if the region starts before stop
+        k = bisect.bisect_right(ends, start)
+        return k < len(starts) and starts[k] < stop
+
+    def bin_overlaps(self, chromosome: str, bin_loc: int, bin_size=100):
+        """
+        :param bin_loc: end coordinate of the bin, as in bin ids like "chr19_5000"
+        :return: True if the bin overlaps any region
+        """
+        return self.overlaps(chromosome, bin_loc - bin_size, bin_loc)
+
+    def bin_intervals(self, bin_size=100, chromosome_lengths=None, max_bins=1000):
+        """
+        Group the bins overlapping the regions into windows of consecutive bins. Regions sharing or touching a bin are
+        combined, so every bin belongs to exactly one window.
+
+        :param bin_size: size of the bins in bp
+        :param chromosome_lengths: optional dict of chromosome lengths, chromosomes missing from it are skipped and
+            bins are not generated past the last bin of a chromosome
+        :param max_bins: longer windows are split, so one window never holds the reads of a whole chromosome
+        :return: list of tuples of (chromosome, start, stop, bins) with the bp window covered by the bins and the list
+            of bin ids, in the order of the chromosomes and regions
+        """
+        windows = []
+        for chromosome, (starts, ends) in self.regions.items():
+            last_bin = None
+            if chromosome_lengths is not None:
+                if chromosome not in chromosome_lengths:
+                    continue
+                last_bin = -(-chromosome_lengths[chromosome] // bin_size) * bin_size
+
+            chromosome_windows = []
+            for start, end in zip(starts, ends):
+                # Bin ends of the first and last bin overlapping [start, end)
+                first = (start // bin_size + 1) * bin_size
+                last = -(-end // bin_size) * bin_size
+                if last_bin is not None:
+                    last = min(last, last_bin)
+                if last < first:
+                    continue
+                if chromosome_windows and first <= chromosome_windows[-1][1] + bin_size:
+                    chromosome_windows[-1][1] = max(chromosome_windows[-1][1], last)
+                else:
+                    chromosome_windows.append([first, last])
+
+            for first, last in chromosome_windows:
+                for window_first in range(first, last + bin_size, max_bins * bin_size):
+                    window_last = min(last, window_first + (max_bins - 1) * bin_size)
+                    bins = ["_".join([chromosome, str(x)]) for x in range(window_first, window_last + bin_size, bin_size)]
+                    windows.append((chromosome, window_first - bin_size, window_last, bins))
+
+        return windows
+
+    def group_bins(self, bins, bin_size=100, max_bins=1000):
+        """
+        Group a stream of bin ids, for example read from a coverage file, by the window of :meth:`bin_intervals` they
+        fall into. Consecutive bins of the same window form one group, bins outside all regions are dropped.
+
+        :param bins: iterable of bin ids like "chr19_5000"
+        :param bin_size: size of the bins in bp
+        :param max_bins: maximum number of bins per group
+        :return: generator of tuples of (chromosome, start, stop, bins) with the bp window covered by the grouped bins
+        """
+        window_ends = dict()
+        for chromosome, start, stop, window_bins in self.bin_intervals(bin_size, max_bins=max_bins):
+            window_ends.setdefault(chromosome, []).append(stop)
+
+        group, group_key = [], None
+        for bin_ in bins:
+            chromosome, bin_loc = bin_.rsplit("_", 1)
+            bin_loc = int(bin_loc)
+            if not self.bin_overlaps(chromosome, bin_loc, bin_size):
+                continue
+            key = (chromosome, bisect.bisect_left(window_ends[chromosome], bin_loc))
+            if group and key != group_key:
+                yield self._group(group, bin_size)
+                group = []
+            group_key = key
+            group.append((chromosome, bin_loc, bin_))
+
+        if group:
+            yield self._group(group, bin_size)
+
+    @staticmethod
+    def _group(group, bin_size):
+        locations = [bin_loc for chromosome, bin_loc, bin_ in group]
+        return group[0][0], min(locations) - bin_size, max(locations), [bin_ for chromosome, bin_loc, bin_ in group]
@@ -0,0 +1,136 @@
+import os
+import time
+import logging
+import threading
+from joblib import load
+from clubcpg_prelim import PReLIM, PredictionCache
+
+
+class ModelRegistry:
+    """
+    Loads each trained PReLIM model once per process and hands out the same instance on every later request, instead of
+    deserializing the model file again for every chunk and every input file.
+
+    Models saved by :class:`clubcpg.ConnectToCpGNet.TrainWithPReLIM` are pickled GridSearchCV objects. Only the
+    best_estimator_ of the search is used for prediction, so by default the wrapper is dropped after loading and the
+    cross validation results are freed. If a compact model written by
+    :meth:`clubcpg.ConnectToCpGNet.TrainWithPReLIM.save_compact` exists next to the saved model it is used instead, it
+    loads much faster.
+
+    Every model gets a :class:`clubcpg_prelim.PredictionCache`, so feature vectors repeated across bins and chunks are
+    predicted only once.
+
+    :Example:
+    >>> from clubcpg.ModelRegistry import default_registry
+    >>> registry = default_registry()
+    >>> model = registry.get("/path/to/models", 4)
+    >>> imputed = model.impute_many(matrices)
+    >>> print(registry.summary())
+
+    """
+
+    def __init__(self, strip_search=True, prefer_compact=True, cache_size=100000):
+        """
+        :param strip_search: Replace a loaded GridSearchCV by its best_estimator_
+        :param prefer_compact: Load the compact model of a density if one exists
+        :param cache_size: Number of feature vectors whose predictions are remembered per model, 0 to disable caching
+        """
+        self.strip_search = strip_search
+        self.prefer_compact = prefer_compact
+        self.cache_size = int(cache_size)
+        self.models = dict()
+        # Per model file: load time in seconds, file size in bytes, modification time and whether it was stripped
+        self.stats = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def model_path(models_folder: str, cpg_density: int):
+        """
+        :return: path of the model file for cpg_density, as written by TrainWithPReLIM
+        """
+        return os.path.join(models_folder, "saved_model_{}_cpgs.prelim".format(cpg_density))
+
+    @staticmethod
+    def compact_model_path(models_folder: str, cpg_density: int):
+        """
+        :return: path of the compact model file for cpg_density, as written by TrainWithPReLIM.save_compact
+        """
+        return os.path.join(models_folder, "saved_model_{}_cpgs.compact".format(cpg_density))
+
+    def get(self, models_folder: str, cpg_density: int):
+        """
+        Get the model for one CpG density, loading it only on first use or if the file changed since it was loaded
+
+        :param models_folder: Path to directory containing trained models
+        :param cpg_density: Number of CpGs
+        :return: :class:`clubcpg_prelim.PReLIM` instance with a loaded model
+        """
+        path = self.compact_model_path(models_folder, cpg_density)
+        if not (self.prefer_compact and os.path.exists(path)):
+            path = self.model_path(models_folder, cpg_density)
+        path = os.path.realpath(path)
+        modified = os.stat(path).st_mtime
+
+        with self._lock:
+            if path in self.models and self.stats[path]['modified'] == modified:
+                return self.models[path]
+
+            start = time.time()
+            model = load(path)
+            stripped = self.strip_search and hasattr(model, "best_estimator_")
+            if stripped:
+                model = model.best_estimator_
+
+            prelim = PReLIM(cpgDensity=cpg_density)
+            prelim.model = model
+            if self.cache_size > 0:
+                prelim.prediction_cache = PredictionCache(self.cache_size)
+            self.models[path] = prelim
+            self.stats[path] = {'load_seconds': time.time() - start, 'file_bytes': os.path.getsize(path),
+                                'modified': modified, 'stripped': stripped}
+
+        message = "Successfully loaded model: {} ({:.1f} MB in {:.2f} s)".format(
+            path, self.stats[path]['file_bytes'] / 1e6, self.stats[path]['load_seconds'])
+        print(message, flush=True)
+        logging.info(message)
+
+        return prelim
+
+    def clear(self):
+        """
+        Drop all loaded models
+        """
+        with self._lock:
+            self.models.clear()
+            self.stats.clear()
+
+    def summary(self):
+        """
+        :return: One line describing the number, total size and total load time of the loaded models
+        """
+        file_bytes = sum(s['file_bytes'] for s in self.stats.values())
+        load_seconds = sum(s['load_seconds'] for s in self.stats.values())
+        return "Loaded {} models ({:.1f} MB) in {:.2f} s".format(len(self.stats), file_bytes / 1e6, load_seconds)
+
+    def cache_summary(self):
+        """
+        :return: One line per loaded model describing how many predictions its cache saved
+        """
+        lines = []
+        for path, model in self.models.items():
+            if model.prediction_cache is not None:
+                lines.append("{} cpg model: {}".format(model.cpgDensity, model.prediction_cache.summary()))
+        return "\n".join(lines)
+
+
+_default_registry = None
+
+
+def default_registry():
+    """
+    :return: The :class:`ModelRegistry` shared by everything running in this process
+    """
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = ModelRegistry()
+    return _default_registry
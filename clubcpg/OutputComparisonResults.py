@@ -1,4 +1,5 @@
 import os
+from clubcpg.ClusterTable import ClusterTableWriter
 
 
 # This class will be called by clubcpg-cluster to output its multiprocessing results output into csv files
@@ -11,26 +12,23 @@ class OutputIndividualMatrixData:
         """
         self.results = results
 
-    def write_to_output(self, filepath=None, prefix=None):
+    def write_to_output(self, filepath=None, prefix=None, output_format="csv", input_labels=("A", "B")):
         """
         :param prefix: Prefix to name the output files
         :param filepath: Path to save the output files
-        :return: None
+        :param output_format: "csv", or "parquet", "feather" or "npz" for typed columns, see
+            :class:`clubcpg.ClusterTable.ClusterTableWriter`
+        :param input_labels: labels of the first and second input file used in the results
+        :return: path of the output file
         """
 
         if prefix and filepath:
-            output_comparisons = open("{}_matrix_data.csv".format(os.path.join(filepath, prefix)), "w")
-
-            output_comparisons.write("bin,input_label,methylation,class_label,read_number,cpg_number,cpg_pattern,class_split\n")
-
-            for result in self.results:
-                if result:
-                    for line in result:
-                        output_comparisons.write(line + "\n")
-                else:
-                    continue
-
-            output_comparisons.close()
-
-            return
-
+            with ClusterTableWriter("{}_matrix_data".format(os.path.join(filepath, prefix)), output_format,
+                                    input_labels) as output_comparisons:
+                for result in self.results:
+                    if result:
+                        output_comparisons.write_lines(result)
+                    else:
+                        continue
+
+            return output_comparisons.path
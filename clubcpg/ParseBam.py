@@ -1,4 +1,5 @@
 import pysam
+import numpy as np
 import pandas as pd
 from collections import defaultdict
 import logging
@@ -42,6 +43,8 @@ class BamFileReadParser:
         self.full_reads = []
         self.read_cpgs = []
         self.no_overlap = no_overlap
+        # Reads of the region fetched by prefetch(), with their start and end coordinates
+        self.prefetched = None
 
         if read1_5 or read2_5 or read1_3 or read2_3:
             self.mbias_filtering = True
@@ -66,6 +69,87 @@ class BamFileReadParser:
 
         return reads_start_loc
 
+    def prefetch(self, chromosome: str, start: int, stop: int):
+        """
+        Fetch all reads of a region once. Later calls of :meth:`parse_reads` for windows inside this region select their
+        reads from memory instead of fetching them again, and the methylation tags of every read are extracted once.
+        Results are the same as without prefetching.
+
+        :param chromosome: chromosome as "chr6"
+        :param start: start coordinate
+        :param stop: end coordinate
+        """
+        reads = [read for read in self.OpenBamFile.fetch(chromosome, start, stop)
+                 if read.mapping_quality >= self.mapping_quality]
+        # Same overlap rule as a fetch, a read without aligned bases spans one bp
+        starts = np.array([read.reference_start for read in reads], dtype=np.int64)
+        ends = np.array([read.reference_end if read.reference_end is not None else read.reference_start + 1
+                         for read in reads], dtype=np.int64)
+        self.prefetched = {'chromosome': chromosome, 'start': start, 'stop': stop, 'reads': reads, 'starts': starts,
+                           'ends': ends, 'max_span': int((ends - starts).max()) if reads else 0, 'tags': dict()}
+
+    def _prefetched_reads(self, chromosome, start, stop):
+        """
+        :return: reads overlapping the window in fetch order, or None if the window is not inside the prefetched region
+        """
+        prefetched = self.prefetched
+        if not prefetched or prefetched['chromosome'] != chromosome or start < prefetched['start'] or \
+                stop > prefetched['stop']:
+            return None
+        starts, ends = prefetched['starts'], prefetched['ends']
+        # Reads are sorted by start, only those starting within max_span before the window can reach into it
+        lo = np.searchsorted(starts, start - prefetched['max_span'], side='left')
+        hi = np.searchsorted(starts, stop, side='left')
+        selected = lo + np.flatnonzero(ends[lo:hi] > start)
+        return [prefetched['reads'][k] for k in selected]
+
+    def _read_tags(self, read):
+        """
+        :return: list of (position, XM tag) of a read without indels, after m-bias trimming, or None for other reads
+        """
+        if self.prefetched:
+            cached = self.prefetched['tags'].get(id(read), False)
+            if cached is not False:
+                # fix_read_overlap extends these lists, hand out a copy
+                return list(cached) if cached is not None else None
+
+        reduced_read = None
+        # need to check for regular expression though
+        no_indel_mapping = re.match("^\d+M$", read.cigarstring)
+        if (no_indel_mapping):
+
+            reduced_read = []
+            # Join EVERY XM tag with its aligned_pair location
+            for pair, tag in zip(read.get_aligned_pairs(), read.get_tag('XM')):
+                if pair[1]:
+                    if read.flag == 83 or read.flag == 163 or read.flag == 16:
+                        reduced_read.append((pair[1] - 1, tag))
+                    else:
+                        reduced_read.append((pair[1], tag))
+                else:
+                    continue
+
+            # if MBIAS was set, slice the joined list
+            if self.mbias_filtering:
+                if read.is_read1:
+                    mbias_5_prime = self.read1_5
+                    # note taking the NEGATIVE of the value for the 3-prime
+                    mbias_3_prime = -self.read1_3
+                    if mbias_3_prime == 0:
+                        mbias_3_prime = None
+                    reduced_read = reduced_read[mbias_5_prime:mbias_3_prime]
+                if read.is_read2:
+                    mbias_5_prime = self.read2_5
+                    mbias_3_prime = -self.read2_3
+                    if mbias_3_prime == 0:
+                        mbias_3_prime = None
+                    reduced_read = reduced_read[mbias_5_prime:mbias_3_prime]
+
+        if self.prefetched:
+            self.prefetched['tags'][id(read)] = reduced_read
+            return list(reduced_read) if reduced_read is not None else None
+        return reduced_read
+
     # Get reads from the bam file, extract methylation state
     def parse_reads(self, chromosome: str, start:int , stop: int):
         """
@@ -74,10 +158,12 @@ class BamFileReadParser:
         :param stop: end coordinate
         :return: List of reads and their positional tags as assigned by bismark
         """
-        reads = []
-        for read in self.OpenBamFile.fetch(chromosome, start, stop):
-            if read.mapping_quality >= self.mapping_quality:
-                reads.append(read)
+        reads = self._prefetched_reads(chromosome, start, stop)
+        if reads is None:
+            reads = []
+            for read in self.OpenBamFile.fetch(chromosome, start, stop):
+                if read.mapping_quality >= self.mapping_quality:
+                    reads.append(read)
 
         ## CIGAR FILTERING BY C. COARFA
         read_cpgs = []
@@ -95,37 +181,8 @@ class BamFileReadParser:
             # if (self.query_count_hash[read.query_name]>2):
             #     logging.info("Found read with more than 2 mappings: %s --> %s\n"%(read.query_name, self.query_count_hash[read.query_name]))
             
-            # need to check for regular expression though
-            no_indel_mapping = re.match("^\d+M$", read.cigarstring)
-            if (no_indel_mapping):
-
-                reduced_read = []
-                # Join EVERY XM tag with its aligned_pair location
-                for pair, tag in zip(read.get_aligned_pairs(), read.get_tag('XM')):
-                    if pair[1]:
-                        if read.flag == 83 or read.flag == 163 or read.flag == 16:
-                            reduced_read.append((pair[1] - 1, tag))
-                        else:
-                            reduced_read.append((pair[1], tag))
-                    else:
-                        continue
-    
-                # if MBIAS was set, slice the joined list
-                if self.mbias_filtering:
-                    if read.is_read1:
-                        mbias_5_prime = self.read1_5
-                        # note taking the NEGATIVE of the value for the 3-prime
-                        mbias_3_prime = -self.read1_3
-                        if mbias_3_prime == 0:
-                            mbias_3_prime = None
-                        reduced_read = reduced_read[mbias_5_prime:mbias_3_prime]
-                    if read.is_read2:
-                        mbias_5_prime = self.read2_5
-                        mbias_3_prime = -self.read2_3
-                        if mbias_3_prime == 0:
-                            mbias_3_prime = None
-                        reduced_read = reduced_read[mbias_5_prime:mbias_3_prime]
-                    
+            reduced_read = self._read_tags(read)
+            if reduced_read is not None:
                 read_cpgs.append(reduced_read)
             else:
                 self.skipped_reads.add(read.query_name)
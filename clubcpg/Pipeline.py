@@ -0,0 +1,153 @@
+import threading
+import queue
+import logging
+from concurrent.futures import TimeoutError
+
+
+# Sentinel placed on a queue once a stage has no more items to pass on
+_END_OF_STREAM = object()
+
+
+class _StageFailure:
+    """Carries an exception raised inside a stage thread downstream to the consumer"""
+
+    def __init__(self, stage_name, error):
+        self.stage_name = stage_name
+        self.error = error
+
+
+class BoundedPipeline:
+    """
+    Run a chain of processing stages concurrently. Every stage runs in its own thread and hands its results to the next
+    stage through a bounded queue, so a slow stage applies back-pressure instead of letting work pile up in memory.
+    Results of the final stage are yielded to the caller in the order the items were submitted.
+
+    :Example:
+    >>> from clubcpg.Pipeline import BoundedPipeline
+    >>> pipeline = BoundedPipeline([("extract", extract_chunk), ("impute", impute_chunk)], max_in_flight=2)
+    >>> for result in pipeline.run(chunks):
+    ...     cluster(result)
+
+    """
+
+    def __init__(self, stages: list, max_in_flight=2):
+        """
+        :param stages: list of (name, callable) tuples. Each callable receives the output of the previous stage
+        :param max_in_flight: Maximum number of items waiting between two consecutive stages
+        """
+        if not stages:
+            raise AttributeError("At least one pipeline stage must be specified")
+        self.stages = stages
+        self.max_in_flight = max(1, int(max_in_flight))
+
+    def _run_stage(self, name, function, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is _END_OF_STREAM or isinstance(item, _StageFailure):
+                out_queue.put(item)
+                return
+            try:
+                result = function(item)
+            except BaseException as e:
+                logging.error("Pipeline stage {} failed".format(name))
+                out_queue.put(_StageFailure(name, e))
+                return
+            out_queue.put(result)
+
+    @staticmethod
+    def _feed(items, out_queue):
+        try:
+            for item in items:
+                out_queue.put(item)
+        except BaseException as e:
+            out_queue.put(_StageFailure("input", e))
+            return
+        out_queue.put(_END_OF_STREAM)
+
+    def run(self, items: iter):
+        """
+        Generator pushing every item through all stages and yielding the output of the last stage
+
+        :param items: iterable of inputs for the first stage
+        :return: outputs of the last stage, in input order
+        """
+        queues = [queue.Queue(maxsize=self.max_in_flight) for _ in range(len(self.stages) + 1)]
+
+        # Daemon threads, a consumer which stops early must not keep the interpreter alive
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for i, (name, function) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_stage, args=(name, function, queues[i], queues[i + 1]),
+                                            name="clubcpg-{}".format(name), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        while True:
+            result = queues[-1].get()
+            if result is _END_OF_STREAM:
+                break
+            if isinstance(result, _StageFailure):
+                raise RuntimeError("Pipeline stage '{}' failed".format(result.stage_name)) from result.error
+            yield result
+
+        for thread in threads:
+            thread.join()
+
+
+def _apply_to_batch(function, batch):
+    """Worker side of :func:`map_in_batches`, a failing item gives None instead of failing its batch"""
+    results = []
+    for item in batch:
+        try:
+            results.append(function(item))
+        except Exception as error:
+            logging.error("Unknown exception = {}".format(error))
+            results.append(None)
+    return results
+
+
+def map_in_batches(pool, function, items, batch_size=64, timeout=5):
+    """
+    Apply function to every item using a pebble pool, submitting the items in batches so the cost of scheduling a task
+    and pickling function is paid once per batch instead of once per item.
+
+    Each batch gets a timeout of timeout seconds per item it contains. If a batch times out its items are retried one by
+    one, so a single hanging item only loses its own result.
+
+    :param pool: an open :class:`pebble.ProcessPool`
+    :param function: picklable callable taking one item
+    :param items: iterable of inputs
+    :param batch_size: number of items per submitted task
+    :param timeout: seconds allowed per item, None to wait forever
+    :return: list preallocated to the number of items, holding each result at the index of its item or None if it failed
+    """
+    items = list(items)
+    results = [None] * len(items)
+    batch_size = max(1, int(batch_size))
+
+    futures = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        batch_timeout = timeout * len(batch) if timeout else None
+        futures.append((start, batch, pool.schedule(_apply_to_batch, args=(function, batch), timeout=batch_timeout)))
+
+    for start, batch, future in futures:
+        try:
+            results[start:start + len(batch)] = future.result()
+            continue
+        except TimeoutError:
+            logging.warning("Batch of {} items starting at {} timed out, retrying items individually".format(
+                len(batch), start))
+        except Exception as error:
+            print("Unknown exception = {}".format(error))
+            continue
+
+        retries = [pool.schedule(function, args=(item,), timeout=timeout) for item in batch]
+        for k, retry in enumerate(retries):
+            try:
+                results[start + k] = retry.result()
+            except TimeoutError as error:
+                print("Timeout caught - {}".format(error.args[1]))
+            except Exception as error:
+                print("Unknown exception = {}".format(error))
+
+    return results
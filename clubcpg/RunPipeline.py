@@ -0,0 +1,192 @@
+import os
+import logging
+import datetime
+from multiprocessing import Pool
+from clubcpg.CalculateBinCoverage import CalculateCompleteBins
+from clubcpg.ClusterReads import ClusterReads
+from clubcpg.Sharding import select_shard, shard_tag
+from clubcpg.ClusterTable import ClusterTableWriter
+
+
+class RunPipeline(ClusterReads):
+    """
+    Run the standard workflow of coverage, filtering and clustering in one pass. Each bin is parsed once per bam file
+    inside one process pool: the complete read matrix built to count coverage is filtered inline and, if it passes,
+    clustered right away instead of being parsed again from a filtered coverage file.
+    This inherits from :class:`.ClusterReads`
+
+    :Example:
+    >>> from clubcpg.RunPipeline import RunPipeline
+    >>> run = RunPipeline(bam_a="/path/to/file.bam", output_directory="/path/to/output", chromosome="chr19")
+    >>> coverage_file, cluster_file = run.execute()
+
+    """
+
+    def __init__(self, bam_a: str, bam_b=None, bin_size=100, output_directory=None, num_processors=1,
+        cluster_member_min=4, read_depth_req=10, remove_noise=True, mbias_read1_5=None,
+        mbias_read1_3=None, mbias_read2_5=None, mbias_read2_3=None, suffix="", no_overlap=True, permute_labels=False,
+        min_reads=10, min_cpgs=2, chromosome=None, chunksize=64, target_regions=None, shard=None,
+        output_format="csv"):
+        """
+        :param min_reads: Minimum number of complete reads in bam_a for a bin to be clustered, the filter usually
+            applied to the clubcpg-coverage output
+        :param min_cpgs: Minimum number of CpGs for a bin to be clustered
+        :param chromosome: Chromosome to analyze, ie "chr19". All chromosomes starting with "chr" if None
+        :param chunksize: Number of bins sent to a worker at once
+        :param target_regions: Optional :class:`clubcpg.IntervalIndex.IntervalIndex`, only bins overlapping its regions
+            are analyzed and the reads of each window of bins are fetched once per bam file
+        :param shard: Optional tuple of (i, N), only the i-th of N contiguous shards of the bins, balanced by genome
+            length, is analyzed. Both output names get a ".shard{i}of{N}" tag for clubcpg-merge
+        :param output_format: format of the cluster output, "csv" or "parquet", "feather" or "npz" for typed columns
+        """
+        super().__init__(bam_a, bam_b, bin_size, None, output_directory, num_processors, cluster_member_min,
+                         read_depth_req, remove_noise, mbias_read1_5, mbias_read1_3, mbias_read2_5, mbias_read2_3,
+                         suffix, no_overlap, permute_labels, target_regions=target_regions, shard=shard,
+                         output_format=output_format)
+        self.min_reads = int(min_reads)
+        self.min_cpgs = int(min_cpgs)
+        self.chromosome = chromosome
+        self.chunksize = int(chunksize)
+
+        # Coverage is counted with the same parser settings the clustering uses
+        self.coverage_calculators = [CalculateCompleteBins(bam_file, self.bin_size, output_directory, num_processors,
+                                                           mbias_read1_5, mbias_read1_3, mbias_read2_5, mbias_read2_3,
+                                                           no_overlap)
+                                     for bam_file in (bam_a, bam_b) if bam_file]
+
+    def _chromosome_lengths(self):
+        calc = self.coverage_calculators[0]
+        chromosome_lengths = calc.get_chromosome_lengths()
+        if self.chromosome:
+            return {self.chromosome: chromosome_lengths[self.chromosome]}
+        if self.target_regions is not None:
+            # Target regions select the chromosomes themselves
+            return chromosome_lengths
+        return calc.remove_scaffolds(chromosome_lengths)
+
+    def generate_bins(self):
+        """
+        :return: list of all bins to analyze, of the selected chromosome or of all chromosomes starting with "chr".
+            With target regions only bins overlapping them
+        """
+        if self.target_regions is not None:
+            return [bin for window in self.generate_windows() for bin in window[3]]
+
+        calc = self.coverage_calculators[0]
+        bins = []
+        for chromosome_bins in calc.generate_bins_list(self._chromosome_lengths()).values():
+            bins.extend(chromosome_bins)
+
+        return bins
+
+    def generate_windows(self):
+        """
+        :return: list of windows of bins overlapping the target regions, as generated by
+            :meth:`clubcpg.IntervalIndex.IntervalIndex.bin_intervals`
+        """
+        return self.target_regions.bin_intervals(self.bin_size, self._chromosome_lengths())
+
+    def process_bin(self, bin, parsers=None):
+        """
+        Count the complete reads of one bin and cluster it if it passes the filters. This is passed to a multiprocessing
+        Pool.
+
+        :param bin: string in this format: "chr19_55555"
+        :param parsers: Optional list of BamFileReadParser to reuse, one per input file
+        :return: tuple of (coverage, lines). coverage is (bin, reads, cpgs) of bam_a or None if the bin has no reads,
+            lines the cluster output lines of the bin or None if it was not clustered
+        """
+        if parsers is None:
+            parsers = [None] * len(self.coverage_calculators)
+        result_A = self.coverage_calculators[0].calculate_bin_coverage(bin, parser=parsers[0])
+        if not result_A:
+            return None, None
+        matrix_A = result_A[1]
+        coverage = (bin, matrix_A.shape[0], matrix_A.shape[1])
+
+        # Inline version of the filter on the coverage output, then the read depth requirement of clustering
+        if coverage[1] < self.min_reads or coverage[2] < self.min_cpgs:
+            return coverage, None
+        if matrix_A.shape[0] < self.read_depth_req:
+            return coverage, None
+
+        matrix_B = None
+        if not self.single_file_mode:
+            result_B = self.coverage_calculators[1].calculate_bin_coverage(bin, parser=parsers[1])
+            if not result_B:
+                return coverage, None
+            matrix_B = result_B[1]
+            if matrix_B.shape[0] < self.read_depth_req:
+                return coverage, None
+
+        chromosome, bin_loc = bin.split("_")
+        return coverage, self.cluster_bin_matrices(chromosome, int(bin_loc), matrix_A, matrix_B)
+
+    def process_window(self, window):
+        """
+        Process all bins of one window, fetching its reads from every bam file once. This is passed to a
+        multiprocessing Pool.
+
+        :param window: tuple of (chromosome, start, stop, bins)
+        :return: list with the result of :meth:`process_bin` for every bin of the window
+        """
+        chromosome, start, stop, bins = window
+        parsers = [calc._create_parser() for calc in self.coverage_calculators]
+        try:
+            for parser in parsers:
+                parser.prefetch(chromosome, start, stop)
+        except ValueError as e:
+            # Chromosome is not in one of the bam files
+            logging.error("Could not fetch reads of {}:{}-{}".format(chromosome, start, stop))
+            logging.debug(str(e))
+            return [(None, None)] * len(bins)
+
+        return [self.process_bin(bin, parsers) for bin in bins]
+
+    def execute(self, return_only=False):
+        """
+        Calculate coverage and cluster all bins, streaming both outputs to the output directory as bins finish.
+
+        :param return_only: unused, results are always written to the output directory
+        :return: tuple of (coverage file, cluster file). The coverage file has the layout of clubcpg-coverage, the
+            cluster file the layout of clubcpg-cluster
+        """
+        start_time = datetime.datetime.now().strftime("%y-%m-%d")
+        if self.target_regions is not None:
+            windows = self.generate_windows()
+            windows = select_shard(windows, [len(window[3]) for window in windows], self.shard)
+            n_bins = sum(len(window[3]) for window in windows)
+        else:
+            bins = self.generate_bins()
+            bins = select_shard(bins, [1] * len(bins), self.shard)
+            n_bins = len(bins)
+        logging.info("Analyzing {} bins".format(n_bins))
+
+        tag = shard_tag(self.shard)
+        # Named like the output of clubcpg-coverage
+        coverage_file = os.path.join(self.output_directory, "CompleteBins.{}.{}{}.csv".format(
+            os.path.basename(self.bam_a), self.chromosome, tag))
+        cluster_prefix = "{}_matrix_data".format(os.path.join(self.output_directory, "Clustering.{}{}{}.{}".format(
+            os.path.basename(self.bam_a), self.suffix, tag, start_time)))
+
+        clustered = 0
+        with Pool(processes=self.num_processors) as pool, open(coverage_file, "w") as coverage_out, \
+                ClusterTableWriter(cluster_prefix, self.output_format, self.input_labels) as cluster_out:
+
+            if self.target_regions is not None:
+                results = (result for window_results in pool.imap(self.process_window, windows)
+                           for result in window_results)
+            else:
+                results = pool.imap(self.process_bin, bins, chunksize=self.chunksize)
+
+            for k, (coverage, lines) in enumerate(results):
+                if coverage:
+                    coverage_out.write("{},{},{}\n".format(*coverage))
+                if lines:
+                    clustered += 1
+                    cluster_out.write_lines(lines)
+                if (k + 1) % 100000 == 0:
+                    logging.info("Bins remaining = {}".format(n_bins - k - 1))
+
+        logging.info("Clustered {} of {} bins".format(clustered, n_bins))
+        return coverage_file, cluster_out.path
@@ -0,0 +1,183 @@
+import os
+import re
+import numpy as np
+from clubcpg.ClusterTable import ClusterTableWriter, read_cluster_table, EXTENSIONS
+
+# Estimated cost of one bin in units of reads. Every bin is fetched and parsed even if it has few reads, this constant
+# accounts for that part of the work.
+BIN_OVERHEAD = 10
+
+
+def parse_shard(text: str):
+    """
+    :param text: shard given as "i/N", i counting from 1 to N, ie "3/8"
+    :return: tuple of (i, N)
+    """
+    match = re.match(r"^\s*(\d+)\s*/\s*(\d+)\s*$", str(text))
+    if not match:
+        raise ValueError("Shard must be given as i/N, for example 3/8, got '{}'".format(text))
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError("Shard index must be between 1 and {}, got {}".format(count, index))
+    return index, count
+
+
+def shard_tag(shard):
+    """
+    :param shard: tuple of (i, N) or None
+    :return: text added to output file names of the shard, ie ".shard3of8", empty if shard is None
+    """
+    if shard is None:
+        return ""
+    return ".shard{}of{}".format(*shard)
+
+
+def bin_cost(reads=None):
+    """
+    :param reads: number of reads of the bin from a coverage file or an array of them, None if unknown
+    :return: estimated cost of processing the bin
+    """
+    if reads is None:
+        return BIN_OVERHEAD
+    return BIN_OVERHEAD + reads
+
+
+def assign_shards(costs, total: float, count: int, offset=0.0):
+    """
+    Assign items in genome order to count contiguous shards of about equal total cost. An item goes to the shard which
+    holds the midpoint of its cost interval, so the assignment only depends on the costs and is the same in every job.
+
+    :param costs: 1d array of item costs
+    :param total: total cost of all items of all chunks
+    :param count: number of shards
+    :param offset: total cost of all items before these, to assign a long stream chunk by chunk
+    :return: integer array with the 0 based shard of every item
+    """
+    costs = np.asarray(costs, dtype=float)
+    if total <= 0:
+        return np.zeros(len(costs), dtype=np.int64)
+    midpoints = offset + np.cumsum(costs) - costs / 2
+    return np.minimum((midpoints / total * count).astype(np.int64), count - 1)
+
+
+def select_shard(items: list, costs, shard):
+    """
+    :param items: list of items in genome order
+    :param costs: cost of every item
+    :param shard: tuple of (i, N) or None
+    :return: the items of shard i, all items if shard is None
+    """
+    if shard is None:
+        return list(items)
+    costs = np.asarray(costs, dtype=float)
+    shards = assign_shards(costs, costs.sum(), shard[1])
+    return [item for item, k in zip(items, shards) if k == shard[0] - 1]
+
+
+def iter_shard(make_iter, cost, shard):
+    """
+    Select the items of one shard from a stream which can be read twice, the first pass sums the costs
+
+    :param make_iter: callable returning a new iterator over the items in genome order
+    :param cost: callable returning the cost of an item
+    :param shard: tuple of (i, N) or None
+    :return: generator of the items of shard i
+    """
+    if shard is None:
+        yield from make_iter()
+        return
+
+    total = float(sum(cost(item) for item in make_iter()))
+    index, count = shard[0] - 1, shard[1]
+    before = 0.0
+    for item in make_iter():
+        item_cost = cost(item)
+        if total > 0:
+            k = min(int((before + item_cost / 2) / total * count), count - 1)
+        else:
+            k = 0
+        before += item_cost
+        if k == index:
+            yield item
+        elif k > index:
+            # Shards are contiguous, nothing after this item belongs to the shard
+            return
+
+
+def find_shards(files):
+    """
+    Check the outputs of all shards of one run are present
+
+    :param files: output files of the shards, named with :func:`shard_tag`
+    :return: list of the files ordered by shard
+    """
+    shards = dict()
+    count = None
+    for path in files:
+        matches = re.findall(r"\.shard(\d+)of(\d+)", os.path.basename(path))
+        if not matches:
+            raise ValueError("{} is not the output of a shard".format(path))
+        index, file_count = int(matches[-1][0]), int(matches[-1][1])
+        if count is not None and file_count != count:
+            raise ValueError("{} belongs to a run with {} shards, other files to one with {}".format(
+                path, file_count, count))
+        count = file_count
+        if index in shards:
+            raise ValueError("Shard {} is given twice: {} and {}".format(index, shards[index], path))
+        shards[index] = path
+
+    if count is None:
+        raise ValueError("No shard outputs given")
+    missing = [index for index in range(1, count + 1) if index not in shards]
+    if missing:
+        raise ValueError("Missing outputs of shards {} of {}".format(", ".join(str(k) for k in missing), count))
+
+    return [shards[index] for index in range(1, count + 1)]
+
+
+def merge_shards(files, output_file: str):
+    """
+    Concatenate the outputs of all shards of one run in shard order, which is genome order. A header line shared by
+    the files, as in clubcpg-cluster outputs, is written once. Parquet, feather and npz cluster outputs are merged
+    into one file of the same format.
+
+    :param files: output files of the shards, named with :func:`shard_tag`
+    :param output_file: path of the merged file
+    :return: number of lines written, without the header
+    """
+    ordered = find_shards(files)
+    if ordered[0].endswith(".gz"):
+        raise ValueError("Compressed shards cannot be merged, merge the csv outputs and index the merged file with "
+                         "clubcpg-index")
+
+    output_format = os.path.splitext(ordered[0])[1].lstrip(".")
+    if output_format in EXTENSIONS and output_format != "csv":
+        prefix, extension = os.path.splitext(output_file)
+        if extension != EXTENSIONS[output_format]:
+            raise ValueError("Merged output of {} shards must be named *{}".format(output_format,
+                                                                                   EXTENSIONS[output_format]))
+        with ClusterTableWriter(prefix, output_format) as writer:
+            for path in ordered:
+                writer.write_frame(read_cluster_table(path))
+        return writer.written
+    header = None
+    with open(ordered[0], "r") as f:
+        first_line = f.readline()
+    if first_line.startswith("bin,"):
+        header = first_line
+
+    written = 0
+    with open(output_file, "w") as out:
+        if header:
+            out.write(header)
+        for path in ordered:
+            with open(path, "r") as f:
+                for k, line in enumerate(f):
+                    if k == 0 and header:
+                        if line != header:
+                            raise ValueError("{} has a different header than {}".format(path, ordered[0]))
+                        continue
+                    out.write(line)
+                    written += 1
+
+    return written
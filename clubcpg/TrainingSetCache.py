@@ -0,0 +1,126 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from clubcpg_prelim import RaggedMatrices
+
+
+class TrainingSetCache:
+    """
+    Keeps the training matrices and training features of every CpG density on disk as numpy files, so later training
+    runs on the same data (for example to retune hyperparameters) skip extraction from the bam file and feature
+    collection. Files are loaded memory-mapped.
+
+    Entries are keyed by the bam file, the coverage file, the m-bias settings, the bin size, the sample limit, the
+    sampling settings and the random seed. Input files are identified by path, size and modification time from
+    os.stat, so rewriting either file in place starts a new entry.
+
+    :Example:
+    >>> from clubcpg.TrainingSetCache import TrainingSetCache
+    >>> cache = TrainingSetCache("/path/to/cache", "/path/to/file.bam", "/path/to/coverage.csv", sample_limit=10000)
+    >>> if not cache.has_matrices(4):
+    ...     cache.save_matrices(4, matrices)
+    >>> matrices = cache.load_matrices(4)
+
+    """
+
+    # Increase when the layout of the files or the way they are generated changes
+    version = 3
+
+    def __init__(self, cache_dir: str, bam_file: str, coverage_file: str, mbias_read1_5=None, mbias_read1_3=None,
+                 mbias_read2_5=None, mbias_read2_3=None, bin_size=100, sample_limit=None, seed=None, sampling=None):
+        """
+        :param cache_dir: folder holding one sub folder per cache entry
+        :param bam_file: path to the bam file training matrices are extracted from
+        :param coverage_file: path to the clubcpg-coverage output bins are sampled from
+        :param bin_size: size of the bins in bp
+        :param sample_limit: maximum number of bins per density
+        :param seed: random seed used for sampling bins and masks, None if unseeded
+        :param sampling: optional dict of further settings deciding which bins are sampled, for example
+            :meth:`clubcpg.CoverageSampler.CoverageSampler.describe`
+        """
+        self.key = {
+            "version": self.version,
+            "bam_file": self._identify(bam_file),
+            "coverage_file": self._identify(coverage_file),
+            "mbias": [mbias_read1_5, mbias_read1_3, mbias_read2_5, mbias_read2_3],
+            "bin_size": int(bin_size),
+            "sample_limit": sample_limit,
+            "seed": seed,
+            "sampling": sampling,
+        }
+        digest = hashlib.sha1(json.dumps(self.key, sort_keys=True).encode()).hexdigest()[:16]
+        self.folder = os.path.join(cache_dir, digest)
+
+    @staticmethod
+    def _identify(path):
+        """
+        :return: list of the resolved path, size in bytes and modification time in ns of an input file
+        """
+        stat = os.stat(path)
+        return [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+
+    def _path(self, cpg_density, name):
+        return os.path.join(self.folder, "{}_cpgs.{}.npy".format(cpg_density, name))
+
+    def _save(self, cpg_density, arrays: dict):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, "key.json"), "w") as key_file:
+            json.dump(self.key, key_file, indent=2)
+        # Write to a temporary file first, an interrupted run must not leave a truncated entry behind
+        for name, array in arrays.items():
+            path = self._path(cpg_density, name)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(path + ".tmp", path)
+
+    def _load(self, cpg_density, name):
+        return np.load(self._path(cpg_density, name), mmap_mode="r")
+
+    def invalidate(self):
+        """
+        Delete everything cached for this key
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def has_matrices(self, cpg_density: int):
+        return all(os.path.exists(self._path(cpg_density, name)) for name in ("data", "offsets", "bins"))
+
+    def save_matrices(self, cpg_density: int, matrices: RaggedMatrices):
+        """
+        :param cpg_density: Number of CpGs
+        :param matrices: training matrices of the density, with their bins
+        """
+        bins = matrices.bins if matrices.bins is not None else []
+        self._save(cpg_density, {"data": matrices.data, "offsets": matrices.offsets,
+                                 "bins": np.asarray(bins, dtype=str)})
+
+    def load_matrices(self, cpg_density: int):
+        """
+        :return: :class:`clubcpg_prelim.RaggedMatrices` of the density, or None if it is not cached
+        """
+        if not self.has_matrices(cpg_density):
+            return None
+        bins = self._load(cpg_density, "bins")
+        return RaggedMatrices(self._load(cpg_density, "data"), self._load(cpg_density, "offsets"),
+                              bins if len(bins) else None)
+
+    def has_features(self, cpg_density: int):
+        return all(os.path.exists(self._path(cpg_density, name)) for name in ("X", "y"))
+
+    def save_features(self, cpg_density: int, X, y):
+        """
+        :param cpg_density: Number of CpGs
+        :param X: training feature vectors, as returned by :meth:`clubcpg_prelim.PReLIM.get_X_y`
+        :param y: labels of the feature vectors
+        """
+        self._save(cpg_density, {"X": X, "y": y})
+
+    def load_features(self, cpg_density: int):
+        """
+        :return: tuple of (X, y) of the density, or None if it is not cached
+        """
+        if not self.has_features(cpg_density):
+            return None
+        return self._load(cpg_density, "X"), self._load(cpg_density, "y")
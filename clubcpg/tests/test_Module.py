@@ -1,15 +1,36 @@
 import unittest
 from clubcpg import ParseBam
 from clubcpg.CalculateBinCoverage import CalculateCompleteBins
-from clubcpg.ClusterReads import ClusterReads
+from clubcpg.ClusterReads import ClusterReads, ClusterReadsWithImputation
+from clubcpg.RunPipeline import RunPipeline
+from clubcpg.DensityScheduler import DensityScheduler
+from clubcpg.Pipeline import map_in_batches
 from clubcpg.Imputation import Imputation
-from clubcpg_prelim import PReLIM
+from clubcpg.ModelRegistry import ModelRegistry
+from clubcpg.ConnectToCpGNet import TrainAllDensities
+from clubcpg.TrainingSetCache import TrainingSetCache
+from clubcpg.CoverageSampler import CoverageSampler
+from clubcpg.CoverageFilter import filter_coverage, read_coverage
+from clubcpg.IntervalIndex import IntervalIndex
+from clubcpg.Sharding import parse_shard, shard_tag, select_shard, iter_shard, merge_shards
+from clubcpg import ClusterTable
+from clubcpg.ClusterTable import ClusterTableWriter, read_cluster_table, encode_pattern, decode_pattern, \
+    parse_line
+from clubcpg.IndexedOutput import index_output, IndexedOutput
+from clubcpg_prelim import PReLIM, RaggedMatrices, CompactForest, PredictionCache
+from clubcpg_prelim.PReLIM import CpGBin
 import os
+import shutil
+import tempfile
+import time
 import pandas as pd
 import numpy as np
 from urllib.request import urlretrieve
 from sklearn.cluster import DBSCAN
-from joblib import load
+from sklearn.ensemble import RandomForestClassifier
+from joblib import load, dump
+from pebble import ProcessPool
+import pysam
 
 
 user_home = os.path.expanduser("~")
@@ -46,6 +67,43 @@ test_bin_bad = "chr1_500"
 prelim_model = "TEST_MODEL.prelim"
 
 
+def double_or_hang(item):
+    # Worker function for TestMapInBatches, needs to be importable by the pool
+    if item == "hang":
+        time.sleep(30)
+    if item == "fail":
+        raise ValueError("bad item")
+    return item * 2
+
+
+def fallback_bin(bin_):
+    # Fallback for TestDensityScheduler, needs to be importable by the pool
+    return "clustered " + bin_
+
+
+def write_bam(path: str, reads: list, chromosome="chr1", length=10000):
+    """
+    Write a small coordinate sorted and indexed bam file of bismark style single end reads
+
+    :param reads: list of tuples of (start, dict of CpG position -> "Z" or "z"), every read is 60 bp long
+    """
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": chromosome, "LN": length}]}
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for k, (start, calls) in enumerate(sorted(reads, key=lambda x: x[0])):
+            read = pysam.AlignedSegment()
+            read.query_name = "read{}".format(k)
+            read.query_sequence = "A" * 60
+            read.flag = 0
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 42
+            read.cigarstring = "60M"
+            read.query_qualities = pysam.qualitystring_to_array("I" * 60)
+            read.set_tag("XM", "".join(calls.get(start + i, ".") for i in range(60)))
+            bam.write(read)
+    pysam.index(path)
+
+
 class TestTests(unittest.TestCase):
     """
     Test that tests are even working correctly
@@ -79,6 +137,24 @@ class TestParseBam(unittest.TestCase):
         self.assertEqual(matrix.shape, (113, 4), "Dataframe fails to be expected shape")
 
 
+class TestPrefetch(unittest.TestCase):
+    """
+    Test reads prefetched for a window parse like reads fetched per bin
+    """
+
+    def setUp(self):
+        self.required_data = [bamA]
+        check_data_exists(self.required_data)
+        self.parser = ParseBam.BamFileReadParser(os.path.join(test_data_location, bamA), 20)
+        self.prefetched = ParseBam.BamFileReadParser(os.path.join(test_data_location, bamA), 20)
+        self.prefetched.prefetch("chr1", 910000, 911500)
+
+    def testSameReads(self):
+        for stop in range(910100, 911600, 100):
+            self.assertEqual(self.prefetched.parse_reads("chr1", stop - 100, stop),
+                             self.parser.parse_reads("chr1", stop - 100, stop))
+
+
 class TestCoverageCalculation(unittest.TestCase):
     """
     Test the features within the CoverageCalculation classes
@@ -102,6 +178,12 @@ class TestCoverageCalculation(unittest.TestCase):
         self.assertIsNone(bad_result, "empty bin shouldn't have returned data")
         self.assertEqual(matrix.shape, (21, 4), "Failed to calculate correct number of reads and CpGs in matrix")
 
+    def testCoverageCalcKeepUnknowns(self):
+        b, matrix, unknowns = self.calc.calculate_bin_coverage(test_bin, keep_unknowns=True)
+        self.assertEqual(unknowns.dtype, np.int8)
+        self.assertEqual(unknowns.shape[1], matrix.shape[1])
+        self.assertEqual((unknowns != -1).all(axis=1).sum(), matrix.shape[0])
+
 
 class TestClustering(unittest.TestCase):
     """
@@ -148,6 +230,802 @@ class TestClustering(unittest.TestCase):
         self.assertEqual(len(self.cluster.get_unique_matrices(self.filtered)), 2, "Failed to get unique matrices")
 
 
+class TestRunPipeline(unittest.TestCase):
+    """
+    Test the one pass pipeline clusters a bin like clubcpg-cluster
+    """
+
+    def setUp(self):
+        self.required_data = [bamA, bamB]
+        check_data_exists(self.required_data)
+        bam_a = os.path.join(test_data_location, bamA)
+        bam_b = os.path.join(test_data_location, bamB)
+        self.run = RunPipeline(bam_a, bam_b, read_depth_req=10)
+        self.cluster = ClusterReads(bam_a, bam_b, read_depth_req=10)
+
+    def testProcessBin(self):
+        coverage, lines = self.run.process_bin(test_bin)
+        self.assertEqual(coverage, (test_bin, 21, 4))
+        self.assertEqual(lines, self.cluster.process_bins(test_bin))
+
+    def testFilteredBin(self):
+        self.run.min_cpgs = 5
+        coverage, lines = self.run.process_bin(test_bin)
+        self.assertEqual(coverage, (test_bin, 21, 4))
+        self.assertIsNone(lines)
+        self.assertEqual(self.run.process_bin(test_bin_bad), (None, None))
+
+
+class TestImputationPruning(unittest.TestCase):
+    """
+    Test bins are pruned before imputation when they cannot reach read depth
+    """
+
+    def setUp(self):
+        self.cluster = ClusterReadsWithImputation(bamA, bamB, bins_file=TEST_BINS, read_depth_req=3)
+        deep = np.array([[1, -1], [0, 1], [1, 1], [-1, 0]], dtype='int8')
+        shallow = np.array([[1, -1], [0, 1]], dtype='int8')
+        self.data_A = RaggedMatrices.from_matrices([deep, shallow, deep], ["chr1_100", "chr1_200", "chr1_300"])
+        self.data_B = RaggedMatrices.from_matrices([deep, deep, deep], ["chr1_400", "chr1_200", "chr1_100"])
+
+    def testPruning(self):
+        pruned_A, pruned_B = self.cluster.prune_unreachable_bins([self.data_A, self.data_B])
+        self.assertEqual(list(pruned_A.bins), ["chr1_100"])
+        self.assertEqual(list(pruned_B.bins), ["chr1_100"])
+        np.testing.assert_array_equal(pruned_B[0], np.array([[1, -1], [0, 1], [1, 1], [-1, 0]]))
+        stats = self.cluster.pruning_stats
+        self.assertEqual(stats['bins_considered'], 3)
+        self.assertEqual(stats['bins_pruned_depth'], 1)
+        self.assertEqual(stats['bins_pruned_missing_pair'], 1)
+        self.assertEqual(stats['matrices_skipped'], 4)
+        self.assertEqual(stats['cells_skipped'], 7)
+
+
+class TestPostprocessPredictions(unittest.TestCase):
+    """
+    Test imputed values are called with configurable thresholds
+    """
+
+    def setUp(self):
+        self.predicted = np.array([[1, 0.1, 0.5], [0.85, 0, 0.3]])
+
+    def testDefaultThresholds(self):
+        processed = Imputation.postprocess_predictions(self.predicted)
+        expected = np.array([[1, 0, np.nan], [1, 0, np.nan]])
+        np.testing.assert_array_equal(processed, expected)
+
+    def testCustomThresholds(self):
+        processed = Imputation.postprocess_predictions(self.predicted, low_threshold=0.3, high_threshold=0.9)
+        expected = np.array([[1, 0, np.nan], [np.nan, 0, 0]])
+        np.testing.assert_array_equal(processed, expected)
+
+    def testBoundaries(self):
+        # Thresholds are inclusive, observed 0s and 1s are kept whatever the thresholds
+        predicted = np.array([[0.2, 0.8, 0.2000001, 0.7999999], [0, 1, 0.5, np.nan]])
+        processed = Imputation.postprocess_predictions(predicted)
+        np.testing.assert_array_equal(processed, [[0, 1, np.nan, np.nan], [0, 1, np.nan, np.nan]])
+        processed = Imputation.postprocess_predictions(predicted, low_threshold=0.5, high_threshold=0.5)
+        np.testing.assert_array_equal(processed, [[0, 1, 0, 1], [0, 1, 0, np.nan]])
+
+
+class TestRaggedMatrices(unittest.TestCase):
+    """
+    Test the concatenated matrix container
+    """
+
+    def setUp(self):
+        self.matrices = [np.array([[1, 0, -1]]), np.array([[0, 0, 1], [1, -1, 1], [1, 1, 1]]), np.zeros((2, 3))]
+        self.ragged = RaggedMatrices.from_matrices(self.matrices, ["chr1_100", "chr1_200", "chr1_300"])
+
+    def testLayout(self):
+        self.assertEqual(len(self.ragged), 3)
+        self.assertEqual(self.ragged.data.shape, (6, 3))
+        self.assertEqual(self.ragged.data.dtype, np.int8)
+        self.assertEqual(list(self.ragged.offsets), [0, 1, 4, 6])
+        for original, stored in zip(self.matrices, self.ragged):
+            np.testing.assert_array_equal(original, stored)
+
+    def testSubset(self):
+        subset = self.ragged.subset([2, 0])
+        self.assertEqual(list(subset.bins), ["chr1_300", "chr1_100"])
+        np.testing.assert_array_equal(subset[0], self.matrices[2])
+        np.testing.assert_array_equal(subset[1], self.matrices[0])
+
+
+class TestPReLIMFeatures(unittest.TestCase):
+    """
+    Test the vectorized feature construction matches the original loops bit for bit
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.prelim = PReLIM(4)
+        self.matrices = []
+        for _ in range(50):
+            m = rng.choice([0.0, 1.0], size=(rng.randint(1, 30), 4))
+            m[rng.rand(*m.shape) < 0.3] = -1
+            # extracted matrices never contain reads without any known state
+            m = m[(m != -1).any(axis=1)]
+            if m.shape[0] > 0:
+                self.matrices.append(m)
+
+    def testImputationFeatures(self):
+        for m in self.matrices:
+            loop = self.prelim._get_imputation_features_loop(m)
+            vectorized = self.prelim._get_imputation_features(m)
+            self.assertEqual(len(loop), len(vectorized))
+            if len(loop) > 0:
+                self.assertEqual(loop.astype(np.float32).tobytes(), vectorized.tobytes())
+
+    def testTrainingFeatures(self):
+        bins = []
+        for m in self.matrices:
+            truth = np.where(m == -1, 1.0, m)
+            mybin = CpGBin(matrix=truth)
+            mybin.tag2 = {"truth": truth, "observed": m, "mask": None}
+            bins.append(mybin)
+        X_loop, y_loop = self.prelim._collectFeatures_loop(bins)
+        X, y = self.prelim._collectFeatures(bins)
+        self.assertEqual(X_loop.astype(np.float32).tobytes(), X.tobytes())
+        np.testing.assert_array_equal(y_loop, y)
+
+    def testTrainingSet(self):
+        # one mask per read depth, so both generators produce the same rows in a different order
+        rng = np.random.RandomState(0)
+        matrices = []
+        for depth in range(1, 9):
+            mask = (rng.rand(depth, 4) < 0.5).astype(float)
+            mask[0, 1] = -1
+            matrices.append(mask)
+            matrices.extend((rng.rand(depth, 4) < 0.5).astype(float) for _ in range(5))
+
+        def sorted_rows(X, y):
+            rows = np.column_stack([X, y])
+            rows[np.isnan(rows)] = -9
+            return rows[np.lexsort(rows.T[::-1])]
+
+        X_loop, y_loop = self.prelim._get_X_y_loop(matrices)
+        X, y = self.prelim.get_X_y(matrices, random_state=0)
+        np.testing.assert_array_equal(sorted_rows(X_loop, y_loop), sorted_rows(X, y))
+
+
+class TestCompactForest(unittest.TestCase):
+    """
+    Test the compact forest gives the same probabilities as sklearn
+    """
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        X = random_state.rand(500, 6).astype(np.float32)
+        y = (X[:, 0] + 0.5 * random_state.rand(500) > 0.7).astype(float)
+        self.forest = RandomForestClassifier(n_estimators=20, max_depth=8, random_state=0).fit(X, y)
+        self.compact = CompactForest.from_estimator(self.forest)
+        self.X_test = random_state.rand(300, 6).astype(np.float32)
+
+    def testProbabilities(self):
+        self.assertTrue(np.array_equal(self.compact.predict_proba(self.X_test), self.forest.predict_proba(self.X_test)))
+        self.assertTrue(np.array_equal(self.compact.predict(self.X_test), self.forest.predict(self.X_test)))
+
+    def testRejectsNaN(self):
+        X = self.X_test.copy()
+        X[3, 2] = np.nan
+        with self.assertRaises(ValueError):
+            self.compact.predict_proba(X)
+        with self.assertRaises(ValueError):
+            self.compact.predict_proba(self.X_test[:, :5])
+
+
+class TestPredictionCache(unittest.TestCase):
+    """
+    Test repeated feature vectors are predicted once
+    """
+
+    def setUp(self):
+        self.cache = PredictionCache(max_size=2)
+        self.X = np.array([[0, 1], [1, 1], [0, 1], [0, 1]], dtype=np.float32)
+        self.predicted_rows = []
+
+    def predict(self, X):
+        self.predicted_rows.append(len(X))
+        return X.sum(axis=1)
+
+    def testDeduplication(self):
+        np.testing.assert_array_equal(self.cache.predict(self.predict, self.X), [1, 2, 1, 1])
+        np.testing.assert_array_equal(self.cache.predict(self.predict, self.X[:1]), [1])
+        self.assertEqual(self.predicted_rows, [2])
+        self.assertEqual(self.cache.rows, 5)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertAlmostEqual(self.cache.hit_rate(), 0.6)
+
+
+class TestTrainAllDensities(unittest.TestCase):
+    """
+    Test models of several densities are trained concurrently and saved
+    """
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.matrices = dict()
+        for density in (2, 3):
+            matrices = [(random_state.rand(10, density) < 0.8).astype(np.int8) for _ in range(100)]
+            for matrix in matrices[::3]:
+                matrix[0, 0] = -1
+            self.matrices[density] = RaggedMatrices.from_matrices(matrices)
+        self.models_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.models_folder)
+
+    def testTraining(self):
+        trainer = TrainAllDensities(self.models_folder, cores=2,
+                                    fit_params={"n_estimators": [5], "max_depths": [2]})
+        model_files = trainer.train(self.matrices)
+        self.assertEqual(sorted(model_files.keys()), [2, 3])
+        for density in (2, 3):
+            self.assertTrue(os.path.exists(ModelRegistry.model_path(self.models_folder, density)))
+            self.assertTrue(os.path.exists(ModelRegistry.compact_model_path(self.models_folder, density)))
+
+
+class TestHalvingSearch(unittest.TestCase):
+    """
+    Test successive halving chooses parameters from the grid and reports them
+    """
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.X = random_state.rand(300, 4)
+        self.y = (self.X[:, 0] + 0.2 * random_state.rand(300) > 0.6).astype(float)
+        self.prelim = PReLIM(2)
+
+    def testSearch(self):
+        self.prelim.fit(self.X, self.y, n_estimators=[2, 4, 8], max_depths=[1, 3, 5], model_file="no",
+                        search="halving")
+        summary = self.prelim.search_summary
+        self.assertEqual(summary["search"], "halving")
+        self.assertIn(summary["best_params"]["n_estimators"], [2, 4, 8])
+        self.assertIn(summary["best_params"]["max_depth"], [1, 3, 5])
+        self.assertEqual(self.prelim.model.n_estimators, summary["best_params"]["n_estimators"])
+
+
+class TestTrainingSetCache(unittest.TestCase):
+    """
+    Test training data is cached per set of inputs
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.bam_file = os.path.join(self.folder, "input.bam")
+        self.coverage_file = os.path.join(self.folder, "coverage.csv")
+        for path in (self.bam_file, self.coverage_file):
+            with open(path, "w") as f:
+                f.write("data")
+        self.cache = TrainingSetCache(os.path.join(self.folder, "cache"), self.bam_file, self.coverage_file,
+                                      sample_limit=100, seed=1)
+        self.matrices = RaggedMatrices.from_matrices([np.ones((2, 3)), -np.ones((1, 3))], ["chr1_100", "chr1_200"])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testRoundTrip(self):
+        self.assertIsNone(self.cache.load_matrices(3))
+        self.cache.save_matrices(3, self.matrices)
+        self.cache.save_features(3, np.zeros((4, 2), dtype=np.float32), np.ones(4))
+        cached = self.cache.load_matrices(3)
+        np.testing.assert_array_equal(cached.data, self.matrices.data)
+        self.assertEqual(list(cached.bins), ["chr1_100", "chr1_200"])
+        X, y = self.cache.load_features(3)
+        self.assertEqual(X.shape, (4, 2))
+
+    def testKey(self):
+        self.cache.save_matrices(3, self.matrices)
+        other_seed = TrainingSetCache(os.path.join(self.folder, "cache"), self.bam_file, self.coverage_file,
+                                      sample_limit=100, seed=2)
+        self.assertFalse(other_seed.has_matrices(3))
+        self.cache.invalidate()
+        self.assertFalse(self.cache.has_matrices(3))
+
+    def testInputChanged(self):
+        self.cache.save_matrices(3, self.matrices)
+        with open(self.coverage_file, "w") as f:
+            f.write("other data")
+        changed = TrainingSetCache(os.path.join(self.folder, "cache"), self.bam_file, self.coverage_file,
+                                   sample_limit=100, seed=1)
+        self.assertNotEqual(changed.folder, self.cache.folder)
+        self.assertFalse(changed.has_matrices(3))
+
+        # Same size, only the modification time differs
+        stat = os.stat(self.bam_file)
+        os.utime(self.bam_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        touched = TrainingSetCache(os.path.join(self.folder, "cache"), self.bam_file, self.coverage_file,
+                                   sample_limit=100, seed=1)
+        self.assertNotEqual(touched.folder, changed.folder)
+
+
+class TestCoverageFilter(unittest.TestCase):
+    """
+    Test coverage files are filtered and merged like the awk one-liner
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.coverage_files = [os.path.join(self.folder, "CompleteBins.{}.csv".format(c)) for c in ("chr1", "chr2")]
+        for coverage_file, chromosome in zip(self.coverage_files, ("chr1", "chr2")):
+            with open(coverage_file, "w") as f:
+                f.write("{0}_100,12,2\n{0}_200,9,3\n{0}_300,30,1\n{0}_400,10,4\n".format(chromosome))
+        self.bed_file = os.path.join(self.folder, "regions.bed")
+        with open(self.bed_file, "w") as f:
+            f.write("chr1\t350\t360\nchr1\t0\t50\nchr1\t20\t100\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testFilterAndMerge(self):
+        output_file = os.path.join(self.folder, "filtered.csv")
+        self.assertEqual(filter_coverage(self.coverage_files, output_file, min_reads=10, min_cpgs=2), 4)
+        with open(output_file) as f:
+            self.assertEqual(f.read().split(), ["chr1_100,12,2", "chr1_400,10,4", "chr2_100,12,2", "chr2_400,10,4"])
+
+    def testRegions(self):
+        regions = IntervalIndex.from_bed(self.bed_file)
+        self.assertEqual(regions["chr1"], ([0, 350], [100, 360]))
+        self.assertTrue(regions.bin_overlaps("chr1", 100))
+        self.assertFalse(regions.bin_overlaps("chr1", 200))
+        self.assertTrue(regions.bin_overlaps("chr1", 400))
+        self.assertFalse(regions.bin_overlaps("chr2", 100))
+
+        output_file = os.path.join(self.folder, "filtered.csv")
+        filter_coverage(self.coverage_files, output_file, chromosomes=["chr1"], bed_file=self.bed_file)
+        with open(output_file) as f:
+            self.assertEqual(f.read().split(), ["chr1_100,12,2", "chr1_400,10,4"])
+
+
+class TestImputedCoverage(unittest.TestCase):
+    """
+    Test coverage written by clubcpg-coverage with models, which has a fourth imputed_reads column, can be read by
+    everything reading coverage files
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.coverage_file = os.path.join(self.folder, "CompleteBins.chr1.csv")
+        with open(self.coverage_file, "w") as f:
+            f.write("chr1_100,4,2,12\nchr1_200,9,3,9\nchr1_300,30,7,30\nchr1_400,2,2,10\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testReadCoverage(self):
+        coverage = read_coverage(self.coverage_file)
+        self.assertEqual(list(coverage.columns), ["bin", "reads", "cpgs", "imputed_reads"])
+        self.assertEqual(coverage["bin"].tolist(), ["chr1_100", "chr1_200", "chr1_300", "chr1_400"])
+        self.assertEqual(coverage["imputed_reads"].tolist(), [12, 9, 30, 10])
+
+        cluster = ClusterReadsWithImputation("A.bam", "B.bam", bins_file=self.coverage_file)
+        coverage_data = cluster.get_coverage_data()
+        self.assertEqual(coverage_data["reads"].tolist(), [4, 9, 30, 2])
+        self.assertEqual(coverage_data["cpgs"].tolist(), [2, 3, 7, 2])
+
+    def testUseImputed(self):
+        output_file = os.path.join(self.folder, "filtered.csv")
+        self.assertEqual(filter_coverage(self.coverage_file, output_file, min_reads=10), 1)
+        self.assertEqual(filter_coverage(self.coverage_file, output_file, min_reads=10, use_imputed=True), 3)
+        with open(output_file) as f:
+            self.assertEqual(f.read().split(), ["chr1_100,4,2,12", "chr1_300,30,7,30", "chr1_400,2,2,10"])
+
+        three_columns = os.path.join(self.folder, "CompleteBins.chr2.csv")
+        with open(three_columns, "w") as f:
+            f.write("chr2_100,4,2\n")
+        with self.assertRaises(ValueError):
+            filter_coverage(three_columns, output_file, min_reads=10, use_imputed=True)
+
+    def testSample(self):
+        sampler = CoverageSampler(densities=[2], sample_limit=5, chunksize=2, random_state=0)
+        bins = sampler.sample(self.coverage_file)
+        self.assertEqual(list(bins.columns), ["bin", "reads", "cpgs"])
+        self.assertEqual(sorted(bins["bin"]), ["chr1_100", "chr1_400"])
+        self.assertEqual(sorted(bins["reads"]), [2, 4])
+
+    def testImputeCoverage(self):
+        # No bin has a density with a model, so every bin keeps its counts and no bam file or model is read
+        output_file = os.path.join(self.folder, "imputed.csv")
+        imputer = Imputation(4, "A.bam", processes=1)
+        imputer.impute_coverage(self.coverage_file, self.folder, output_file, densities=[4], chunksize=2)
+        with open(output_file) as f:
+            self.assertEqual(f.read().split(), ["chr1_100,4,2", "chr1_200,9,3", "chr1_300,30,7", "chr1_400,2,2"])
+
+
+class TestIntervalIndex(unittest.TestCase):
+    """
+    Test target regions are merged, padded and turned into windows of bins
+    """
+
+    def setUp(self):
+        self.index = IntervalIndex({"chr1": [(250, 260), (0, 50), (20, 100), (430, 450)], "chr2": [(5, 6)]})
+
+    def testMerged(self):
+        self.assertEqual(self.index["chr1"], ([0, 250, 430], [100, 260, 450]))
+        self.assertEqual(IntervalIndex({"chr1": [(250, 260), (430, 450)]}, padding=100)["chr1"], ([150], [550]))
+        self.assertEqual(self.index.total_length(), 131)
+
+    def testBinIntervals(self):
+        windows = self.index.bin_intervals(100)
+        self.assertEqual(windows, [("chr1", 0, 100, ["chr1_100"]), ("chr1", 200, 300, ["chr1_300"]),
+                                   ("chr1", 400, 500, ["chr1_500"]), ("chr2", 0, 100, ["chr2_100"])])
+        padded = IntervalIndex({"chr1": [(250, 260), (430, 450)]}, padding=100)
+        self.assertEqual(padded.bin_intervals(100, max_bins=3),
+                         [("chr1", 100, 400, ["chr1_200", "chr1_300", "chr1_400"]), ("chr1", 400, 600, ["chr1_500", "chr1_600"])])
+        self.assertEqual(self.index.bin_intervals(100, {"chr1": 420}), windows[:3])
+
+    def testGroupBins(self):
+        groups = list(self.index.group_bins(["chr1_100", "chr1_200", "chr1_300", "chr2_100", "chr3_100"]))
+        self.assertEqual(groups, [("chr1", 0, 100, ["chr1_100"]), ("chr1", 200, 300, ["chr1_300"]),
+                                  ("chr2", 0, 100, ["chr2_100"])])
+
+
+class TestSharding(unittest.TestCase):
+    """
+    Test bins are split into contiguous balanced shards and the shard outputs merged back in order
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testParseShard(self):
+        self.assertEqual(parse_shard("3/8"), (3, 8))
+        self.assertEqual(shard_tag((3, 8)), ".shard3of8")
+        for text in ["0/8", "9/8", "3", "a/b"]:
+            with self.assertRaises(ValueError):
+                parse_shard(text)
+
+    def testSelectShard(self):
+        items = list(range(100))
+        costs = [100 if k < 10 else 1 for k in items]
+        shards = [select_shard(items, costs, (i, 4)) for i in range(1, 5)]
+        # Every item is in exactly one shard, in order, and the expensive items are spread out
+        self.assertEqual([item for shard in shards for item in shard], items)
+        self.assertTrue(all(len(shard) <= 5 for shard in shards[:2]))
+        streamed = [list(iter_shard(lambda: iter(items), lambda k: costs[k], (i, 4))) for i in range(1, 5)]
+        self.assertEqual(streamed, shards)
+
+    def testShardBinIds(self):
+        # A bins file of bin ids only is split by bin count
+        bins_file = os.path.join(self.folder, "bins.csv")
+        bins = ["chr1_{}".format(100 * k) for k in range(1, 9)]
+        with open(bins_file, "w") as f:
+            f.write("\n".join(bins) + "\n")
+        shards = [list(ClusterReads(bam_a=None, bins_file=bins_file, shard=(i, 2))._shard_bins()) for i in (1, 2)]
+        self.assertEqual(shards, [bins[:4], bins[4:]])
+
+    def testMergeShards(self):
+        files = []
+        for i in range(1, 4):
+            path = os.path.join(self.folder, "Clustering.A.bam.shard{}of3.csv".format(i))
+            with open(path, "w") as f:
+                f.write("bin,input_label\nchr1_{}00,A\n".format(i))
+            files.append(path)
+        output_file = os.path.join(self.folder, "merged.csv")
+
+        self.assertEqual(merge_shards(files[::-1], output_file), 3)
+        with open(output_file) as f:
+            self.assertEqual(f.read(), "bin,input_label\nchr1_100,A\nchr1_200,A\nchr1_300,A\n")
+        with self.assertRaises(ValueError):
+            merge_shards(files[:2], output_file)
+
+
+class TestClusterTable(unittest.TestCase):
+    """
+    Test cluster output lines survive a round trip through the columnar formats
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.lines = ["chr19_3079800,A,0.5,0,7,2,0;1,A=7", "chr19_3079800,AB,1.0,1,10,2,1;1,A=3;B=7",
+                      "chrUn_gl000220_3100,B,0.25,-1,4,4,0;0;1;0,B=4"]
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testPattern(self):
+        self.assertEqual(encode_pattern("1;0;1;1"), 13)
+        self.assertEqual(decode_pattern(13, 5), "1;0;1;1;0")
+
+    def roundTrip(self, output_format):
+        with ClusterTableWriter(os.path.join(self.folder, "clusters"), output_format, row_group_size=2) as writer:
+            writer.write_lines(self.lines)
+        self.assertTrue(writer.path.endswith("." + output_format))
+        self.assertEqual(writer.row_groups, 2)
+
+        clusters = read_cluster_table(writer.path, decode_patterns=True)
+        self.assertEqual(clusters["chromosome"].tolist(), ["chr19", "chr19", "chrUn_gl000220"])
+        self.assertEqual(clusters["cpg_pattern"].tolist(), ["0;1", "1;1", "0;0;1;0"])
+        self.assertEqual(clusters["reads_B"].tolist(), [0, 7, 4])
+        self.assertEqual(clusters["class_label"].dtype, np.int16)
+
+        with ClusterTableWriter(os.path.join(self.folder, "clusters"), "csv") as writer:
+            writer.write_frame(read_cluster_table(writer.path[:-4] + "." + output_format))
+        with open(writer.path) as f:
+            self.assertEqual(f.read().splitlines()[1:], self.lines)
+
+    def testNpz(self):
+        self.roundTrip("npz")
+
+    @unittest.skipIf(ClusterTable.pa is None, "pyarrow is not installed")
+    def testParquet(self):
+        self.roundTrip("parquet")
+
+    def testWideBin(self):
+        # Bins of more than 64 CpGs do not fit into the packed pattern and keep it as a string
+        wide = ";".join(["1", "0", "0"] * 30)
+        self.lines.append("chr19_3080000,A,0.3333,0,5,90,{},A=5".format(wide))
+        with self.assertRaises(ValueError):
+            encode_pattern(wide)
+        self.assertEqual(parse_line(self.lines[-1])[7:9], (0, wide))
+
+        for output_format in ("npz", "parquet") if ClusterTable.pa is not None else ("npz",):
+            with ClusterTableWriter(os.path.join(self.folder, "clusters"), output_format) as writer:
+                writer.write_lines(self.lines)
+            clusters = read_cluster_table(writer.path, columns=["bin_end"], decode_patterns=True)
+            self.assertEqual(clusters["cpg_pattern"].tolist(), ["0;1", "1;1", "0;0;1;0", wide])
+
+            with ClusterTableWriter(os.path.join(self.folder, "clusters"), "csv") as writer:
+                writer.write_frame(read_cluster_table(writer.path[:-4] + "." + output_format))
+            with open(writer.path) as f:
+                self.assertEqual(f.read().splitlines()[1:], self.lines)
+
+
+class TestIndexedOutput(unittest.TestCase):
+    """
+    Test outputs are sorted, compressed and indexed and regions read back from them
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testCoverage(self):
+        coverage_file = os.path.join(self.folder, "coverage.csv")
+        with open(coverage_file, "w") as f:
+            f.write("chr2_100,12,3\nchr2_500,4,2\nchr1_300,7,5\n")
+
+        indexed_file = index_output(coverage_file, keep_original=False)
+        self.assertFalse(os.path.exists(coverage_file))
+        self.assertTrue(os.path.exists(indexed_file + ".tbi"))
+        with IndexedOutput(indexed_file) as coverage:
+            self.assertEqual(coverage.columns, ["bin", "reads", "cpgs"])
+            self.assertEqual(coverage.query("chr2:50-350")["bin"].tolist(), ["chr2_100"])
+            self.assertEqual(coverage.query("chr2", 399, 401)["reads"].tolist(), [4])
+            self.assertTrue(coverage.query("chr3").empty)
+
+    def testUnsortedClusters(self):
+        cluster_file = os.path.join(self.folder, "clusters.csv")
+        with open(cluster_file, "w") as f:
+            f.write(ClusterTable.HEADER + "\n")
+            f.write("chr1_300,A,0.5,0,7,2,0;1,A=7\nchr1_100,AB,1.0,1,10,2,1;1,A=3;B=7\nchr1_100,B,0.0,2,5,2,0;0,B=5\n")
+
+        with IndexedOutput(index_output(cluster_file)) as clusters:
+            records = clusters.query("chr1")
+            self.assertEqual(records["bin"].tolist(), ["chr1_100", "chr1_100", "chr1_300"])
+            self.assertEqual(records["class_split"].tolist()[0], "A=3;B=7")
+
+
+class TestCoverageSampler(unittest.TestCase):
+    """
+    Test training bins are sampled from the coverage file without replacement
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.coverage_file = os.path.join(self.folder, "coverage.csv")
+        chromosomes = ["chr1"] * 90 + ["chr2"] * 30
+        coverage = pd.DataFrame({"bin": ["{}_{}".format(c, 100 * (i + 1)) for i, c in enumerate(chromosomes)],
+                                 "reads": np.arange(120) % 40, "cpgs": [2, 3, 7] * 40})
+        coverage.to_csv(self.coverage_file, header=False, index=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testSample(self):
+        sampler = CoverageSampler(densities=[2, 3], sample_limit=20, chunksize=25, random_state=0)
+        bins = sampler.sample(self.coverage_file)
+        self.assertTrue(bins["bin"].is_unique)
+        self.assertEqual(bins.groupby("cpgs").size().to_dict(), {2: 20, 3: 20})
+
+    def testStratified(self):
+        sampler = CoverageSampler(densities=[2], sample_limit=20, stratify_chromosome=True, chunksize=25,
+                                  random_state=0)
+        bins = sampler.sample(self.coverage_file)
+        self.assertEqual(bins["bin"].str.startswith("chr1_").sum(), 15)
+        self.assertEqual(bins["bin"].str.startswith("chr2_").sum(), 5)
+
+
+class TestModelRegistry(unittest.TestCase):
+    """
+    Test a model is loaded once and reused
+    """
+
+    def setUp(self):
+        self.required_data = [prelim_model]
+        check_data_exists(self.required_data)
+        self.models_folder = tempfile.mkdtemp()
+        shutil.copy(os.path.join(test_data_location, prelim_model), ModelRegistry.model_path(self.models_folder, 4))
+        self.registry = ModelRegistry()
+
+    def tearDown(self):
+        shutil.rmtree(self.models_folder)
+
+    def testLoadedOnce(self):
+        model = self.registry.get(self.models_folder, 4)
+        self.assertIs(self.registry.get(self.models_folder, 4), model)
+        self.assertEqual(len(self.registry.stats), 1)
+        self.assertFalse(hasattr(model.model, "best_estimator_"))
+
+
+class TestMapInBatches(unittest.TestCase):
+    """
+    Test batched pool tasks keep results in order and lose only the items which fail or time out
+    """
+
+    def setUp(self):
+        self.pool = ProcessPool(max_workers=2)
+
+    def tearDown(self):
+        self.pool.stop()
+        self.pool.join()
+
+    def testOrder(self):
+        results = map_in_batches(self.pool, double_or_hang, range(10), batch_size=3, timeout=None)
+        self.assertEqual(results, [2 * k for k in range(10)])
+
+    def testFailedItem(self):
+        results = map_in_batches(self.pool, double_or_hang, [1, "fail", 3], batch_size=2)
+        self.assertEqual(results, [2, None, 6])
+
+    def testTimeoutRetry(self):
+        # The batch holding the hanging item times out, its other items are retried one by one
+        start = time.time()
+        results = map_in_batches(self.pool, double_or_hang, [1, 2, "hang", 4, 5], batch_size=4, timeout=0.5)
+        self.assertEqual(results, [2, 4, None, 8, 10])
+        self.assertLess(time.time() - start, 20)
+
+
+class TestDensityScheduler(unittest.TestCase):
+    """
+    Test bins are extracted once and routed by CpG density, other densities go to the fallback
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.bam_file = os.path.join(self.folder, "input.bam")
+        # Bin chr1_200 has 2 CpGs, chr1_400 has 3 and chr1_600 has 6
+        densities = {100: [110, 130], 300: [310, 320, 330], 500: [505, 510, 515, 520, 525, 530]}
+        reads = []
+        for start, positions in densities.items():
+            for k in range(4):
+                reads.append((start + k, {p: "Z" if (p + k) % 2 else "z" for p in positions}))
+        write_bam(self.bam_file, reads)
+        self.coverage = pd.DataFrame({"bin": ["chr1_200", "chr1_400", "chr1_600"], "reads": [4, 4, 4],
+                                      "cpgs": [2, 3, 6]})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testRouting(self):
+        with DensityScheduler([self.bam_file, self.bam_file], densities=[2, 3], processes=1) as scheduler:
+            routed, other = scheduler.extract(self.coverage)
+        self.assertEqual(sorted(routed.keys()), [2, 3])
+        self.assertEqual(other, [])
+        for density, bin_ in ((2, "chr1_200"), (3, "chr1_400")):
+            # One container per bam file
+            self.assertEqual(len(routed[density]), 2)
+            for matrices in routed[density]:
+                self.assertEqual(list(matrices.bins), [bin_])
+                self.assertEqual(matrices[0].shape, (4, density))
+        np.testing.assert_array_equal(routed[2][0][0], [[0, 0], [1, 1], [0, 0], [1, 1]])
+
+    def testFallback(self):
+        scheduler = DensityScheduler([self.bam_file], densities=[2, 3], processes=1, fallback=fallback_bin)
+        routed, other = scheduler.extract(self.coverage)
+        self.assertEqual(other, [("chr1_600", "clustered chr1_600")])
+        self.assertEqual(list(routed[2][0].bins), ["chr1_200"])
+        self.assertEqual(list(routed[3][0].bins), ["chr1_400"])
+
+    def testCacheRoutedMatrices(self):
+        # clubcpg-impute-train caches the first bam file's matrices of each density as they are routed
+        cache = TrainingSetCache(os.path.join(self.folder, "cache"), self.bam_file, self.bam_file)
+        with DensityScheduler([self.bam_file], densities=[2, 3], processes=1) as scheduler:
+            routed, _ = scheduler.extract(self.coverage)
+        for density in (2, 3):
+            cache.save_matrices(density, routed[density][0])
+            cached = cache.load_matrices(density)
+            self.assertEqual(list(cached.bins), list(routed[density][0].bins))
+            np.testing.assert_array_equal(cached[0], routed[density][0][0])
+
+
+class TestBatchedImputation(unittest.TestCase):
+    """
+    Test imputing matrices in batches gives the same matrices as imputing them one by one
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        self.matrices = []
+        for _ in range(25):
+            m = rng.choice([0, 1], size=(rng.randint(2, 12), 3)).astype(np.int8)
+            # The first read and the first CpG stay known, so no feature is a mean over nothing
+            m[1:, 1:][rng.rand(m.shape[0] - 1, 2) < 0.4] = -1
+            self.matrices.append(m)
+
+        self.prelim = PReLIM(3)
+        X = np.concatenate([self.prelim._get_imputation_features(m.astype(float)) for m in self.matrices if -1 in m])
+        self.prelim.model = RandomForestClassifier(n_estimators=5, random_state=0).fit(
+            X.astype(np.float32), rng.randint(0, 2, len(X)))
+        self.models_folder = tempfile.mkdtemp()
+        dump(self.prelim.model, ModelRegistry.model_path(self.models_folder, 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.models_folder)
+
+    def testSameAsOneByOne(self):
+        imputer = Imputation(3, "input.bam")
+        batched = list(imputer.impute_from_model(self.models_folder, self.matrices, batch_size=4,
+                                                 registry=ModelRegistry()))
+        self.assertEqual(len(batched), len(self.matrices))
+        for m, imputed in zip(self.matrices, batched):
+            expected = m.astype(float)
+            if -1 in m:
+                expected = Imputation.postprocess_predictions(self.prelim.impute(expected))
+            np.testing.assert_array_equal(imputed, expected)
+
+
+class TestScatterPredictions(unittest.TestCase):
+    """
+    Test predictions are written back to the unknown cells of every matrix in row-major order
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.matrices = []
+        for _ in range(10):
+            m = rng.choice([0.0, 1.0], size=(rng.randint(2, 8), 3))
+            m[1:, 1:][rng.rand(m.shape[0] - 1, 2) < 0.5] = -1
+            self.matrices.append(m)
+        self.prelim = PReLIM(3)
+        X = np.concatenate([self.prelim._get_imputation_features_loop(m) for m in self.matrices if -1 in m])
+        self.prelim.model = RandomForestClassifier(n_estimators=5, random_state=0).fit(
+            X.astype(np.float32), rng.randint(0, 2, len(X)))
+
+    def reference(self, matrix):
+        if -1 not in matrix:
+            return matrix
+        predictions = iter(self.prelim.predict(self.prelim._get_imputation_features_loop(matrix).astype(np.float32)))
+        expected = matrix.copy()
+        for i in range(matrix.shape[0]):
+            for j in range(matrix.shape[1]):
+                if matrix[i, j] == -1:
+                    expected[i, j] = next(predictions)
+        return expected
+
+    def testImpute(self):
+        for m in self.matrices:
+            np.testing.assert_array_equal(self.prelim.impute(m), self.reference(m))
+
+    def testImputeMany(self):
+        for m, imputed in zip(self.matrices, self.prelim.impute_many(self.matrices)):
+            np.testing.assert_array_equal(imputed, self.reference(m))
+
+    def testImputeRaggedInplace(self):
+        ragged = RaggedMatrices.from_matrices(self.matrices, dtype=float)
+        predicted = self.prelim.impute_ragged(ragged.data, ragged.offsets, inplace=True)
+        self.assertIs(predicted, ragged.data)
+        for m, imputed in zip(self.matrices, ragged):
+            np.testing.assert_array_equal(imputed, self.reference(m))
+
+
 class TestImpuation(unittest.TestCase):
 
     def setUp(self):
@@ -166,6 +1044,20 @@ class TestImpuation(unittest.TestCase):
     def testImputedResults(self):
         self.assertEqual(self.imputed_matrix.shape, (92, 4))
 
+    def testImputedReadCounts(self):
+        models_folder = tempfile.mkdtemp()
+        try:
+            shutil.copy(os.path.join(test_data_location, prelim_model), ModelRegistry.model_path(models_folder, 4))
+            matrix = np.array(self.matrix.fillna(-1), dtype=np.int8)
+            matrices = RaggedMatrices.from_matrices([matrix, matrix[:10], matrix[:0]], cpg_density=4)
+            counts = self.imputer.imputed_read_counts(models_folder, matrices, batch_size=2,
+                                                      registry=ModelRegistry())
+        finally:
+            shutil.rmtree(models_folder)
+        expected = [self.imputed_matrix.shape[0], pd.DataFrame(
+            self.imputer.postprocess_predictions(self.prelim.impute(matrix[:10]))).dropna().shape[0], 0]
+        self.assertEqual(counts.tolist(), expected)
+
 
 if __name__ == "__main__":
     unittest.main()
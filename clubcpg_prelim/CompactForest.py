@@ -0,0 +1,155 @@
+"""
+A compact inference format for trained PReLIM random forests.
+
+All trees of a fitted sklearn RandomForestClassifier are flattened into a few
+contiguous numpy arrays (split features, thresholds, children and normalized
+leaf probabilities). Prediction walks every tree for a block of feature vectors
+at once, one tree level per step, instead of calling predict_proba tree by tree.
+
+"""
+
+import numpy as np
+
+
+class CompactForest():
+	"""
+	Flattened random forest with the prediction interface PReLIM uses (predict_proba, predict, classes_).
+
+	Node k of the forest splits on feature[k] at threshold[k]. Samples go to children[k, 0] if
+	their value is <= threshold[k] and to children[k, 1] otherwise. Leaves point to themselves,
+	so walking max_depth levels leaves every sample on a leaf of every tree.
+
+	"""
+	def __init__(self, feature, threshold, children, leaf_proba, roots, max_depth, classes, n_features):
+		"""
+		:param feature: 1d integer array, feature index of every node
+		:param threshold: 1d float32 array, split threshold of every node
+		:param children: 2d integer array, left and right child of every node, shape (nodes, 2)
+		:param leaf_proba: 2d float array, class probabilities of every node, shape (nodes, classes)
+		:param roots: 1d integer array, index of the root node of every tree
+		:param max_depth: depth of the deepest tree
+		:param classes: class labels, same order as the columns of leaf_proba
+		:param n_features: number of features the forest was trained on
+		"""
+		self.feature = feature
+		self.threshold = threshold
+		self.children = children
+		self.leaf_proba = leaf_proba
+		self.roots = roots
+		self.max_depth = int(max_depth)
+		self.classes_ = classes
+		self.n_features_in_ = int(n_features)
+
+	@classmethod
+	def from_estimator(cls, model):
+		"""
+		Flatten a fitted forest
+
+		:param model: fitted RandomForestClassifier, or a fitted GridSearchCV over one
+		:return: CompactForest with the same predictions
+		"""
+		model = getattr(model, "best_estimator_", model)
+		trees = [estimator.tree_ for estimator in model.estimators_]
+
+		sizes = np.array([tree.node_count for tree in trees], dtype=np.int64)
+		roots = np.zeros(len(trees), dtype=np.int64)
+		np.cumsum(sizes[:-1], out=roots[1:])
+
+		features, thresholds, children, probas = [], [], [], []
+		for tree, root in zip(trees, roots):
+			nodes = np.arange(tree.node_count)
+			is_leaf = tree.children_left == -1
+			features.append(np.where(is_leaf, 0, tree.feature))
+			thresholds.append(tree.threshold)
+			children.append(np.stack([np.where(is_leaf, nodes, tree.children_left),
+									  np.where(is_leaf, nodes, tree.children_right)], axis=1) + root)
+
+			# Same normalization as DecisionTreeClassifier.predict_proba
+			value = tree.value[:, 0, :]
+			normalizer = value.sum(axis=1, keepdims=True)
+			normalizer[normalizer == 0.0] = 1.0
+			probas.append(value / normalizer)
+
+		# sklearn compares float32 features to float64 thresholds. x <= t holds for a float32 x exactly
+		# when x <= the largest float32 not above t, so thresholds can be stored as float32 without changing a split
+		threshold = np.concatenate(thresholds)
+		threshold32 = threshold.astype(np.float32)
+		rounded_up = threshold32.astype(np.float64) > threshold
+		threshold32[rounded_up] = np.nextafter(threshold32[rounded_up], np.float32(-np.inf))
+
+		return cls(feature=np.concatenate(features).astype(np.intp),
+				   threshold=threshold32,
+				   children=np.concatenate(children).astype(np.intp),
+				   leaf_proba=np.concatenate(probas),
+				   roots=roots.astype(np.intp),
+				   max_depth=max(tree.max_depth for tree in trees),
+				   classes=np.asarray(model.classes_),
+				   n_features=trees[0].n_features)
+
+	@property
+	def n_trees(self):
+		return len(self.roots)
+
+	def _check_X(self, X):
+		"""
+		Reject inputs sklearn would reject. A NaN compares False with every threshold, so the traversal would
+		silently send it right at every split
+
+		:param X: 2d array of feature vectors
+		:return: X as a contiguous float32 array
+		"""
+		X = np.ascontiguousarray(X, dtype=np.float32)
+		if X.ndim != 2:
+			raise ValueError("Expected a 2d array of feature vectors, got {} dimensions".format(X.ndim))
+		if X.shape[1] != self.n_features_in_:
+			raise ValueError("X has {} features, but the forest was trained with {} features".format(
+				X.shape[1], self.n_features_in_))
+		if not np.isfinite(X).all():
+			raise ValueError("Input X contains NaN or infinity")
+		return X
+
+	def leaves(self, X):
+		"""
+		:param X: 2d array of feature vectors
+		:return: 2d integer array, the leaf reached in every tree by every sample, shape (trees, samples)
+		"""
+		return self._leaves(self._check_X(X))
+
+	def _leaves(self, X):
+		n_samples, n_features = X.shape
+		flat_X = X.ravel()
+		children = self.children.ravel()
+		# Position of every sample in flat_X, the feature index of a node is added to it
+		row_starts = np.arange(n_samples, dtype=np.intp) * n_features
+
+		nodes = np.repeat(self.roots[:, None], n_samples, axis=1)
+		for _ in range(self.max_depth):
+			go_right = np.take(flat_X, np.take(self.feature, nodes) + row_starts) > np.take(self.threshold, nodes)
+			nodes = np.take(children, 2 * nodes + go_right)
+
+		return nodes
+
+	def predict_proba(self, X, block_size=4096):
+		"""
+		:param X: 2d array of feature vectors
+		:param block_size: number of samples walked through the forest together, bounds memory use
+		:return: 2d array of class probabilities averaged over all trees, shape (samples, classes)
+		"""
+		X = self._check_X(X)
+		proba = np.zeros((X.shape[0], len(self.classes_)))
+		for start in range(0, X.shape[0], block_size):
+			nodes = self._leaves(X[start:start + block_size])
+			# Accumulate tree by tree, in the same order as sklearn
+			block = proba[start:start + block_size]
+			for tree_leaves in nodes:
+				block += self.leaf_proba[tree_leaves]
+
+		proba /= self.n_trees
+		return proba
+
+	def predict(self, X):
+		"""
+		:param X: 2d array of feature vectors
+		:return: 1d array of the most likely class label of every sample
+		"""
+		return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
@@ -31,7 +31,9 @@ import random
 # sklearn imports
 from sklearn.preprocessing import normalize
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.utils import check_random_state
+from joblib import Parallel, delayed
 
 # Pickle
 try:
@@ -106,6 +108,10 @@ class PReLIM():
 	def __init__(self, cpgDensity=2):
 		self.model = None
 		self.cpgDensity = cpgDensity
+		# Optional PredictionCache, reuses predictions of feature vectors seen before
+		self.prediction_cache = None
+		# Search strategy, chosen parameters and wall time of the last call to fit
+		self.search_summary = None
 		self.METHYLATED = 1
 		self.UNMETHYLATED = 0
 		self.MISSING = -1
@@ -135,7 +141,8 @@ class PReLIM():
 			cores = -1,
 			max_depths = [1, 5, 10, 20, 30],
 			model_file=None,
-			verbose=False
+			verbose=False,
+			search="grid"
 			):
 		"""
 		Inputs: 
@@ -147,8 +154,11 @@ class PReLIM():
 		6. model_file, string,      The name of the file to save the model to. 
 			If None, then create a file name that includes a timestamp.
 			If you don't want to save a file, set this to "no"
+		7. search, string, "grid" for an exhaustive grid search, "halving" for successive halving
+			over n_estimators, see _halving_search
 	
-		5-fold validation is built into the grid search
+		5-fold validation is built into the search. The chosen parameters and the wall time
+		of the search are stored in self.search_summary
 
 		Outputs: 
 		The trained model
@@ -156,18 +166,28 @@ class PReLIM():
 		Usage: 
 		model.fit(X_train, y_train)	
 		"""
-
-
-		grid_param = {  
-		 "n_estimators": n_estimators,
-		  "max_depth": max_depths,
-		}
-
-		# Note: let the grid search use a lot of cores, but only use 1 for each forest
-		# since dispatching can take a lot of time
-		rf = RandomForestClassifier(n_jobs=1)
-		self.model = GridSearchCV(rf, grid_param, n_jobs=cores, cv=5, verbose=verbose)
-		self.model.fit(X_train, y_train)
+		start = time.time()
+
+		if search == "halving":
+			self.model, best_params = self._halving_search(X_train, y_train, n_estimators, max_depths, cores, verbose)
+		elif search == "grid":
+			grid_param = {  
+			 "n_estimators": n_estimators,
+			  "max_depth": max_depths,
+			}
+
+			# Note: let the grid search use a lot of cores, but only use 1 for each forest
+			# since dispatching can take a lot of time
+			rf = RandomForestClassifier(n_jobs=1)
+			self.model = GridSearchCV(rf, grid_param, n_jobs=cores, cv=5, verbose=verbose)
+			self.model.fit(X_train, y_train)
+			best_params = self.model.best_params_
+		else:
+			raise ValueError("Unknown search strategy: {}, use 'grid' or 'halving'".format(search))
+
+		self.search_summary = {"search": search, "best_params": best_params, "wall_time": time.time() - start}
+		if self.prediction_cache is not None:
+			self.prediction_cache.clear()
 
 
 		# save the model
@@ -185,8 +205,87 @@ class PReLIM():
 
 
 
+	@staticmethod
+	def _grow_forest(forest, X, y, train, test, n_trees):
+		'''
+		Grow a warm started forest to n_trees trees on the train fold, returns its accuracy on the test fold
+		'''
+		forest.set_params(n_estimators=n_trees)
+		forest.fit(X[train], y[train])
+		return forest.score(X[test], y[test])
+
+	def _halving_search(self, X_train, y_train, n_estimators, max_depths, cores=-1, verbose=False, factor=2):
+		'''
+		Successive halving over the number of trees. Every max_depth starts with one warm started
+		forest per fold. At each value of n_estimators, in increasing order, the surviving forests
+		are grown to that size, reusing all trees grown so far, and only the best 1/factor of the
+		depths by mean cross validated accuracy go on to the next size.
+
+		Inputs:
+		1. X_train, y_train, n_estimators, max_depths, cores, verbose, as in fit
+		2. factor, int, fraction of depths dropped at every size
+
+		Outputs:
+		1. A forest refit on all data with the best parameters
+		2. The best parameters, dict with n_estimators and max_depth. Ties go to fewer trees
+		'''
+		folds = list(StratifiedKFold(n_splits=5).split(X_train, y_train))
+		forests = {depth: [RandomForestClassifier(n_jobs=1, max_depth=depth, warm_start=True) for _ in folds]
+				   for depth in max_depths}
+
+		best_score, best_params = None, None
+		survivors = list(max_depths)
+		for n_trees in sorted(n_estimators):
+			tasks = [(depth, fold) for depth in survivors for fold in range(len(folds))]
+			# Forests are grown in place, trees are built without the GIL so threads run in parallel
+			scores = Parallel(n_jobs=cores, prefer="threads")(
+				delayed(self._grow_forest)(forests[depth][fold], X_train, y_train, folds[fold][0], folds[fold][1], n_trees)
+				for depth, fold in tasks)
+
+			mean_scores = {depth: np.mean(scores[k * len(folds):(k + 1) * len(folds)]) for k, depth in enumerate(survivors)}
+			for depth in survivors:
+				if best_score is None or mean_scores[depth] > best_score:
+					best_score, best_params = mean_scores[depth], {"max_depth": depth, "n_estimators": n_trees}
+			if verbose:
+				print("n_estimators={}: {}".format(n_trees, mean_scores))
+
+			# Keep the best depths, in the order they were given
+			ranked = sorted(survivors, key=lambda depth: -mean_scores[depth])
+			kept = set(ranked[:max(1, int(np.ceil(len(survivors) / factor)))])
+			survivors = [depth for depth in survivors if depth in kept]
+
+		model = RandomForestClassifier(n_jobs=cores, **best_params)
+		model.fit(X_train, y_train)
+		return model, best_params
+
 	# Feature collection directly from bins
-	def get_X_y(self, bin_matrices, model_file=None, verbose=False):
+	def get_X_y(self, bin_matrices, model_file=None, verbose=False, random_state=None):
+		"""
+		Inputs:
+		1. bin_matrices, list of cpg matrices or a RaggedMatrices, all with the same number of CpGs
+		2. random_state, None, int or np.random.RandomState, used to shuffle bins and pick masks.
+			None uses the global numpy random state
+
+		Outputs:
+		1. X, numpy array of feature vectors, one per masked CpG
+		2. y, numpy array of the true states of the masked CpGs
+
+		Complete reads of every bin are masked with the missing data pattern of a random bin
+		that has missing data and as many reads, see _mask_training_matrices
+		"""
+		if len(bin_matrices) == 0:
+			return np.array([]), np.array([])
+
+		data, offsets = self._concatenate_matrices(bin_matrices)
+		observed, truth, masked_offsets = _mask_training_matrices(data, offsets, check_random_state(random_state))
+		if len(masked_offsets) == 1:
+			return np.array([]), np.array([])
+
+		X, rows, cols = self._get_imputation_features_batch(observed, masked_offsets)
+		return X, truth[rows, cols]
+
+	# Reference implementation of get_X_y, bin by bin
+	def _get_X_y_loop(self, bin_matrices, model_file=None, verbose=False):
 		bins = []
 
 		# convert to bin objects for ease of use
@@ -234,6 +333,8 @@ class PReLIM():
 		y_pred = CpGNet.predict(X)  
 
 		"""
+		if self.prediction_cache is not None:
+			return self.prediction_cache.predict(lambda rows: self.model.predict_proba(rows)[:,1], X)
 		return self.model.predict_proba(X)[:,1]
 
 
@@ -271,13 +372,99 @@ class PReLIM():
 
 
 
-	def _get_imputation_features(self,matrix):
+	def _get_imputation_features(self, matrix):
 		'''
 		Returns a vector of features needed for the imputation of this matrix
 
 		Inputs: 
 		1. matrix, a 2d np array, dtype=float, representing a CpG matrix, 1=methylated, 0=unmethylated, -1=unknown
 
+		Outputs:
+		1. A float32 feature array with one row per unknown state, in row-major order
+		'''
+		matrix = np.asarray(matrix)
+		X, _, _ = self._get_imputation_features_batch(matrix, [0, matrix.shape[0]])
+		return X
+
+	def _get_imputation_features_batch(self, data, offsets):
+		'''
+		Returns the feature vectors of every unknown state of many matrices at once, without Python loops over
+		reads or CpGs. Produces exactly the features of _get_imputation_features_loop, as float32.
+
+		Inputs: 
+		1. data, a 2d np array, the reads of all matrices concatenated, 1=methylated, 0=unmethylated, -1=unknown
+		2. offsets, a 1d integer array of length number of matrices + 1, matrix k is data[offsets[k]:offsets[k+1]]
+
+		Outputs:
+		1. X, a 2d float32 np array, one feature vector per unknown state, matrix by matrix in row-major order
+		2. rows, the row in data of every unknown state
+		3. cols, the column in data of every unknown state
+		'''
+		data = np.asarray(data)
+		offsets = np.asarray(offsets, dtype=np.int64)
+		n_matrices = len(offsets) - 1
+		density = data.shape[1]
+		n_patterns = 3 ** density
+
+		missing = data == -1
+		rows, cols = np.nonzero(missing)
+
+		read_counts = np.diff(offsets)
+		matrix_index = np.repeat(np.arange(n_matrices), read_counts)
+
+		# Means over the known states. Sums of 0s and 1s are exact, so this matches np.nanmean bit for bit
+		known = np.where(missing, 0, data).astype(np.float64)
+		known_counts = (~missing).astype(np.float64)
+		column_sums = np.zeros((n_matrices, density))
+		column_counts = np.zeros((n_matrices, density))
+		nonempty = read_counts > 0
+		if nonempty.any():
+			starts = offsets[:-1][nonempty]
+			column_sums[nonempty] = np.add.reduceat(known, starts, axis=0)
+			column_counts[nonempty] = np.add.reduceat(known_counts, starts, axis=0)
+
+		with np.errstate(invalid="ignore", divide="ignore"):
+			row_means = known.sum(axis=1) / known_counts.sum(axis=1)
+			column_means = column_sums / column_counts
+
+			# l1 normalized histogram of the base 3 read patterns of every matrix, see _encode_input_matrix
+			base_3_vec = np.power(3, np.arange(density - 1, -1, -1))
+			codes = np.dot(data.astype(np.int64) + 1, base_3_vec)
+			pattern_counts = np.bincount(matrix_index * n_patterns + codes, minlength=n_matrices * n_patterns)
+			encodings = pattern_counts.reshape(n_matrices, n_patterns) / read_counts[:, np.newaxis].astype(np.float64)
+
+		owner = matrix_index[rows]
+		X = np.empty((len(rows), 4 + density + n_patterns), dtype=np.float32)
+		X[:, 0] = row_means[rows]
+		X[:, 1] = column_means[owner, cols]
+		X[:, 2] = rows - offsets[owner]
+		X[:, 3] = cols
+		X[:, 4:4 + density] = data[rows]
+		X[np.arange(len(rows)), 4 + cols] = -1
+		X[:, 4 + density:] = encodings[owner]
+
+		return X, rows, cols
+
+	@staticmethod
+	def _concatenate_matrices(matrices):
+		'''
+		Returns (data, offsets) for a list of matrices, or the buffers of a RaggedMatrices as they are
+		'''
+		if hasattr(matrices, "offsets"):
+			return matrices.data, matrices.offsets
+		matrices = [np.asarray(m) for m in matrices]
+		offsets = np.zeros(len(matrices) + 1, dtype=np.int64)
+		np.cumsum([m.shape[0] for m in matrices], out=offsets[1:])
+		return np.concatenate(matrices), offsets
+
+	def _get_imputation_features_loop(self,matrix):
+		'''
+		Returns a vector of features needed for the imputation of this matrix.
+		Reference implementation of _get_imputation_features, one cell at a time
+
+		Inputs: 
+		1. matrix, a 2d np array, dtype=float, representing a CpG matrix, 1=methylated, 0=unmethylated, -1=unknown
+
 		Outputs:
 		1. A feature vector for the matrix
 		'''
@@ -332,13 +519,9 @@ class PReLIM():
 
 		predictions = self.predict(X)
 
-		k = 0 # keep track of prediction index for missing states
-		predicted_matrix = np.copy(matrix)
-		for i in range(predicted_matrix.shape[0]):
-			for j in range(predicted_matrix.shape[1]):
-				if predicted_matrix[i, j] == -1:
-					predicted_matrix[i, j] = predictions[k]
-					k += 1
+		# boolean mask assignment fills the unknowns in row-major order, the order the features were built in
+		predicted_matrix = np.array(matrix, dtype=float)
+		predicted_matrix[predicted_matrix == -1] = predictions
 
 		return predicted_matrix
 
@@ -361,36 +544,49 @@ class PReLIM():
 
 		1. A List of 2d numpy arrays with predicted probabilities of methylation for unknown values.
 		'''
+		if len(matrices) == 0:
+			return matrices
 
-		# Extract all features for all matrices so we can predict in bulk, this is where the speedup comes from
-		
-		X = np.array([features for matrix_features in [self._get_imputation_features(matrix) for matrix in matrices] for features in matrix_features])
-		
-		if len(X) == 0:
+		data, offsets = self._concatenate_matrices(matrices)
+		predicted = self.impute_ragged(data, offsets)
+		if predicted is data:
 			return matrices
-		
-		predictions = self.predict(X)
 
+		# views into the imputed buffer, one per matrix
+		return [predicted[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
 
-		predicted_matrices = []
+	def impute_ragged(self, data, offsets, inplace=False):
+		'''
+		Imputes many matrices stored as one concatenated buffer, with a single prediction for all of them.
 
-		# TODO: lots of for-loops here, could be sped up?
+		Inputs:
 
-		k = 0 # keep track of prediction index for missing states, order is crucial!
-		for matrix in matrices:
-			predicted_matrix = np.copy(matrix)
-			for i in range(predicted_matrix.shape[0]):
-				for j in range(predicted_matrix.shape[1]):
-					if predicted_matrix[i, j] == -1:
-						predicted_matrix[i, j] = predictions[k]
-						k += 1
-			predicted_matrices.append(predicted_matrix)
+		1. data, a 2d np array, the reads of all matrices concatenated, 1=methylated, 0=unmethylated, -1=unknown
+		2. offsets, a 1d integer array of length number of matrices + 1, matrix k is data[offsets[k]:offsets[k+1]]
+		3. inplace, boolean, write the predictions into data, which must then be a float array
 
-		return predicted_matrices
+		Outputs:
 
+		1. A 2d float array laid out like data, with predicted probabilities of methylation for unknown values.
+		data itself is returned if there was nothing to impute
+		'''
 
+		# Extract all features for all matrices so we can predict in bulk, this is where the speedup comes from
+		X, rows, cols = self._get_imputation_features_batch(data, offsets)
 
+		if len(X) == 0:
+			return data
 
+		predictions = self.predict(X)
+
+		# features were built in row-major order of the buffer, so the mask assignment puts every prediction back in place
+		if inplace:
+			predicted = data
+		else:
+			predicted = np.array(data, dtype=float)
+		predicted[rows, cols] = predictions
+
+		return predicted
 
 
 
@@ -446,6 +642,18 @@ class PReLIM():
 	# Returns X, y
 	# note: y can contain the labels 1,0, -1
 	def _collectFeatures(self, bins):
+		if len(bins) == 0:
+			return np.array([]), np.array([])
+
+		observed, offsets = self._concatenate_matrices([Bin.tag2["observed"] for Bin in bins])
+		truth, _ = self._concatenate_matrices([Bin.tag2["truth"] for Bin in bins])
+
+		X, rows, cols = self._get_imputation_features_batch(observed, offsets)
+		Y = truth[rows, cols]
+		return X, Y
+
+	# Reference implementation of _collectFeatures, one cell at a time
+	def _collectFeatures_loop(self, bins):
 		X = []
 		Y = []
 		for Bin in tqdm(bins):
@@ -548,6 +756,52 @@ def _apply_masks( filtered_bins, all_bins ):
 
 	return ready_bins
 
+# Batched version of _filter_missing_data and _apply_masks, works on the reads of all bins at once.
+# Returns (observed, truth, offsets): matrix k of the training set is observed[offsets[k]:offsets[k+1]],
+# the complete reads of one bin with -1 wherever the chosen mask is missing, and truth holds the same
+# reads unmasked. Bins are shuffled, every bin with complete reads gets a mask drawn uniformly from the
+# bins with missing data that have exactly as many reads. Bins without such a mask are dropped.
+def _mask_training_matrices( data, offsets, random_state ):
+	offsets = np.asarray(offsets, dtype=np.int64)
+	read_counts = np.diff(offsets)
+	n_matrices = len(read_counts)
+	matrix_index = np.repeat(np.arange(n_matrices), read_counts)
+
+	row_missing = (data == -1).any(axis=1)
+	complete_rows = np.flatnonzero(~row_missing)
+	complete_counts = np.bincount(matrix_index[complete_rows], minlength=n_matrices)
+	complete_starts = np.zeros(n_matrices, dtype=np.int64)
+	np.cumsum(complete_counts[:-1], out=complete_starts[1:])
+
+	# masks are the bins with at least one missing value, their shape is their read count
+	mask_ids = np.flatnonzero(np.bincount(matrix_index[row_missing], minlength=n_matrices) > 0)
+	mask_shapes = read_counts[mask_ids]
+
+	# shuffle the bins with complete reads, then draw the masks one shape at a time
+	targets = random_state.permutation(np.flatnonzero(complete_counts >= 1))
+	target_shapes = complete_counts[targets]
+	chosen = np.full(len(targets), -1, dtype=np.int64)
+	for shape in np.unique(target_shapes):
+		pool = mask_ids[mask_shapes == shape]
+		if len(pool) == 0:
+			continue
+		group = np.flatnonzero(target_shapes == shape)
+		chosen[group] = pool[random_state.randint(len(pool), size=len(group))]
+
+	has_mask = chosen >= 0
+	targets, chosen = targets[has_mask], chosen[has_mask]
+	counts = complete_counts[targets]
+	new_offsets = np.zeros(len(targets) + 1, dtype=np.int64)
+	np.cumsum(counts, out=new_offsets[1:])
+
+	# row k of a training matrix is complete read k of its bin, masked by row k of its mask
+	within = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1], counts)
+	truth = data[complete_rows[np.repeat(complete_starts[targets], counts) + within]].astype(float)
+	mask = data[np.repeat(offsets[chosen], counts) + within]
+	observed = np.where(mask == -1, -1.0, truth)
+
+	return observed, truth, new_offsets
+
 # get a set of bins with no missing data
 def _filter_missing_data( bins, min_read_depth=1 ):
 	cpg_bins_complete = _filter_bad_reads(bins)
@@ -0,0 +1,99 @@
+"""
+Memoization of PReLIM predictions by exact feature vector.
+
+Most missing cells of low density bins share a small set of distinct feature
+vectors, so the same inputs are predicted again and again across bins. The cache
+predicts every distinct row of a batch once and remembers the results of recent
+batches in a bounded least recently used store.
+
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class PredictionCache():
+	"""
+	Bounded LRU store of predictions keyed by the bytes of a feature row.
+
+	Usage:
+	cache = PredictionCache(max_size=100000)
+	predictions = cache.predict(model.predict, X)
+	print(cache.summary())
+
+	"""
+	def __init__(self, max_size=100000):
+		"""
+		:param max_size: maximum number of feature rows remembered across batches
+		"""
+		self.max_size = int(max_size)
+		self._store = OrderedDict()
+		self._lock = threading.Lock()
+		# Feature rows requested, distinct rows within their batch, and distinct rows found in the store
+		self.rows = 0
+		self.unique_rows = 0
+		self.hits = 0
+
+	def __len__(self):
+		return len(self._store)
+
+	def predict(self, predict_function, X):
+		"""
+		:param predict_function: callable returning one prediction per row of a 2d array
+		:param X: 2d numpy array of feature vectors
+		:return: 1d numpy array of predictions, equal to predict_function(X)
+		"""
+		X = np.ascontiguousarray(X)
+		if X.shape[0] == 0:
+			return predict_function(X)
+
+		# View every row as one opaque value, deduplicating those is much faster than np.unique(X, axis=0)
+		row_bytes = X.view(np.dtype((np.void, X.dtype.itemsize * X.shape[1]))).ravel()
+		unique_bytes, first, inverse = np.unique(row_bytes, return_index=True, return_inverse=True)
+		keys = unique_bytes.tolist()
+		values = np.empty(len(keys))
+
+		missing = []
+		with self._lock:
+			for k, key in enumerate(keys):
+				value = self._store.get(key)
+				if value is None:
+					missing.append(k)
+				else:
+					values[k] = value
+					self._store.move_to_end(key)
+
+		if missing:
+			values[missing] = predict_function(X[first[missing]])
+
+		with self._lock:
+			for k in missing:
+				self._store[keys[k]] = values[k]
+			while len(self._store) > self.max_size:
+				self._store.popitem(last=False)
+
+			self.rows += X.shape[0]
+			self.unique_rows += len(keys)
+			self.hits += len(keys) - len(missing)
+
+		return values[inverse.reshape(-1)]
+
+	@property
+	def predicted_rows(self):
+		"""Number of feature rows that actually went through the model"""
+		return self.unique_rows - self.hits
+
+	def hit_rate(self):
+		"""Fraction of requested feature rows answered without the model"""
+		return 1 - self.predicted_rows / self.rows if self.rows else 0.0
+
+	def clear(self):
+		with self._lock:
+			self._store.clear()
+			self.rows = self.unique_rows = self.hits = 0
+
+	def summary(self):
+		"""One line describing the savings of the cache"""
+		return "Predicted {} of {} feature rows ({:.1%} answered from {} duplicate rows and {} cache hits)".format(
+			self.predicted_rows, self.rows, self.hit_rate(), self.rows - self.unique_rows, self.hits)
@@ -0,0 +1,97 @@
+"""
+A compact container for many CpG matrices of the same CpG density.
+
+Matrices extracted from a BAM file all have the same number of columns (CpGs) for
+a given density, but a different number of rows (reads). Instead of keeping one
+small numpy array per bin, all rows are stored in one concatenated buffer and
+each matrix is described by a pair of row offsets into that buffer.
+
+"""
+
+import numpy as np
+
+
+class RaggedMatrices():
+	"""
+	Collection of CpG matrices sharing a number of CpGs, stored as one buffer plus row offsets.
+
+	Matrix i is data[offsets[i]:offsets[i+1]] and belongs to bins[i].
+
+	"""
+	def __init__(self, data, offsets, bins=None):
+		"""
+		:param data: 2d numpy array, all reads of all matrices concatenated, shape (total reads, CpG density)
+		:param offsets: 1d integer numpy array of length number of matrices + 1, row offsets into data
+		:param bins: optional 1d array of bin ids, one per matrix
+		"""
+		self.data = data
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.bins = bins
+
+	@classmethod
+	def from_matrices(cls, matrices, bins=None, cpg_density=None, dtype=np.int8):
+		"""
+		Build the container from an iterable of 2d matrices
+
+		:param matrices: iterable of 2d arrays with the same number of columns
+		:param bins: optional iterable of bin ids, one per matrix
+		:param cpg_density: number of columns, only needed when matrices is empty
+		:param dtype: dtype of the concatenated buffer
+		"""
+		matrices = [np.asarray(m) for m in matrices]
+		if cpg_density is None:
+			cpg_density = matrices[0].shape[1] if matrices else 0
+
+		offsets = np.zeros(len(matrices) + 1, dtype=np.int64)
+		if matrices:
+			np.cumsum([m.shape[0] for m in matrices], out=offsets[1:])
+
+		# Preallocate the buffer and copy every matrix into its slot
+		data = np.empty((offsets[-1], cpg_density), dtype=dtype)
+		for m, start, stop in zip(matrices, offsets[:-1], offsets[1:]):
+			data[start:stop] = m
+
+		if bins is not None:
+			bins = np.asarray(list(bins), dtype=object)
+
+		return cls(data, offsets, bins)
+
+	@property
+	def cpg_density(self):
+		return self.data.shape[1]
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		# A view, no copy of the underlying buffer
+		return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def read_counts(self):
+		"""Number of reads (rows) of every matrix"""
+		return np.diff(self.offsets)
+
+	def matrix_index(self):
+		"""For every row of data, the index of the matrix it belongs to"""
+		return np.repeat(np.arange(len(self)), self.read_counts())
+
+	def with_data(self, data):
+		"""A container with the same layout and bins, holding a new buffer of the same number of rows"""
+		if data.shape[0] != self.data.shape[0]:
+			raise ValueError("New buffer has {} rows, expected {}".format(data.shape[0], self.data.shape[0]))
+		return RaggedMatrices(data, self.offsets, self.bins)
+
+	def subset(self, indices):
+		"""A new container holding only the matrices at the given indices, in that order"""
+		indices = np.asarray(indices, dtype=np.int64)
+		counts = self.read_counts()[indices]
+		offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+		np.cumsum(counts, out=offsets[1:])
+		# Row indices of the selected matrices, built without a Python loop over matrices
+		rows = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[indices], counts)
+		bins = self.bins[indices] if self.bins is not None else None
+		return RaggedMatrices(self.data[rows], offsets, bins)
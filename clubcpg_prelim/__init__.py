@@ -1,4 +1,7 @@
 from .PReLIM import PReLIM
+from .RaggedMatrices import RaggedMatrices
+from .CompactForest import CompactForest
+from .PredictionCache import PredictionCache
 
 __version__ = "0.1.13"
 __author__ = "Jack Duryea"
@@ -39,9 +39,13 @@ setup(name="clubcpg",
       scripts=[
           'bin/clubcpg-coverage',
             'bin/clubcpg-cluster',
+            'bin/clubcpg-filter',
             'bin/clubcpg-impute-train',
             'bin/clubcpg-impute-coverage',
             'bin/clubcpg-impute-cluster',
+            'bin/clubcpg-run',
+            'bin/clubcpg-merge',
+            'bin/clubcpg-index',
       ]
 
       )